@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Time wyag commands on a synthetic repository, and compare runs.
+
+    bench.py run [-o results.json] [--repeat N] [scenario...] [shape options]
+    bench.py compare old.json new.json [--threshold 10]
+
+run builds the repository (see generate.py) unless one of the same
+shape is already there, then runs each scenario repeat times, each
+time as a new process, as wyag runs from a shell, a prompt or a hook.
+It writes the times to a JSON file.  The startup scenario only
+imports libwyag, and also records what python -X importtime says it
+cost.
+
+compare reads two such files and prints how each scenario's median
+changed.  A scenario more than threshold percent slower is a
+regression, and makes compare exit with status 1, so it can gate a
+change: run on the old code, run on the new, compare."""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Each scenario is the wyag arguments to run in the repository, and
+# what to feed it on stdin.  "{tmp}" is replaced by a fresh empty
+# directory.
+scenarios = { "startup":      None,
+              "rev-parse":    ([ "rev-parse", "HEAD" ], None),
+              "log":          ([ "log", "--oneline", "HEAD" ], None),
+              "ls-tree":      ([ "ls-tree", "-r", "HEAD" ], None),
+              "checkout":     ([ "checkout", "HEAD", "{tmp}" ], None),
+              "ls-files":     ([ "ls-files" ], None),
+              "check-ignore": ([ "check-ignore", "--stdin" ], "paths"),
+              "show-ref":     ([ "show-ref" ], None) }
+
+def main(argv=sys.argv[1:]):
+    argparser = argparse.ArgumentParser(description="Benchmark wyag.")
+    argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+    argsubparsers.required = True
+
+    argsp = argsubparsers.add_parser("run", help="Run the scenarios")
+    argsp.add_argument("scenario", nargs="*",
+                       help=f"Only run these scenarios, out of {', '.join(scenarios)}")
+    argsp.add_argument("-o", "--output", default="bench.json", help="Where to write the results")
+    argsp.add_argument("--repeat", type=int, default=5, help="How many times to run each scenario")
+    argsp.add_argument("--repo", default=None,
+                       help="Where to build the repository.  Defaults to a directory in the "
+                            "temporary directory, named after the shape, and kept between runs.")
+    generate.argparse_shape(argsp)
+
+    argsp = argsubparsers.add_parser("compare", help="Compare two runs")
+    argsp.add_argument("old", help="Results of the run to compare against")
+    argsp.add_argument("new", help="Results of the run to check")
+    argsp.add_argument("--threshold", type=float, default=10.0,
+                       help="How many percent slower a scenario can get before it's a regression")
+
+    args = argparser.parse_args(argv)
+    match args.command:
+        case "run": cmd_run(args)
+        case "compare": sys.exit(cmd_compare(args))
+
+def cmd_run(args):
+    for name in args.scenario:
+        if name not in scenarios:
+            raise Exception(f"No such scenario: {name}")
+    shape = { key: getattr(args, key) for key in generate.shape_defaults }
+    path = args.repo or os.path.join(tempfile.gettempdir(),
+                                     "wyag-bench-" + "-".join(str(v) for v in shape.values()))
+    if not os.path.exists(os.path.join(path, ".git")):
+        print(f"Generating {path}...", file=sys.stderr)
+        generate.generate(path, shape)
+
+    results = dict()
+    for name in args.scenario or scenarios:
+        results[name] = run_scenario(name, path, args.repeat)
+        print(f"{name:<14} median {results[name]['median'] * 1000:8.1f} ms"
+              f"   min {results[name]['min'] * 1000:8.1f} ms", file=sys.stderr)
+
+    report = { "python": platform.python_version(),
+               "platform": platform.platform(),
+               "commit": git_head(),
+               "date": int(time.time()),
+               "shape": shape,
+               "repeat": args.repeat,
+               "scenarios": results }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+def run_scenario(name, path, repeat):
+    """Run scenario name in the repository at path repeat times, after
+one untimed run to warm the caches.  Returns its statistics."""
+    env = dict(os.environ, PYTHONPATH=root)
+    if name == "startup":
+        argv, stdin = [ sys.executable, "-c", "import libwyag" ], None
+    else:
+        args, stdin = scenarios[name]
+        argv = [ sys.executable, os.path.join(root, "wyag") ] + args
+        if stdin == "paths":
+            stdin = worktree_paths(path)
+
+    times = list()
+    for i in range(repeat + 1):
+        tmp = tempfile.mkdtemp(prefix="wyag-bench-")
+        try:
+            start = time.perf_counter()
+            subprocess.run([ a.replace("{tmp}", tmp) for a in argv ], cwd=path, env=env,
+                           input=stdin, stdout=subprocess.DEVNULL, check=True)
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(tmp)
+        if i:
+            times.append(elapsed)
+
+    ret = { "median": statistics.median(times),
+            "min": min(times),
+            "runs": times }
+    if name == "startup":
+        ret["importtime_us"] = import_time(env)
+    return ret
+
+def import_time(env):
+    """What python -X importtime says importing libwyag costs, in
+microseconds, everything it imports included."""
+    p = subprocess.run([ sys.executable, "-X", "importtime", "-c", "import libwyag" ],
+                       env=env, capture_output=True, text=True, check=True)
+    for line in p.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        fields = [ f.strip() for f in line.split("|") ]
+        if fields[-1] == "libwyag":
+            return int(fields[1])
+    return None
+
+def worktree_paths(path):
+    """Every file in the worktree at path, tracked or not, one per line."""
+    ret = list()
+    for dirpath, dirnames, filenames in os.walk(path):
+        if ".git" in dirnames:
+            dirnames.remove(".git")
+        ret.extend(os.path.relpath(os.path.join(dirpath, f), path) for f in filenames)
+    return "".join(p + "\n" for p in sorted(ret)).encode("utf8")
+
+def git_head():
+    """The commit being benchmarked, if root is a git checkout."""
+    try:
+        return subprocess.run([ "git", "rev-parse", "HEAD" ], cwd=root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def cmd_compare(args):
+    """Print the change of each scenario's median.  Returns 1 if any
+got slower by more than the threshold, 0 otherwise."""
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old["shape"] != new["shape"]:
+        print("Warning: the runs are on repositories of different shapes.", file=sys.stderr)
+
+    regressions = 0
+    for name, result in new["scenarios"].items():
+        if name not in old["scenarios"]:
+            print(f"{name:<14} {'':>10} {result['median'] * 1000:8.1f} ms   new")
+            continue
+        before = old["scenarios"][name]["median"]
+        change = (result["median"] - before) / before * 100
+        if change > args.threshold:
+            verdict = "REGRESSION"
+            regressions += 1
+        elif change < -args.threshold:
+            verdict = "faster"
+        else:
+            verdict = ""
+        print(f"{name:<14} {before * 1000:8.1f} ms -> {result['median'] * 1000:8.1f} ms"
+              f"  {change:+6.1f}%  {verdict}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    main()
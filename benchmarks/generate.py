@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""Build a synthetic repository for the benchmarks, with wyag itself.
+
+The same shape and seed always give the same repository, down to the
+object names: every object goes through object_write, with fixed
+dates, and every choice comes from one seeded random generator.
+
+The worktree has dirs subdirectories per directory, depth levels deep,
+and files files in each directory.  The first commit adds them all;
+each following one rewrites churn of them.  Blob sizes follow a
+log-normal distribution around blob_size bytes, so most files are
+small and a few are big, like in a real project.  Every
+commits // (tags + 1) commits gets an annotated tag, and the last
+commit is checked out: the files are written and the index holds them.
+
+Ignore rules go in .gitignore files, ignore_rules of them at the top
+and a few in each directory of the first level, mixing globs,
+anchored and directory patterns and negations.  Untracked files, some
+of them ignored, are scattered in the worktree too."""
+
+import argparse
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import libwyag
+
+shape_defaults = { "commits": 200,
+                   "files": 20,
+                   "dirs": 4,
+                   "depth": 2,
+                   "blob_size": 2000,
+                   "churn": 5,
+                   "tags": 10,
+                   "ignore_rules": 50,
+                   "untracked": 200,
+                   "seed": 1 }
+
+# Files are text, so deltas and diffs behave as with source code.
+words = [ "alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta",
+          "iota", "kappa", "lambda", "mu", "nu", "xi", "omicron", "pi", "rho",
+          "sigma", "tau", "upsilon", "phi", "chi", "psi", "omega" ]
+extensions = [ ".py", ".c", ".h", ".txt", ".md", ".json", ".o", ".log", ".tmp" ]
+
+def argparse_shape(argsp):
+    """Add an option for each part of the shape to argsp."""
+    for key, value in shape_defaults.items():
+        argsp.add_argument("--" + key.replace("_", "-"), dest=key, type=int, default=value)
+
+def main(argv=sys.argv[1:]):
+    argsp = argparse.ArgumentParser(description="Build a synthetic repository for the benchmarks.")
+    argsp.add_argument("path", help="Where to create it.  Must not exist.")
+    argparse_shape(argsp)
+    args = argsp.parse_args(argv)
+    generate(args.path, { key: getattr(args, key) for key in shape_defaults })
+
+def generate(path, shape):
+    """Create the repository described by shape (see shape_defaults) at
+path.  Returns its GitRepository."""
+    rng = random.Random(shape["seed"])
+    repo = libwyag.repo_create(path)
+
+    dirs = [ "" ]
+    for level in range(shape["depth"]):
+        dirs += [ f"{d}{name}{i}/" for d in dirs if d.count("/") == level
+                  for i, name in enumerate(rng.sample(words, shape["dirs"])) ]
+    files = dict() # path to contents
+    for d in dirs:
+        for i in range(shape["files"]):
+            files[f"{d}{rng.choice(words)}{i}{rng.choice(extensions[:6])}"] = None
+    for name in files:
+        files[name] = blob_contents(rng, shape["blob_size"])
+    files.update(gitignore_files(rng, dirs, shape["ignore_rules"]))
+
+    names = sorted(files)
+    blobs = dict() # contents to sha, of the blobs already written
+    commits = list()
+    step = max(shape["commits"] // (shape["tags"] + 1), 1)
+    for i in range(shape["commits"]):
+        if i:
+            for name in rng.sample(names, min(shape["churn"], len(names))):
+                files[name] = blob_contents(rng, shape["blob_size"])
+        tree = tree_write(repo, files, blobs)
+        commits.append(commit_write(repo, tree, commits[-1:], i))
+
+        if (i + 1) % step == 0 and (i + 1) // step <= shape["tags"]:
+            tag_write(repo, f"v{(i + 1) // step}", commits[-1], i)
+    libwyag.ref_create(repo, "heads/master", commits[-1])
+
+    worktree_write(repo, files, blobs)
+    for i in range(shape["untracked"]):
+        d = rng.choice(dirs)
+        name = f"{d}untracked{i}{rng.choice(extensions)}"
+        with open(os.path.join(repo.worktree, name), "w") as f:
+            f.write(f"{i}\n")
+    return repo
+
+def blob_contents(rng, median):
+    size = min(int(rng.lognormvariate(math.log(median), 1.0)), 1024 * 1024)
+    lines = list()
+    length = 0
+    while length < size:
+        line = " ".join(rng.choices(words, k=rng.randint(1, 12)))
+        lines.append(line)
+        length += len(line) + 1
+    return ("\n".join(lines) + "\n").encode("utf8")
+
+def gitignore_files(rng, dirs, count):
+    """Return the .gitignore files, as a dict of path to contents."""
+    def rule():
+        match rng.randrange(6):
+            case 0: return f"*{rng.choice(extensions)}"
+            case 1: return f"/{rng.choice(words)}*"
+            case 2: return f"{rng.choice(words)}/"
+            case 3: return f"!{rng.choice(words)}{rng.randrange(20)}{rng.choice(extensions)}"
+            case 4: return f"**/{rng.choice(words)}/*.tmp"
+            case _: return f"{rng.choice(words)}?{rng.choice(extensions)}"
+
+    ret = { ".gitignore": "\n".join(rule() for _ in range(count)) + "\n" }
+    for d in dirs:
+        if d.count("/") == 1:
+            ret[d + ".gitignore"] = "\n".join(rule() for _ in range(max(count // 10, 1))) + "\n"
+    return { name: contents.encode("utf8") for name, contents in ret.items() }
+
+def tree_write(repo, files, blobs):
+    """Write the trees for files, a dict of path to contents, and return
+the sha of the top one.  Blobs already in blobs, a dict of contents to
+sha, aren't written again."""
+    top = dict()
+    for name, contents in files.items():
+        sha = blobs.get(contents)
+        if sha is None:
+            sha = blobs[contents] = libwyag.object_write(libwyag.GitBlob(contents), repo)
+        d = top
+        *parents, base = name.split("/")
+        for p in parents:
+            d = d.setdefault(p, dict())
+        d[base] = sha
+
+    def write(d):
+        tree = libwyag.GitTree()
+        for name, value in d.items():
+            if isinstance(value, dict):
+                tree.items.append(libwyag.GitTreeLeaf(b"040000", name.encode("utf8"),
+                                                      bytes.fromhex(write(value))))
+            else:
+                tree.items.append(libwyag.GitTreeLeaf(b"100644", name.encode("utf8"),
+                                                      bytes.fromhex(value)))
+        return libwyag.object_write(tree, repo)
+    return write(top)
+
+def ident(i):
+    # One commit a day, from 2020-01-01.
+    return f"Bench <bench@example.com> {1577836800 + 86400 * i} +0000".encode("ascii")
+
+def commit_write(repo, tree, parents, i):
+    commit = libwyag.GitCommit()
+    commit.kvlm[b'tree'] = tree.encode("ascii")
+    if parents:
+        commit.kvlm[b'parent'] = parents[0].encode("ascii")
+    commit.kvlm[b'author'] = ident(i)
+    commit.kvlm[b'committer'] = ident(i)
+    commit.kvlm[None] = f"Commit {i}\n".encode("ascii")
+    return libwyag.object_write(commit, repo)
+
+def tag_write(repo, name, sha, i):
+    tag = libwyag.GitTag()
+    tag.kvlm[b'object'] = sha.encode("ascii")
+    tag.kvlm[b'type'] = b'commit'
+    tag.kvlm[b'tag'] = name.encode("ascii")
+    tag.kvlm[b'tagger'] = ident(i)
+    tag.kvlm[None] = f"Release {name}\n".encode("ascii")
+    libwyag.ref_create(repo, "tags/" + name, libwyag.object_write(tag, repo))
+
+def worktree_write(repo, files, blobs):
+    """Write files to the worktree, and an index matching them."""
+    entries = list()
+    for name in sorted(files, key=lambda name: name.encode("utf8")):
+        path = os.path.join(repo.worktree, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(files[name])
+        st = os.stat(path)
+        entries.append(libwyag.GitIndexEntry(
+            ctime=(int(st.st_ctime), st.st_ctime_ns % 10**9),
+            mtime=(int(st.st_mtime), st.st_mtime_ns % 10**9),
+            dev=st.st_dev & 0xFFFFFFFF,
+            ino=st.st_ino & 0xFFFFFFFF,
+            mode_type=0b1000,
+            mode_perms=0o644,
+            uid=st.st_uid,
+            gid=st.st_gid,
+            fsize=st.st_size,
+            binsha=bytes.fromhex(blobs[files[name]]),
+            flag_assume_valid=False,
+            flag_stage=0,
+            raw_name=name.encode("utf8")))
+    libwyag.index_write(repo, libwyag.GitIndex(entries=entries))
+
+if __name__ == "__main__":
+    main()
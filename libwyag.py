@@ -1,45 +1,246 @@
 import argparse
+import bisect
+from collections import OrderedDict
 import configparser
-from datetime import datetime
-import grp, pwd
-from fnmatch import fnmatch
-import hashlib
+import heapq
 from math import ceil
 import os
 import re
+import stat
+import struct
 import sys
+import time
 import zlib
 
+# Modules only a few commands need (hashlib, json, tempfile, datetime,
+# concurrent.futures, mmap, threading and the like) are imported by the
+# functions that use them: wyag runs from prompts and hooks, where
+# import time is most of the run time.  tests/test_wyag.py checks that
+# importing libwyag doesn't pull them in.
+
+# Tracing
+#
+# With WYAG_TRACE set to a file name, wyag writes there where its time
+# went, in the Chrome trace event format, which chrome://tracing and
+# https://ui.perfetto.dev display as a timeline.  There is an event per
+# timed region: the command, finding the repository, reading the
+# config and the index, loading the ignore rules, walking trees and
+# history.  Counters go along: objects read by type, bytes inflated
+# and the compressed bytes they came from, files stat'ed, hits and
+# misses of the parsed object cache, and calls to object_read, per sha.
+#
+# Without WYAG_TRACE, functions marked @traced aren't even wrapped,
+# trace_region() returns a shared object that does nothing, and the
+# counters cost checking that trace is None.
+
+trace = None
+
+class GitTrace(object):
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.start = time.perf_counter_ns()
+        self.events = list()
+        self.counters = dict()
+        self.reads = dict() # sha to how many times object_read was called for it
+
+    def now(self):
+        """Microseconds since the trace started."""
+        return (time.perf_counter_ns() - self.start) / 1000
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def read(self, sha):
+        self.reads[sha] = self.reads.get(sha, 0) + 1
+
+    def write(self):
+        import json
+        top = sorted(self.reads.items(), key=lambda item: -item[1])[:20]
+        with open(self.path, "w") as f:
+            json.dump({ "traceEvents": self.events,
+                        "displayTimeUnit": "ms",
+                        "otherData": { "argv": sys.argv,
+                                       "counters": self.counters,
+                                       "object_read_calls": sum(self.reads.values()),
+                                       "object_read_shas": len(self.reads),
+                                       "object_read_most": dict(top) } }, f)
+
+class GitTraceRegion(object):
+    """A timed region, as a context manager: a "complete" event, and a
+snapshot of the counters when it ends."""
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args=None):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = trace.now()
+        return self
+
+    def __exit__(self, *exc):
+        import threading
+        end = trace.now()
+        tid = threading.get_ident()
+        trace.events.append({ "name": self.name, "ph": "X", "ts": self.start, "dur": end - self.start,
+                              "pid": trace.pid, "tid": tid, "args": self.args or {} })
+        trace.events.append({ "name": "counters", "ph": "C", "ts": end,
+                              "pid": trace.pid, "tid": tid, "args": dict(trace.counters) })
+
+class GitTraceOff(object):
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        pass
 
-argparser = argparse.ArgumentParser(description="The studpidest content tracker")
-argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
-argsubparsers.required = True
+trace_off = GitTraceOff()
+
+def trace_region(name, args=None):
+    """Time the body of a with statement as region name, args being a
+dict of details to show with it."""
+    if trace is None:
+        return trace_off
+    return GitTraceRegion(name, args)
+
+def traced(name):
+    """Decorator making calls to the function a region called name.  For
+a generator, the region lasts until it's exhausted or closed."""
+    def decorate(f):
+        if "WYAG_TRACE" not in os.environ:
+            return f
+        import functools, inspect
+
+        if inspect.isgeneratorfunction(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with trace_region(name):
+                    yield from f(*args, **kwargs)
+        else:
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with trace_region(name):
+                    return f(*args, **kwargs)
+        return wrapper
+    return decorate
+
+class GitTraceMain(object):
+    """Start tracing, time the command as a region, and write the trace
+at the end, however the command ends."""
+
+    def __init__(self, argv):
+        self.argv = argv
+
+    def __enter__(self):
+        global trace
+        trace = GitTrace(os.environ["WYAG_TRACE"])
+
+        # Count stat calls by wrapping os.stat and os.lstat, which
+        # os.path.exists, isfile and the like call too.
+        def counted(f, name):
+            def wrapper(*args, **kwargs):
+                if trace:
+                    trace.count(name)
+                return f(*args, **kwargs)
+            return wrapper
+        os.stat = counted(os.stat, "files.stat")
+        os.lstat = counted(os.lstat, "files.lstat")
+
+        self.region = GitTraceRegion("wyag " + " ".join(self.argv[:1]), { "argv": self.argv })
+        self.region.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        global trace
+        self.region.__exit__(*exc)
+        trace.write()
+        trace = None
+
+def trace_main(argv):
+    if "WYAG_TRACE" not in os.environ:
+        return trace_off
+    return GitTraceMain(argv)
+
+# The commands, by name: their help, and a function adding their
+# arguments to their parser.  See argparser_build.
+argcommands = dict()
+
+def argcommand(name, help, setup=None):
+    argcommands[name] = (help, setup)
+
+def argparser_build(command=None):
+    """Return the argument parser.  Every command gets a subparser, so
+that they're all listed in --help, but only command, the one being
+run, gets its arguments added."""
+    argparser = argparse.ArgumentParser(description="The studpidest content tracker")
+    argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+    argsubparsers.required = True
+    for name, (help, setup) in argcommands.items():
+        argsp = argsubparsers.add_parser(name, help=help)
+        if setup and name == command:
+            setup(argsp)
+    return argparser
+
+# Options that, as in git, only take a value as --name=value: a bare
+# --name takes none, and leaves the next argument alone.  argparse
+# can't do both with one option, so argv_split_equals turns
+# --name=value into two arguments, "--name=" and value, for a separate
+# "--name=" option to take.
+argv_equals_options = ("--abbrev",)
+
+def argv_split_equals(argv):
+    ret = list()
+    for i, arg in enumerate(argv):
+        if arg == "--":
+            return ret + argv[i:]
+        name, equals, value = arg.partition("=")
+        if equals and name in argv_equals_options:
+            ret += [ name + "=", value ]
+        else:
+            ret.append(arg)
+    return ret
 
 def main(argv=sys.argv[1:]):
-    args = argparser.parse_args(argv)
-    match args.command:
-        case "add"          : cmd_add(args)
-        case "cat-file"     : cmd_cat_file(args)
-        case "check-ignore" : cmd_check_ignore(args)
-        case "checkout"     : cmd_checkout(args)
-        case "commit"       : cmd_commit(args)
-        case "hash-object"  : cmd_hash_object(args)
-        case "init"         : cmd_init(args)
-        case "log"          : cmd_log(args)
-        case "ls-files"     : cmd_ls_files(args)
-        case "ls-tree"      : cmd_ls_tree(args)
-        case "rev-parse"    : cmd_rev_parse(args)
-        case "rm"           : cmd_rm(args)
-        case "show-ref"     : cmd_show_ref(args)
-        case "status"       : cmd_status(args)
-        case "tag"          : cmd_tag(args)
-        case _              : print("Bad command.")
+    with trace_main(argv):
+        args = argparser_build(argv[0] if argv else None).parse_args(argv_split_equals(argv))
+        match args.command:
+            case "add"          : cmd_add(args)
+            case "cat-file"     : cmd_cat_file(args)
+            case "check-ignore" : cmd_check_ignore(args)
+            case "checkout"     : cmd_checkout(args)
+            case "commit"       : cmd_commit(args)
+            case "commit-graph" : cmd_commit_graph(args)
+            case "count-objects": cmd_count_objects(args)
+            case "daemon"       : cmd_daemon(args)
+            case "diff-tree"    : cmd_diff_tree(args)
+            case "fsck"         : cmd_fsck(args)
+            case "hash-object"  : cmd_hash_object(args)
+            case "init"         : cmd_init(args)
+            case "log"          : cmd_log(args)
+            case "ls-files"     : cmd_ls_files(args)
+            case "ls-tree"      : cmd_ls_tree(args)
+            case "pack-refs"    : cmd_pack_refs(args)
+            case "repack"       : cmd_repack(args)
+            case "rev-list"     : cmd_rev_list(args)
+            case "rev-parse"    : cmd_rev_parse(args)
+            case "rm"           : cmd_rm(args)
+            case "show-ref"     : cmd_show_ref(args)
+            case "status"       : cmd_status(args)
+            case "tag"          : cmd_tag(args)
+            case _              : print("Bad command.")
 class GitRepository(object):
     """a git repository"""
     worktree = None
     gitdir = None
     conf = None
-    def __init__(self, path, force=False):
+    packs = None
+    cache = None
+    commit_graph = None
+    refs = None
+    oids = None
+    bitmap = None
+    def __init__(self, path, force=False, cache_size=None):
         self.worktree = path
         self.gitdir = os.path.join(path, ".git")
         if not(force or os.path.isdir(self.gitdir)):
@@ -49,13 +250,33 @@ class GitRepository(object):
         self.conf = configparser.ConfigParser()
         cf = repo_file(self, "config")
         if cf and os.path.exists(cf):
-            self.conf.read([cf])
+            with trace_region("config"):
+                self.conf.read([cf])
         elif not force:
             raise Exception("Configuration file missing")
         if not force:
             vers = int(self.conf.get("core", "repositoryformatversion"))
             if vers != 0:
                 raise Exception("Unsupported repositoryformatversion %s" % vers)
+
+        # The parsed object cache is opt-in: set core.wyagCacheSize
+        # (eg "64m") to enable it.  Long-running callers pass a default
+        # cache_size, which the config only overrides; 0 turns it off.
+        size = self.conf.get("core", "wyagCacheSize", fallback=None)
+        if size:
+            cache_size = config_parse_size(size)
+        if cache_size:
+            blob_limit = self.conf.get("core", "wyagCacheBlobLimit", fallback=None)
+            self.cache = GitObjectCache(cache_size,
+                                        config_parse_size(blob_limit) if blob_limit else GitObjectCache.blob_limit)
+def config_parse_size(value):
+    """Parse a git-style size, like "512", "64k", "16m" or "1g"."""
+    value = value.strip().lower()
+    units = { "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3 }
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
 def repo_path(repo, *path):
     """compute path under the repos gitdir"""
     return os.path.join(repo.gitdir, *path)
@@ -133,16 +354,20 @@ def repo_default_config():
 
 
 
-argsp = argsubparsers.add_parser("init", help="Initialize a new, empty repository.")
-argsp.add_argument(
-    "path",
-    metavar="directory",
-    nargs="?",
-    default=".",
-    help="Where to create the repository.",
-)
+def argparse_init(argsp):
+    argsp.add_argument(
+        "path",
+        metavar="directory",
+        nargs="?",
+        default=".",
+        help="Where to create the repository.",
+    )
+
+argcommand("init", "Initialize a new, empty repository.", argparse_init)
+
 def cmd_init(args):
     repo_create(args.path)
+@traced("repo_find")
 def repo_find(path=".", required=True):
     path = os.path.realpath(path)
     if os.path.isdir(os.path.join(path, ".git")):
@@ -174,43 +399,758 @@ class GitObject(object):
         raise Exception("Unimplemented!")
     def init(self):
         pass
+class GitObjectCache(object):
+    """An LRU cache of parsed objects, keyed by sha, that evicts the
+least recently used objects once the total size of their raw data goes
+over a byte budget.
+
+Cached objects are shared between callers, who must not modify them."""
+
+    # Blobs bigger than this are never cached: they would push out
+    # dozens of trees and commits, which are what gets re-read.
+    blob_limit = 64 * 1024
+
+    def __init__(self, limit, blob_limit=None):
+        self.limit = limit
+        if blob_limit is not None:
+            self.blob_limit = blob_limit
+        self.objects = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sha):
+        entry = self.objects.get(sha)
+        if entry is None:
+            self.misses += 1
+            if trace:
+                trace.count("cache.misses")
+            return None
+        self.hits += 1
+        if trace:
+            trace.count("cache.hits")
+        self.objects.move_to_end(sha)
+        return entry[0]
+
+    def add(self, sha, obj, size):
+        if size > self.limit or (obj.fmt == b'blob' and size > self.blob_limit):
+            return
+        if sha in self.objects:
+            return
+        self.objects[sha] = (obj, size)
+        self.size += size
+        while self.size > self.limit:
+            _, (_, old_size) = self.objects.popitem(last=False)
+            self.size -= old_size
+
 def object_read(repo, sha):
     """Read object with the given SHA1 hash from the repository."""
-    path = repo_file(repo, "objects, sha[0:2], sha[2:]")
-    if not os.path.isfile(path):
+    if trace:
+        trace.read(sha)
+    cache = repo.cache
+    if cache is not None:
+        obj = cache.get(sha)
+        if obj is not None:
+            return obj
+
+    raw = object_read_raw(repo, sha)
+    if raw is None:
+        return None
+    fmt, data = raw
+    match fmt:
+        case b'commit':
+            c = GitCommit
+        case b'tree':
+            c = GitTree
+        case b'blob':
+            c = GitBlob
+        case b'tag':
+            c = GitTag
+        case _:
+            raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+    obj = c(data)
+    if cache is not None:
+        cache.add(sha, obj, len(data))
+    return obj
+
+def object_read_raw(repo, sha):
+    """Read the type and contents of object sha, from a pack or as a
+loose object.  Returns a (fmt, data) tuple, or None if there's no such
+object."""
+    # Packs first: a lookup there is a binary search in memory, while
+    # a loose object costs a stat and an open.
+    binsha = bytes.fromhex(sha)
+    for pack in repo_packs(repo):
+        offset = pack.find(binsha)
+        if offset is not None:
+            ret = pack.read(offset, repo)
+            if trace:
+                trace.count("objects." + ret[0].decode("ascii"))
+            return ret
+
+    stream = object_read_loose_stream(repo, sha, 1024 * 1024)
+    if stream is None:
+        return None
+    fmt, size, chunks = stream
+    if trace:
+        trace.count("objects." + fmt.decode("ascii"))
+    return fmt, b''.join(chunks)
+
+def object_read_stream(repo, sha, chunk_size=64 * 1024):
+    """Open object sha for reading in chunks.
+
+Returns a (fmt, size, chunks) tuple, where chunks iterates over the
+object's contents in pieces of at most chunk_size bytes, or None if
+there's no such object.  The length is checked once chunks is
+exhausted, so a truncated object raises at the end."""
+    binsha = bytes.fromhex(sha)
+    stream = None
+    for pack in repo_packs(repo):
+        offset = pack.find(binsha)
+        if offset is not None:
+            stream = pack.stream(offset, chunk_size, repo)
+            break
+    else:
+        stream = object_read_loose_stream(repo, sha, chunk_size)
+    if trace and stream:
+        trace.count("objects." + stream[0].decode("ascii"))
+    return stream
+
+def object_read_loose_stream(repo, sha, chunk_size):
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    if not path or not os.path.isfile(path):
         return None
-    with open(path, "rb") as f:
-        raw = zlib.decompress(f.read())
 
-        x = raw.find(b"")
+    f = open(path, "rb")
+    try:
+        chunks = zlib_inflate_iter(lambda: f.read(chunk_size), chunk_size)
+
+        # The header ends at the first NUL, which is in the first chunk
+        # unless chunk_size is ridiculously small.
+        raw = b''
+        while (y := raw.find(b'\x00')) < 0:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise Exception("Malformed object {0}: bad header".format(sha))
+            raw += chunk
+        x = raw.find(b' ')
         fmt = raw[0:x]
-
-        y = raw.find(b" \x00", x + 1)
         size = int(raw[x + 1:y].decode("ascii"))
-        if size != len(raw) - y - 1:
+    except BaseException:
+        f.close()
+        raise
+
+    return fmt, size, object_stream_body(raw[y + 1:], chunks, size, sha, f)
+
+def object_stream_body(first, rest, size, sha, f=None):
+    """Yield first, then the chunks from rest, checking at the end that
+there were exactly size bytes.  Closes f, if given, when done."""
+    try:
+        read = len(first)
+        if first:
+            yield first
+        for chunk in rest:
+            read += len(chunk)
+            yield chunk
+        if read != size:
             raise Exception("Malformed object {0}: bad length".format(sha))
-        match fmt:
-            case b'commit':
-                c= GitCommit()
-            case b'tree':
-                c= GitTree()
-            case b'blob':
-                c= GitBlob()
-            case b'tag':
-                c= GitTag()
-            case _:
-                raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
-        return c(raw[y + 2:])
+    finally:
+        if f:
+            f.close()
+
+def zlib_inflate_iter(read, chunk_size):
+    """Inflate a zlib stream, pulling compressed data from read() and
+yielding decompressed chunks of at most chunk_size bytes."""
+    d = zlib.decompressobj()
+    while not d.eof:
+        data = d.unconsumed_tail
+        if not data:
+            data = read()
+            if not data:
+                raise Exception("Truncated zlib stream")
+            if trace:
+                trace.count("bytes.compressed", len(data))
+        out = d.decompress(data, chunk_size)
+        if out:
+            if trace:
+                trace.count("bytes.inflated", len(out))
+            yield out
+    if trace:
+        # What was read past the end of the stream.
+        trace.count("bytes.compressed", -len(d.unused_data))
+
+def object_read_header(repo, sha):
+    """Return the (fmt, size) of object sha, or None if there's no such
+object.  This only inflates the few bytes needed to read the header,
+however big the object is."""
+    binsha = bytes.fromhex(sha)
+    for pack in repo_packs(repo):
+        offset = pack.find(binsha)
+        if offset is not None:
+            return pack.read_header(offset, repo)
+
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    if not path or not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        # "commit 18446744073709551615\x00" is 28 bytes, so 64 is plenty.
+        raw = zlib_inflate_prefix(lambda: f.read(256), 64)
+
+    x = raw.find(b' ')
+    y = raw.find(b'\x00', x)
+    if x < 0 or y < 0:
+        raise Exception("Malformed object {0}: bad header".format(sha))
+    return raw[0:x], int(raw[x + 1:y].decode("ascii"))
+
+def zlib_inflate_prefix(read, n):
+    """Inflate at most the first n bytes of a zlib stream, pulling
+compressed data from read() as needed."""
+    d = zlib.decompressobj()
+    out = b''
+    while len(out) < n and not d.eof:
+        data = d.unconsumed_tail
+        if not data:
+            data = read()
+            if not data:
+                break
+        out += d.decompress(data, n - len(out))
+    return out
+
+#Packfiles
+#
+# After a gc or a clone, most objects live in .git/objects/pack, in
+# pairs of files: a .pack holding the (zlib-compressed, possibly
+# deltified) objects back to back, and a .idx mapping each sha to its
+# offset in the .pack.
+
+PACK_OBJ_COMMIT    = 1
+PACK_OBJ_TREE      = 2
+PACK_OBJ_BLOB      = 3
+PACK_OBJ_TAG       = 4
+PACK_OBJ_OFS_DELTA = 6 # Delta against an object earlier in this pack
+PACK_OBJ_REF_DELTA = 7 # Delta against an object named by its sha
+
+pack_type_names = { PACK_OBJ_COMMIT: b'commit',
+                    PACK_OBJ_TREE:   b'tree',
+                    PACK_OBJ_BLOB:   b'blob',
+                    PACK_OBJ_TAG:    b'tag' }
+
+class GitPack(object):
+    """A packfile and its version 2 index, both memory-mapped."""
+
+    # How many bytes of resolved delta bases we keep around.  Deltas
+    # in a pack tend to share bases, so this saves re-resolving the
+    # same chain over and over.
+    base_cache_limit = 16 * 1024 * 1024
+
+    # How much compressed data we hand zlib at a time.
+    inflate_chunk = 8192
+
+    def __init__(self, idx_path, pack_path):
+        import mmap, threading
+        self.idx_path = idx_path
+        self.pack_path = pack_path
+
+        with open(idx_path, "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(pack_path, "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.pack[0:4] != b"PACK":
+            raise Exception(f"Not a packfile: {pack_path}")
+
+        # Version 1 indexes have no magic number at all, version 2
+        # start with "\377tOc" followed by the version.
+        if self.idx[0:4] != b"\377tOc" or struct.unpack_from(">I", self.idx, 4)[0] != 2:
+            raise Exception(f"Unsupported pack index format: {idx_path}")
+
+        # The fanout table, see oid_table_find.
+        self.fanout = struct.unpack_from(">256I", self.idx, 8)
+        self.count = self.fanout[255]
+
+        # After the fanout come the sorted shas, then a CRC32 per
+        # object, then a 4-byte offset per object, then a table of
+        # 8-byte offsets for packs larger than 2GB.
+        self.names_offset = 8 + 256 * 4
+        self.crc_offset = self.names_offset + 20 * self.count
+        self.offsets_offset = self.crc_offset + 4 * self.count
+        self.large_offsets_offset = self.offsets_offset + 4 * self.count
+
+        self.base_cache = OrderedDict()
+        self.base_cache_bytes = 0
+        # Checkout reads from several threads at once.
+        self.base_cache_lock = threading.Lock()
+
+    def name_at(self, i):
+        """Binary sha of the i-th object in index order."""
+        start = self.names_offset + 20 * i
+        return self.idx[start:start + 20]
+
+    def offset_at(self, i):
+        """Offset in the pack of the i-th object in index order."""
+        offset = struct.unpack_from(">I", self.idx, self.offsets_offset + 4 * i)[0]
+        if offset & 0x80000000:
+            # MSB set: the rest is an index into the large offset table.
+            offset = struct.unpack_from(">Q", self.idx,
+                                        self.large_offsets_offset + 8 * (offset & 0x7fffffff))[0]
+        return offset
+
+    def find(self, sha):
+        """Return the pack offset of the object with binary sha, or None."""
+        i = oid_table_find(self.idx, self.fanout, self.names_offset, sha)
+        return None if i is None else self.offset_at(i)
+
+    def entry_header(self, offset):
+        """Parse the header of the object at offset.
+
+Returns (type, size, base, data_offset).  size is the inflated size of
+the data (for deltas, of the delta itself).  base is the offset of the
+base object for an OFS_DELTA, its binary sha for a REF_DELTA, None
+otherwise."""
+        pack = self.pack
+        start = offset
+        c = pack[offset]
+        offset += 1
+        type = (c >> 4) & 0b111
+        size = c & 0b1111
+        shift = 4
+        while c & 0x80:
+            c = pack[offset]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+
+        base = None
+        if type == PACK_OBJ_OFS_DELTA:
+            # A big-endian varint, where each continuation also adds
+            # one, so that there's only one encoding for each value.
+            c = pack[offset]
+            offset += 1
+            distance = c & 0x7f
+            while c & 0x80:
+                c = pack[offset]
+                offset += 1
+                distance = ((distance + 1) << 7) | (c & 0x7f)
+            base = start - distance
+        elif type == PACK_OBJ_REF_DELTA:
+            base = pack[offset:offset + 20]
+            offset += 20
+
+        return type, size, base, offset
+
+    def inflate(self, offset, size):
+        """Inflate the zlib stream starting at offset, which must
+decompress to exactly size bytes."""
+        d = zlib.decompressobj()
+        chunks = list()
+        while not d.eof:
+            chunk = self.pack[offset:offset + self.inflate_chunk]
+            if not chunk:
+                raise Exception(f"Truncated packfile {self.pack_path}")
+            offset += len(chunk)
+            chunks.append(d.decompress(chunk))
+            if trace:
+                trace.count("bytes.compressed", len(chunk) - len(d.unused_data))
+        data = b''.join(chunks)
+        if len(data) != size:
+            raise Exception(f"Malformed object in {self.pack_path}: bad length")
+        if trace:
+            trace.count("bytes.inflated", size)
+        return data
+
+    def read_header(self, offset, repo=None):
+        """Return the (fmt, size) of the object at offset.
+
+For a delta, the size is read from the delta's own header, so only its
+first few bytes get inflated, and the type is that of the full object
+at the bottom of the chain."""
+        type, size, base, data_offset = self.entry_header(offset)
+        if type in pack_type_names:
+            return pack_type_names[type], size
+
+        pos = data_offset
+        def read():
+            nonlocal pos
+            chunk = self.pack[pos:pos + 512]
+            pos += len(chunk)
+            return chunk
+        # Two varints: the size of the base, then of the result.
+        head = zlib_inflate_prefix(read, 20)
+        _, size = delta_varint(head, delta_varint(head, 0)[0])
+
+        while type not in pack_type_names:
+            if type == PACK_OBJ_OFS_DELTA:
+                offset = base
+            elif type == PACK_OBJ_REF_DELTA:
+                offset = self.find(base)
+                if offset is None:
+                    header = object_read_header(repo, base.hex()) if repo else None
+                    if header is None:
+                        raise Exception(f"Missing delta base {base.hex()} in {self.pack_path}")
+                    return header[0], size
+            else:
+                raise Exception(f"Unknown object type {type} in {self.pack_path}")
+            type, _, base, _ = self.entry_header(offset)
+        return pack_type_names[type], size
+
+    def stream(self, offset, chunk_size, repo=None):
+        """Open the object at offset for reading in chunks; see
+object_read_stream.  Deltas can only be resolved in memory, but full
+objects get inflated a chunk at a time."""
+        type, size, base, data_offset = self.entry_header(offset)
+        if type not in pack_type_names:
+            fmt, data = self.read(offset, repo)
+            return fmt, len(data), iter((data,))
+
+        pos = data_offset
+        def read():
+            nonlocal pos
+            chunk = self.pack[pos:pos + self.inflate_chunk]
+            pos += len(chunk)
+            return chunk
+        chunks = zlib_inflate_iter(read, chunk_size)
+        return pack_type_names[type], size, object_stream_body(b'', chunks, size, f"at {offset} in {self.pack_path}")
+
+    def read(self, offset, repo=None):
+        """Read the object at offset, resolving deltas.  Returns a
+(fmt, data) tuple.
+
+REF_DELTA bases that aren't in this pack are read through repo."""
+
+        # Walk down the delta chain until we reach a full object (or
+        # one we have in cache), remembering the deltas on the way.
+        # This is a loop and not recursion: chains can be long.
+        chain = list()
+        while True:
+            cached = self.base_cache_get(offset)
+            if cached:
+                fmt, data = cached
+                break
+
+            type, size, base, data_offset = self.entry_header(offset)
+            if type == PACK_OBJ_OFS_DELTA:
+                chain.append((data_offset, size))
+                offset = base
+            elif type == PACK_OBJ_REF_DELTA:
+                chain.append((data_offset, size))
+                offset = self.find(base)
+                if offset is None:
+                    raw = object_read_raw(repo, base.hex()) if repo else None
+                    if raw is None:
+                        raise Exception(f"Missing delta base {base.hex()} in {self.pack_path}")
+                    fmt, data = raw
+                    break
+            elif type in pack_type_names:
+                fmt = pack_type_names[type]
+                data = self.inflate(data_offset, size)
+                if chain:
+                    self.base_cache_add(offset, fmt, data)
+                break
+            else:
+                raise Exception(f"Unknown object type {type} in {self.pack_path}")
+
+        # Then apply the deltas back up, innermost first.
+        for data_offset, size in reversed(chain):
+            data = delta_apply(data, self.inflate(data_offset, size))
+        return fmt, data
+
+    def base_cache_get(self, offset):
+        with self.base_cache_lock:
+            entry = self.base_cache.get(offset)
+            if entry:
+                self.base_cache.move_to_end(offset)
+            return entry
+
+    def base_cache_add(self, offset, fmt, data):
+        if len(data) > self.base_cache_limit:
+            return
+        with self.base_cache_lock:
+            if offset in self.base_cache:
+                return
+            self.base_cache[offset] = (fmt, data)
+            self.base_cache_bytes += len(data)
+            while self.base_cache_bytes > self.base_cache_limit:
+                _, (_, old) = self.base_cache.popitem(last=False)
+                self.base_cache_bytes -= len(old)
+
+def oid_table_find(buf, fanout, names_offset, sha):
+    """Binary search for binary sha in a sorted table of 20-byte oids
+starting at names_offset in buf, with its fanout table.  Returns its
+position in the table, or None.
+
+Entry N of the fanout is the number of oids whose first byte is <= N,
+so the oids starting with byte N are at [fanout[N-1], fanout[N])."""
+    first = sha[0]
+    lo = fanout[first - 1] if first else 0
+    hi = fanout[first]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = names_offset + 20 * mid
+        name = buf[start:start + 20]
+        if name < sha:
+            lo = mid + 1
+        elif name > sha:
+            hi = mid
+        else:
+            return mid
+    return None
+
+def delta_varint(delta, pos):
+    """Read a little-endian size varint, as used in delta headers.
+Returns (new_pos, value)."""
+    value = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return pos, value
+
+def delta_apply(base, delta):
+    """Apply a git delta to base, returning the reconstructed object."""
+    pos, src_size = delta_varint(delta, 0)
+    pos, dst_size = delta_varint(delta, pos)
+    if src_size != len(base):
+        raise Exception("Delta base has the wrong size")
+
+    base = memoryview(base)
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            # Copy from base.  The low 4 bits say which offset bytes
+            # follow, the next 3 which size bytes.
+            copy_offset = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    copy_offset |= delta[pos] << (8 * i)
+                    pos += 1
+            copy_size = 0
+            for i in range(3):
+                if cmd & (0x10 << i):
+                    copy_size |= delta[pos] << (8 * i)
+                    pos += 1
+            if copy_size == 0:
+                copy_size = 0x10000
+            out += base[copy_offset:copy_offset + copy_size]
+        elif cmd:
+            # Insert the next cmd bytes of the delta as-is.
+            out += delta[pos:pos + cmd]
+            pos += cmd
+        else:
+            raise Exception("Invalid delta opcode 0")
+
+    if len(out) != dst_size:
+        raise Exception("Delta result has the wrong size")
+    return bytes(out)
+
+def repo_packs(repo):
+    """Return the repository's packs, opening them on first use."""
+    if repo.packs is None:
+        repo.packs = list()
+        path = repo_dir(repo, "objects", "pack")
+        if path:
+            for f in sorted(os.listdir(path)):
+                if not f.endswith(".idx"):
+                    continue
+                pack = os.path.join(path, f[:-4] + ".pack")
+                if os.path.exists(pack):
+                    repo.packs.append(GitPack(os.path.join(path, f), pack))
+    return repo.packs
+
+class GitOidTable(object):
+    """The sorted table of count 20-byte oids at offset in buf, as a
+read-only sequence of bytes, so bisect works on it in place."""
+
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        start = self.offset + 20 * i
+        return self.buf[start:start + 20]
+
+class GitOidIndex(object):
+    """Every object id in the repository as sorted binary oids: each
+pack's .idx table as it is on disk, plus one sorted list per loose
+object directory, listed the first time it's needed.  Lookups bisect
+each of those, so finding a short hash or the shortest unique
+abbreviation of one never scans anything."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.tables = [ GitOidTable(p.idx, p.names_offset, p.count)
+                        for p in repo_packs(repo) ]
+        # Loose oids per objects/ subdirectory, keyed by its name.
+        self.loose = dict()
+
+        # The shortest abbreviation we hand out, as in git.
+        abbrev = repo.conf.get("core", "abbrev", fallback="auto")
+        self.min_len = int(abbrev) if abbrev.isdigit() else 7
+
+    def loose_names(self, dirname):
+        if dirname not in self.loose:
+            path = repo_path(self.repo, "objects", dirname)
+            names = list()
+            if os.path.isdir(path):
+                for f in os.listdir(path):
+                    # Skip anything that isn't an object, like
+                    # temporary files.
+                    if len(f) == 38:
+                        try:
+                            names.append(bytes.fromhex(dirname + f))
+                        except ValueError:
+                            pass
+            names.sort()
+            self.loose[dirname] = names
+        return self.loose[dirname]
+
+    def sources(self, prefix):
+        """The sorted sequences that may hold oids starting with the hex
+prefix, which must be at least 2 characters."""
+        return [ self.loose_names(prefix[0:2]) ] + self.tables
+
+    def add(self, sha):
+        """Record the new loose object sha."""
+        names = self.loose.get(sha[0:2])
+        binsha = bytes.fromhex(sha)
+        if names is not None:
+            i = bisect.bisect_left(names, binsha)
+            if i == len(names) or names[i] != binsha:
+                names.insert(i, binsha)
+
+    def find_prefix(self, prefix):
+        """Return the sorted shas that start with the hex prefix, which
+must be at least 2 characters."""
+        prefix = prefix.lower()
+        # The smallest oid with this prefix.  An odd number of hex
+        # digits gets padded with a 0 to make whole bytes.
+        start = bytes.fromhex(prefix + "0" * (len(prefix) % 2))
+        ret = set()
+        for names in self.sources(prefix):
+            i = bisect.bisect_left(names, start)
+            while i < len(names):
+                sha = names[i].hex()
+                if not sha.startswith(prefix):
+                    break
+                ret.add(sha)
+                i += 1
+        return sorted(ret)
+
+    def find_unique_abbrev(self, sha, min_len=None):
+        """Return the shortest prefix of sha, but no shorter than
+min_len, that no other object in the repository starts with.
+
+Only the neighbours of sha in each sorted source can share a longer
+prefix with it than anything else, so those are all we look at."""
+        if min_len is None:
+            min_len = self.min_len
+        binsha = bytes.fromhex(sha)
+        common = 0
+        for names in self.sources(sha):
+            i = bisect.bisect_left(names, binsha)
+            after = i + 1 if i < len(names) and names[i] == binsha else i
+            for j in (i - 1, after):
+                if 0 <= j < len(names):
+                    other = names[j].hex()
+                    n = 0
+                    while n < 40 and sha[n] == other[n]:
+                        n += 1
+                    common = max(common, n)
+        return sha[0:max(min_len, common + 1)]
+
+def repo_oids(repo):
+    """Return the repository's oid index, creating it on first use."""
+    if repo.oids is None:
+        repo.oids = GitOidIndex(repo)
+    return repo.oids
+
 def object_write(obj, repo):
+    import hashlib
     data = obj.serialize()
     result = obj.fmt + b" " + str(len(data)).encode() + b"\x00" + data
     sha = hashlib.sha1(result).hexdigest()
 
-    if repo:
+    if repo and not object_exists(repo, sha):
         path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
         with open(path, "wb") as f:
             f.write(zlib.compress(result))
+        if repo.oids:
+            repo.oids.add(sha)
     return sha
+
+def object_write_stream(fd, fmt, repo=None, chunk_size=64 * 1024):
+    """Hash an object whose contents are the whole of file fd, writing
+it to the repo if provided.
+
+The file is read in chunks of chunk_size, each fed to both the hash
+and the compressor, so memory use doesn't depend on the file size.
+The compressed object goes to a temporary file in .git/objects, which
+is only renamed into place if the object doesn't already exist."""
+    import hashlib, tempfile
+
+    # The size goes in the header, before any of the data, so we need
+    # it up front.
+    size = os.fstat(fd.fileno()).st_size
+    header = fmt + b" " + str(size).encode() + b"\x00"
+    sha1 = hashlib.sha1(header)
+
+    tmp = None
+    if repo:
+        z = zlib.compressobj()
+        tmp_fd, tmp_path = tempfile.mkstemp(prefix="tmp_obj_",
+                                            dir=repo_dir(repo, "objects", mkdir=True))
+        tmp = os.fdopen(tmp_fd, "wb")
+
+    try:
+        if tmp:
+            tmp.write(z.compress(header))
+        read = 0
+        while chunk := fd.read(chunk_size):
+            read += len(chunk)
+            sha1.update(chunk)
+            if tmp:
+                tmp.write(z.compress(chunk))
+        if read != size:
+            raise Exception(f"File changed size while being hashed ({size} to {read} bytes)")
+
+        sha = sha1.hexdigest()
+        if tmp:
+            tmp.write(z.flush())
+            tmp.close()
+            if object_exists(repo, sha):
+                os.unlink(tmp_path)
+            else:
+                # Objects are immutable, as in git.
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True))
+                if repo.oids:
+                    repo.oids.add(sha)
+        return sha
+    except BaseException:
+        if tmp:
+            tmp.close()
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        raise
+
+def object_exists(repo, sha):
+    """Whether object sha is in the repository, packed or loose."""
+    binsha = bytes.fromhex(sha)
+    for pack in repo_packs(repo):
+        if pack.find(binsha) is not None:
+            return True
+    return os.path.isfile(repo_path(repo, "objects", sha[0:2], sha[2:]))
 class GitBlob(GitObject):
     fmt = b'blob'
     def serialize(self):
@@ -218,54 +1158,142 @@ class GitBlob(GitObject):
     def deserialize(self, data):
         self.blobdata = data
 
-argsp = argsubparsers.add_parser("cat-file", help="Provide content or type and size information for repository objects")
-argsp.add_argument("type", metavar="type", help="Specify the type")
-argsp.add_argument("object", metavar="object", help="The object to display")
+def argparse_cat_file(argsp):
+    argsp_mode = argsp.add_mutually_exclusive_group()
+    argsp_mode.add_argument("-t", dest="mode", action="store_const", const="type",
+                            help="Show the object's type")
+    argsp_mode.add_argument("-s", dest="mode", action="store_const", const="size",
+                            help="Show the object's size")
+    argsp_mode.add_argument("-e", dest="mode", action="store_const", const="exists",
+                            help="Exit with zero status if the object exists, non-zero otherwise")
+    argsp_mode.add_argument("--batch", dest="mode", action="store_const", const="batch",
+                            help="Print the type, size and contents of each object named on stdin")
+    argsp_mode.add_argument("--batch-check", dest="mode", action="store_const", const="batch-check",
+                            help="Print the type and size of each object named on stdin")
+    argsp.add_argument("type", metavar="type", nargs="?", help="Specify the type")
+    argsp.add_argument("object", metavar="object", nargs="?", help="The object to display")
+
+argcommand("cat-file", "Provide content or type and size information for repository objects", argparse_cat_file)
 
 def cmd_cat_file(args):
     repo = repo_find()
+    if args.mode in ("batch", "batch-check"):
+        if args.type or args.object:
+            raise Exception(f"cat-file: --{args.mode} takes its objects from stdin")
+        cat_file_batch(repo, sys.stdin.buffer, sys.stdout.buffer,
+                       contents=(args.mode == "batch"))
+        return
+    if args.mode:
+        # With -t, -s or -e there's no type, so argparse hands the
+        # object over as the first positional.
+        if args.type and args.object:
+            raise Exception("cat-file: -t, -s and -e don't take a type")
+        if not (args.object or args.type):
+            raise Exception("cat-file: an object is required")
+        sys.exit(cat_file_info(repo, args.object or args.type, args.mode))
+    if not args.object:
+        raise Exception("cat-file: an object is required")
+    if not args.type:
+        raise Exception("cat-file: a type is required")
     cat_file(repo, args.object, args.type.encode())
 def cat_file(repo, objname, fmt):
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
-    sys.stdout.buffer.write(obj.serialize())
+    # Copy the object out as it gets inflated, rather than holding all
+    # of it in memory.
+    _, _, chunks = object_read_stream(repo, object_find(repo, objname, fmt=fmt))
+    out = sys.stdout.buffer
+    for chunk in chunks:
+        out.write(chunk)
+def cat_file_info(repo, objname, mode):
+    """Print an object's type or size, or for "exists" just check for
+it.  Returns the exit status."""
+    if mode == "exists":
+        # Don't raise on names that don't resolve: they simply don't
+        # exist.
+        candidates = object_resolve(repo, objname)
+        if not candidates or len(candidates) > 1:
+            return 1
+        return 0 if object_read_header(repo, candidates[0]) else 1
+
+    header = object_read_header(repo, object_find(repo, objname))
+    if header is None:
+        raise Exception(f"No such object {objname}.")
+    fmt, size = header
+    match mode:
+        case "type": print(fmt.decode("ascii"))
+        case "size": print(size)
+    return 0
+
+def cat_file_batch(repo, f, out, contents=True):
+    """For each object name read from binary file f, one per line, write
+"<sha> <type> <size>" to out, followed by the contents and a newline
+if contents.  Names that don't resolve get "<name> missing" (or
+"ambiguous") instead.  Every record is flushed as soon as it's
+written, so a caller can send a name and wait for its answer."""
+    for line in f:
+        name = line.rstrip(b"\n").decode("utf8")
+        try:
+            sha = object_find(repo, name)
+        except Exception:
+            sha = None
+        if not sha:
+            status = "ambiguous" if len(object_resolve(repo, name) or []) > 1 else "missing"
+            out.write(f"{name} {status}\n".encode("utf8"))
+            out.flush()
+            continue
+
+        if contents:
+            stream = object_read_stream(repo, sha)
+        else:
+            stream = object_read_header(repo, sha)
+        if stream is None:
+            out.write(f"{name} missing\n".encode("utf8"))
+            out.flush()
+            continue
+
+        out.write(f"{sha} {stream[0].decode('ascii')} {stream[1]}\n".encode("ascii"))
+        if contents:
+            for chunk in stream[2]:
+                out.write(chunk)
+            out.write(b"\n")
+        out.flush()
 def object_find(repo, name, fmt=None, follow=True):
     return name
 
 
-argsp = argsubparsers.add_parser(
-    "hash-object", help="Compute object ID and optionally creates a blob from a file"
-)
-argsp.add_argument(
-    "-w",
-    "--write",
-    action="store_true",
-    help="Actually write the object into the database",
-)
-argsp.add_argument("path", help="The file to hash")
-argsp.add_argument(
-    "-t",
-    "--type",
-    metavar="type",
-    choices=["blob", "commit", "tag", "tree"],
-    default="blob",
-    help="Specify the type (default: blob)",
-)
+def argparse_hash_object(argsp):
+    argsp.add_argument(
+        "-w",
+        "--write",
+        action="store_true",
+        help="Actually write the object into the database",
+    )
+    argsp.add_argument("path", help="The file to hash")
+    argsp.add_argument(
+        "-t",
+        "--type",
+        metavar="type",
+        choices=["blob", "commit", "tag", "tree"],
+        default="blob",
+        help="Specify the type (default: blob)",
+    )
+
+argcommand("hash-object", "Compute object ID and optionally creates a blob from a file", argparse_hash_object)
+
 def cmd_hash_object(args):
     if args.write:
         repo = repo_find()
     else:
         repo = None
     with open(args.path, "rb") as f:
-        data = f.read()
-        match fmt:
-            case b"commit": obj = GitCommit(data)
-            case b"tree"  : obj = GitTree(data)
-            case b"tag"   : obj = GitTag(data)
-            case b"blob"  : obj = GitBlob(data)
-            case _: raise Exception(f"Unknown type {fmt}!")
-        return object_write(obj, repo)
+        print(object_hash(f, args.type.encode(), repo))
 def object_hash(fd, fmt, repo=None):
     """Hash Object, writing it to the repo if provided"""
+    # Blobs don't need parsing, so they can be streamed: that's what
+    # keeps hashing a huge file from needing several times its size
+    # in memory.
+    if fmt == b"blob":
+        return object_write_stream(fd, fmt, repo)
+
     data = fd.read()
     match fmt:
         case b"commit": obj = GitCommit(data)
@@ -279,107 +1307,583 @@ def object_hash(fd, fmt, repo=None):
 #Section 5.1 Parsing commits
 
 def kvlm_parse(raw, start=0, dct=None):
+    if not dct:
+        dct = dict()
 
-    spc = raw.find(b' ', start)
-    nl = raw.find(b'\n', start)
-
-    if (spc < 0) or (nl < spc):
-        assert nl == start
-        dct[None] = raw[start + 1:]
-        return dct
-    key = raw[start:spc]
-    end = start
+    # One header per iteration.  This used to be a recursive call per
+    # header, which a commit with a few thousand parents would overflow.
     while True:
-        end = raw.find(b'\n', end + 1)
-        if raw[end + 1] != ord(' '):
-            break
-    value = raw[spc + 1:end].replace(b'\n ', b'\n')
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
+        spc = raw.find(b' ', start)
+        nl = raw.find(b'\n', start)
+
+        if (spc < 0) or (nl < spc):
+            assert nl == start
+            dct[None] = raw[start + 1:]
+            return dct
+        key = raw[start:spc]
+        end = start
+        while True:
+            end = raw.find(b'\n', end + 1)
+            if raw[end + 1] != ord(' '):
+                break
+        value = raw[spc + 1:end].replace(b'\n ', b'\n')
+        if key in dct:
+            if type(dct[key]) == list:
+                dct[key].append(value)
+            else:
+                dct[key] = [dct[key], value]
         else:
-            dct[key] = [dct[key], value]
-    else:
-        dct[key] = value
-    return kvlm_parse(raw, start=end+1, dct=dct)
+            dct[key] = value
+        start = end + 1
+
+def kvlm_values(raw, key):
+    """Return the values of the single-line header key in raw commit or
+tag data, as a list, without parsing anything else.  Stops at the
+blank line after the headers, so the message is never scanned."""
+    ret = list()
+    prefix = key + b' '
+    start = 0
+    while True:
+        nl = raw.find(b'\n', start)
+        if nl <= start: # The blank line, or no more lines.
+            return ret
+        # Continuation lines start with a space, so they never match.
+        if raw.startswith(prefix, start):
+            ret.append(raw[start + len(prefix):nl])
+        start = nl + 1
 
 def kvlm_serialize(kvlm):
-    ret = b''
+    ret = list()
 
     for k in kvlm.keys():
         if k == None: continue
         val = kvlm[k]
         if type(val) != list:
             val = [ val ]
-            for v in val:
-                ret += k + b' ' + v.replace(b'\n', b'\n ') + b'\n'
-    ret += b'\n' + kvlm[None]
-    return ret
+        for v in val:
+            ret.append(k + b' ' + v.replace(b'\n', b'\n ') + b'\n')
+    ret.append(b'\n' + kvlm[None])
+    return b''.join(ret)
 
 #Section 5.2 Git Commit Object
 
 class GitCommit(GitObject):
+    """A commit.  The data is kept as read, and kvlm, the headers and
+message as a dict, is only parsed when first used.  Walking history
+needs only a few headers: tree, parents, committer_time and header()
+read those straight from the data, and message skips the headers."""
     fmt = b'commit'
 
     def deserialize(self, data):
-        self.kvlm = kvlm_parse(data)
+        self.raw = data
+        self._kvlm = None
 
     def serialize(self):
-        return kvlm_serialize(self.kvlm)
+        if self._kvlm is None:
+            return self.raw
+        return kvlm_serialize(self._kvlm)
+
     def init(self):
-        self.kvlm = dict()\
+        self.raw = b''
+        self._kvlm = dict()
+
+    @property
+    def kvlm(self):
+        if self._kvlm is None:
+            self._kvlm = kvlm_parse(self.raw)
+        return self._kvlm
+
+    @kvlm.setter
+    def kvlm(self, value):
+        self._kvlm = value
+
+    def header(self, key):
+        """The values of the single-line header key, as a list."""
+        if self._kvlm is None:
+            return kvlm_values(self.raw, key)
+        value = self._kvlm.get(key, [])
+        return value if type(value) == list else [ value ]
+
+    @property
+    def tree(self):
+        return self.header(b'tree')[0].decode("ascii")
+
+    @property
+    def parents(self):
+        return [ p.decode("ascii") for p in self.header(b'parent') ]
+
+    @property
+    def committer_time(self):
+        return int(self.header(b'committer')[0].split()[-2])
+
+    @property
+    def message(self):
+        if self._kvlm is None:
+            # The message starts after the first blank line.
+            if self.raw.startswith(b'\n'):
+                return self.raw[1:]
+            end = self.raw.find(b'\n\n')
+            return self.raw[end + 2:] if end >= 0 else b''
+        return self._kvlm[None]
 
 #Section 5.3 Commit log command
 
-argsp = argsubparsers.add_parser("log", help="Display commit logs")
-argsp.add_argument("commit", metavar="commit", nargs="?", default="HEAD", help="The commit to start from")
+def argparse_log(argsp):
+    argsp.add_argument("commit", metavar="commit", nargs="*",
+                       help="Commits to start from (default HEAD).  ^A or A..B exclude what's reachable from A.")
+    argsp.add_argument("-n", "--max-count", type=int, default=None, help="Show at most this many commits")
+    argsp.add_argument("--since", default=None,
+                       help="Only show commits newer than this date (unix timestamp or ISO 8601)")
+    argsp.add_argument("--first-parent", action="store_true", help="Only follow the first parent of merges")
+    argsp.add_argument("--topo-order", action="store_true", help="Never show a parent before all its children")
+    argsp.add_argument("--oneline", action="store_true", help="Print one line per commit instead of a graphviz graph")
+
+argcommand("log", "Display commit logs", argparse_log)
 
 def cmd_log(args):
     repo = repo_find()
-
-    print("digraph wyaglog{")
-    print("  node[shape=rect]")
-    log_graphviz(repo, object_find(repo, args.commit), set())
-    print("}")
-
-def log_graphviz(repo, sha, seen):
-
-    if sha in seen:
+    starts, exclude = log_parse_revs(repo, args.commit)
+
+    walk = rev_walk(repo, starts, exclude,
+                    max_count=args.max_count,
+                    since=log_parse_date(args.since) if args.since else None,
+                    first_parent=args.first_parent,
+                    topo_order=args.topo_order)
+
+    # Write everything through one buffered writer rather than a print
+    # per line.
+    out = sys.stdout.buffer
+    if args.oneline:
+        log_oneline(repo, walk, out)
+    else:
+        log_graphviz(repo, walk, out, args.first_parent)
+    out.flush()
+
+def log_parse_revs(repo, revs):
+    """Turn revs, like "A", "A..B" or "^A", into the commits to start
+from and the commits to exclude.  No revs means HEAD."""
+    starts = list()
+    exclude = list()
+    for rev in revs or [ "HEAD" ]:
+        if ".." in rev:
+            a, _, b = rev.partition("..")
+            exclude.append(object_find(repo, a or "HEAD", fmt=b'commit'))
+            starts.append(object_find(repo, b or "HEAD", fmt=b'commit'))
+        elif rev.startswith("^"):
+            exclude.append(object_find(repo, rev[1:], fmt=b'commit'))
+        else:
+            starts.append(object_find(repo, rev, fmt=b'commit'))
+    if not starts:
+        starts.append(object_find(repo, "HEAD", fmt=b'commit'))
+    return starts, exclude
+
+def log_parse_date(value):
+    """Parse a unix timestamp or an ISO 8601 date."""
+    from datetime import datetime
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp())
+
+def commit_subject(commit):
+    """The first line of a commit's message."""
+    message = commit.message.decode("utf8").strip()
+    if "\n" in message:
+        message = message[:message.index("\n")]
+    return message
+
+def log_oneline(repo, walk, out):
+    oids = repo_oids(repo)
+    for sha in walk:
+        abbrev = oids.find_unique_abbrev(sha)
+        out.write(f"{abbrev} {commit_subject(object_read(repo, sha))}\n".encode("utf8"))
+
+def log_graphviz(repo, walk, out, first_parent=False):
+    out.write(b"digraph wyaglog{\n")
+    out.write(b"  node[shape=rect]\n")
+    for sha in walk:
+        message = commit_subject(object_read(repo, sha))
+        message = message.replace("\\", "\\\\")
+        message = message.replace("\"", "\\\"")
+        lines = [ f"  c_{sha} [label=\"{sha[0:7]}: {message}\"]\n" ]
+
+        # Parents come from the commit-graph when there's one.
+        parents = commit_info(repo, sha)[1]
+        for p in parents[:1] if first_parent else parents:
+            lines.append(f"  c_{sha} -> c_{p};\n")
+        out.write("".join(lines).encode("utf8"))
+    out.write(b"}\n")
+
+@traced("rev_walk")
+def rev_walk(repo, starts, exclude=(), max_count=None, since=None,
+             first_parent=False, topo_order=False):
+    """Yield the shas of the commits reachable from starts, but not from
+exclude, newest first by committer date.
+
+This is a loop over a priority queue, not recursion, so history can be
+as long as it wants.  Without exclude, it only reads as much history
+as the caller consumes: the commits yielded, plus their parents to
+know where they go in the queue.  Dates and parents come from the
+commit-graph when there's one.
+
+since drops commits older than that timestamp.  first_parent only
+follows the first parent of merges.  topo_order gives git's
+--topo-order: no parent before all its children, and each line of
+history kept together.  That needs the whole walk done before the
+first commit comes out."""
+    if topo_order:
+        yield from rev_walk_topo(repo, starts, exclude, max_count, since, first_parent)
         return
-    seen.add(sha)
 
-    commit = object_read(repo, sha)
-    message = commit.kvlm[None].decode("utf8").strip()
-    message = message.replace("\\", "\\\\")
-    message = message.replace("\"", "\\\"")
-
-    if "\n" in message: # Keep only the first line
-        message = message[:message.index("\n")]
+    heap = list()
+    infos = dict()
+    queued = set()
+    uninteresting = set()
+    queued_interesting = 0
+    counter = 0
+
+    def parents(sha):
+        return infos[sha][1][:1] if first_parent else infos[sha][1]
+
+    def mark(sha):
+        # Mark sha uninteresting, and if we've already walked past it,
+        # its parents too, and so on.
+        nonlocal queued_interesting
+        stack = [ sha ]
+        while stack:
+            sha = stack.pop()
+            if sha in uninteresting:
+                continue
+            uninteresting.add(sha)
+            if sha in queued:
+                queued_interesting -= 1
+            elif sha in infos:
+                stack.extend(parents(sha))
+
+    def push(sha, uninteresting_parent):
+        nonlocal queued_interesting, counter
+        if uninteresting_parent:
+            mark(sha)
+        if sha in infos:
+            return
+        infos[sha] = commit_info(repo, sha)
+        queued.add(sha)
+        if sha not in uninteresting:
+            queued_interesting += 1
+        # The counter breaks ties, keeping the order stable.
+        heapq.heappush(heap, (-infos[sha][2], counter, sha))
+        counter += 1
+
+    def pop():
+        nonlocal queued_interesting
+        _, _, sha = heapq.heappop(heap)
+        queued.remove(sha)
+        mark_parents = sha in uninteresting
+        if not mark_parents:
+            queued_interesting -= 1
+        for p in parents(sha):
+            push(p, mark_parents)
+        return sha
 
-    print(f"  c_{sha} [label=\"{sha[0:7]}: {message}\"]")
-    assert commit.fmt==b'commit'
+    for sha in exclude:
+        push(sha, True)
+    for sha in starts:
+        push(sha, False)
+
+    if exclude:
+        # A commit can only be known to be excluded once an excluded
+        # path reaches it, which may be after the date order got to it
+        # through an included path.  So, like git, walk until only
+        # excluded commits are left, plus a few more in case of clock
+        # skew, and only then sort out what to show.
+        walked = list()
+        slop = 5
+        while heap:
+            if queued_interesting:
+                slop = 5
+            else:
+                slop -= 1
+                if not slop:
+                    break
+            walked.append(pop())
+        commits = (sha for sha in walked if sha not in uninteresting)
+    else:
+        # Nothing to exclude: commits can come out as they are walked.
+        def walk():
+            while heap:
+                yield pop()
+        commits = walk()
+
+    count = 0
+    for sha in commits:
+        if since is not None and infos[sha][2] < since:
+            # Everything left is older still.
+            return
+        yield sha
+        count += 1
+        if max_count is not None and count >= max_count:
+            return
+
+def rev_walk_topo(repo, starts, exclude, max_count, since, first_parent):
+    # Git's topological sort: collect everything first, in date order,
+    # and count each commit's children.  Then emit from a stack: a
+    # commit goes on it once all its children are out.  The stack, as
+    # opposed to picking the newest ready commit, keeps each line of
+    # history together instead of interleaving branches by date.
+    commits = list(rev_walk(repo, starts, exclude, since=since, first_parent=first_parent))
+    parents = dict()
+    for sha in commits:
+        p = commit_info(repo, sha)[1]
+        parents[sha] = p[:1] if first_parent else p
+
+    children = { sha: 0 for sha in commits }
+    for sha in commits:
+        for p in parents[sha]:
+            if p in children:
+                children[p] += 1
+
+    # The tips, the newest on top.
+    stack = [ sha for sha in commits if not children[sha] ]
+    stack.reverse()
+    count = 0
+    while stack:
+        sha = stack.pop()
+        yield sha
+        count += 1
+        if max_count is not None and count >= max_count:
+            return
+        for p in parents[sha]:
+            if p in children:
+                children[p] -= 1
+                if not children[p]:
+                    stack.append(p)
+
+#5.4 The commit-graph
+#
+# Walking history means reading and parsing every commit just to find
+# its parents.  The commit-graph file, in .git/objects/info, holds for
+# every commit its tree, parents, date and generation number (its
+# distance to the root commits), in fixed-size records that can be
+# looked up without inflating anything.  The format is git's own:
+#
+#  - a header: "CGPH", version 1, hash version 1 (sha1), the number of
+#    chunks, and 0 (no base graphs);
+#  - a table of contents: for each chunk a 4-byte id and an 8-byte
+#    offset, then an all-zero id and the offset of the end;
+#  - the chunks: OIDF, a fanout table; OIDL, the sorted commit shas;
+#    CDAT, for each commit, its tree sha, the positions of its first two
+#    parents, and its generation (30 bits) and commit time (34 bits);
+#    and, for octopus merges only, EDGE, the rest of their parents;
+#  - the sha1 of all of the above.
+
+COMMIT_GRAPH_NO_PARENT = 0x70000000
+COMMIT_GRAPH_EXTRA_EDGES = 0x80000000
+COMMIT_GRAPH_GENERATION_MAX = 0x3FFFFFFF
+
+class GitCommitGraph(object):
+    """A memory-mapped commit-graph file."""
+
+    def __init__(self, path):
+        import mmap
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, hash_version, chunk_count, _ = struct.unpack_from(">4sBBBB", self.data, 0)
+        if signature != b"CGPH" or version != 1 or hash_version != 1:
+            raise Exception(f"Unsupported commit-graph {path}")
+
+        chunks = dict()
+        for i in range(chunk_count):
+            chunk_id, offset = struct.unpack_from(">4sQ", self.data, 8 + 12 * i)
+            chunks[chunk_id] = offset
+
+        self.fanout = struct.unpack_from(">256I", self.data, chunks[b"OIDF"])
+        self.count = self.fanout[255]
+        self.oids_offset = chunks[b"OIDL"]
+        self.cdat_offset = chunks[b"CDAT"]
+        self.edges_offset = chunks.get(b"EDGE")
+
+    def find(self, sha):
+        """Return the position of the commit with binary sha, or None."""
+        return oid_table_find(self.data, self.fanout, self.oids_offset, sha)
+
+    def sha_at(self, pos):
+        start = self.oids_offset + 20 * pos
+        return self.data[start:start + 20].hex()
+
+    def commit_at(self, pos):
+        """Return the (tree, parents, time, generation) of the commit at
+pos, shas in hex."""
+        start = self.cdat_offset + 36 * pos
+        tree = self.data[start:start + 20].hex()
+        parent1, parent2, high, low = struct.unpack_from(">IIII", self.data, start + 20)
+
+        parents = list()
+        if parent1 != COMMIT_GRAPH_NO_PARENT:
+            parents.append(self.sha_at(parent1))
+        if parent2 & COMMIT_GRAPH_EXTRA_EDGES:
+            i = parent2 & ~COMMIT_GRAPH_EXTRA_EDGES
+            while True:
+                edge = struct.unpack_from(">I", self.data, self.edges_offset + 4 * i)[0]
+                parents.append(self.sha_at(edge & ~COMMIT_GRAPH_EXTRA_EDGES))
+                if edge & COMMIT_GRAPH_EXTRA_EDGES:
+                    break
+                i += 1
+        elif parent2 != COMMIT_GRAPH_NO_PARENT:
+            parents.append(self.sha_at(parent2))
+
+        return tree, parents, ((high & 0b11) << 32) | low, high >> 2
+
+def repo_commit_graph(repo):
+    """Return the repository's commit-graph, or None if it has none."""
+    if repo.commit_graph is None:
+        path = repo_path(repo, "objects", "info", "commit-graph")
+        repo.commit_graph = GitCommitGraph(path) if os.path.exists(path) else False
+    return repo.commit_graph or None
+
+def commit_info(repo, sha):
+    """Return the (tree, parents, time, generation) of commit sha, shas
+in hex.  This comes from the commit-graph if the commit is in it, which
+costs no inflating or parsing.  Otherwise the commit is read, and its
+generation is None."""
+    graph = repo_commit_graph(repo)
+    if graph:
+        pos = graph.find(bytes.fromhex(sha))
+        if pos is not None:
+            return graph.commit_at(pos)
 
-    if not b'parent' in commit.kvlm.keys():
-        # Base case: the initial commit.
-        return
+    commit = object_read(repo, sha)
+    if commit is None or commit.fmt != b'commit':
+        raise Exception(f"Not a commit: {sha}")
+    return commit.tree, commit.parents, commit.committer_time, None
 
-    parents = commit.kvlm[b'parent']
+def argparse_commit_graph(argsp):
+    argsp.add_argument("action", choices=["write"], nargs="?", default="write",
+                       help="What to do (only write for now)")
 
-    if type(parents) != list:
-        parents = [ parents ]
+argcommand("commit-graph", "Write a commit-graph file.", argparse_commit_graph)
 
-    for p in parents:
-        p = p.decode("ascii")
-        print (f"  c_{sha} -> c_{p};")
-        log_graphviz(repo, p, seen)
+def cmd_commit_graph(args):
+    repo = repo_find()
+    count = commit_graph_write(repo)
+    print(f"Wrote {count} commits to the commit-graph.")
+
+@traced("commit_graph_write")
+def commit_graph_write(repo):
+    """Write a commit-graph of every commit reachable from the refs and
+HEAD.  Returns the number of commits."""
+    import hashlib, tempfile
+    # Start from every ref, peeling tags, and walk down the parents.
+    starts = [ ref_resolve(repo, "HEAD") ] + [ ref_resolve(repo, name)
+                                             for name in repo_refs(repo).names ]
+    stack = [ object_peel(repo, sha, b'commit') for sha in starts if sha ]
+    commits = dict()
+    while stack:
+        sha = stack.pop()
+        if not sha or sha in commits:
+            continue
+        commits[sha] = commit_info(repo, sha)
+        stack.extend(commits[sha][1])
+
+    # Generation numbers, parents first.  This is a loop and not
+    # recursion, since histories can be long.
+    generations = dict()
+    for sha in commits:
+        stack = [ sha ]
+        while stack:
+            top = stack[-1]
+            if top in generations:
+                stack.pop()
+                continue
+            pending = [ p for p in commits[top][1] if p not in generations ]
+            if pending:
+                stack.extend(pending)
+            else:
+                generations[top] = min(COMMIT_GRAPH_GENERATION_MAX,
+                                       1 + max((generations[p] for p in commits[top][1]), default=0))
+                stack.pop()
+
+    oids = sorted(commits)
+    positions = { sha: i for i, sha in enumerate(oids) }
+
+    fanout = [0] * 256
+    for sha in oids:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    cdat = list()
+    edges = list()
+    for sha in oids:
+        tree, parents, time, _ = commits[sha]
+        p = [ positions[x] for x in parents ]
+        parent1 = p[0] if p else COMMIT_GRAPH_NO_PARENT
+        if len(p) > 2:
+            parent2 = COMMIT_GRAPH_EXTRA_EDGES | len(edges)
+            edges.extend(p[1:])
+            edges[-1] |= COMMIT_GRAPH_EXTRA_EDGES
+        else:
+            parent2 = p[1] if len(p) == 2 else COMMIT_GRAPH_NO_PARENT
+        cdat.append(bytes.fromhex(tree))
+        cdat.append(struct.pack(">IIII", parent1, parent2,
+                                (generations[sha] << 2) | ((time >> 32) & 0b11),
+                                time & 0xFFFFFFFF))
+
+    chunks = [ (b"OIDF", struct.pack(">256I", *fanout)),
+               (b"OIDL", b''.join(bytes.fromhex(sha) for sha in oids)),
+               (b"CDAT", b''.join(cdat)) ]
+    if edges:
+        chunks.append((b"EDGE", struct.pack(f">{len(edges)}I", *edges)))
+
+    out = [ struct.pack(">4sBBBB", b"CGPH", 1, 1, len(chunks), 0) ]
+    offset = 8 + 12 * (len(chunks) + 1)
+    for chunk_id, data in chunks:
+        out.append(struct.pack(">4sQ", chunk_id, offset))
+        offset += len(data)
+    out.append(struct.pack(">4sQ", b"\x00\x00\x00\x00", offset))
+    out.extend(data for _, data in chunks)
+    data = b''.join(out)
+
+    info = repo_dir(repo, "objects", "info", mkdir=True)
+    fd, tmp_path = tempfile.mkstemp(prefix="tmp_graph_", dir=info)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+        f.write(hashlib.sha1(data).digest())
+    os.chmod(tmp_path, 0o444)
+    os.replace(tmp_path, os.path.join(info, "commit-graph"))
+    repo.commit_graph = None
+    return len(oids)
 
 #6.2 Git Tree Leaf Object
 
 class GitTreeLeaf(object):
-    def __init__(self, mode, path, sha):
+    # Trees are the innermost loop of checkout, ls-tree -r, diff-tree
+    # and status: slots save a dict per leaf.
+    __slots__ = ("mode", "raw_path", "binsha")
+
+    def __init__(self, mode, raw_path, binsha):
         self.mode = mode
-        self.path = path
-        self.sha = sha
+        self.raw_path = raw_path
+        self.binsha = binsha
+
+    # As in the tree, the path is kept as utf8 bytes and the sha as
+    # its 20 raw bytes, and only converted when asked for.
+
+    @property
+    def path(self):
+        return self.raw_path.decode("utf8")
+
+    @path.setter
+    def path(self, value):
+        self.raw_path = value.encode("utf8")
+
+    @property
+    def sha(self):
+        return self.binsha.hex()
+
+    @sha.setter
+    def sha(self, value):
+        self.binsha = bytes.fromhex(value)
 
 def tree_parse_one(raw, start=0):
     x = raw.find(b' ', start)
@@ -391,74 +1895,129 @@ def tree_parse_one(raw, start=0):
         mode = b'0' + mode
 
     # Find the Null terminator of the path
-
     y = raw.find(b'\x00', x + 1)
-    path = raw[x + 1:y]
-
-    raw_sha = int.from_bytes(raw[y+1:y+21], 'big')
 
-    sha = format(raw_sha, '040x')
-    return y+21, GitTreeLeaf(mode, path.decode('utf8'), sha)
+    return y+21, GitTreeLeaf(mode, raw[x + 1:y], raw[y + 1:y + 21])
 
-def tree_parse(raw):
+def tree_iter(raw):
+    """Yield the leaves of tree data raw, parsing each only when it's
+reached."""
     pos = 0
     max = len(raw)
-    ret = list()
     while pos < max:
-        pos, data = tree_parse_one(raw, pos)
-        ret.append(data)
+        pos, leaf = tree_parse_one(raw, pos)
+        yield leaf
+
+def tree_parse(raw):
+    return list(tree_iter(raw))
+
+def tree_leaf_is_tree(leaf):
+    # Modes are padded to 6 digits when parsed, but not necessarily
+    # when built by hand.
+    return leaf.mode.lstrip(b"0").startswith(b"4")
 
-    return ret
 def tree_leaf_sort_key(leaf):
-    if leaf.mode.startswith(b"10"):
-        return leaf.path
-    else:
+    # Git sorts subtrees as if their name ended with a slash.  Symlinks
+    # and submodules don't get one.
+    if tree_leaf_is_tree(leaf):
         return leaf.path + "/"
+    else:
+        return leaf.path
 
 def tree_serialize(obj):
     obj.items.sort(key=tree_leaf_sort_key)
-    ret = b''
-    for i in obj.items:
-        ret += i.mode
-        ret += b" "
-        ret += i.path.encode("utf8")
-        ret += b"\x00"
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder='big')
-    return ret
+    # Git writes the mode of a tree as 40000, without the 0 we pad it
+    # with when parsing.
+    return b''.join(b''.join((i.mode.lstrip(b'0'), b' ', i.raw_path, b'\x00', i.binsha))
+                    for i in obj.items)
 
 
 class GitTree(GitObject):
+    """A tree.  The data is kept as read, and only parsed into leaves
+when items is first used: iterating over the tree instead parses the
+leaves one at a time, without keeping them."""
     fmt = b'tree'
 
     def deserialize(self, data):
-        self.items = tree_parse(data)
+        self.raw = data
+        self._items = None
 
     def serialize(self):
+        if self._items is None:
+            return self.raw
         return tree_serialize(self)
+
     def init(self):
-        self.items = list()
+        self.raw = b''
+        self._items = list()
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = tree_parse(self.raw)
+        return self._items
+
+    @items.setter
+    def items(self, value):
+        self._items = value
+
+    def __iter__(self):
+        if self._items is None:
+            return tree_iter(self.raw)
+        return iter(self._items)
+
+    def find(self, name):
+        """Return the leaf called name, or None.  Leaves are sorted, so
+this is a binary search, once for a file and once for a tree."""
+        items = self.items
+        for key in (name, name + "/"):
+            i = bisect.bisect_left(items, key, key=tree_leaf_sort_key)
+            if i < len(items) and tree_leaf_sort_key(items[i]) == key:
+                return items[i]
+        return None
 
 
 #6.3 Showing tree: ls-tree
 
-argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object.")
-argsp.add_argument("-r",
-                   dest="recursive",
-                   action="store_true",
-                   help="Recurse into sub-trees")
+def argparse_ls_tree(argsp):
+    argsp.add_argument("-r",
+                       dest="recursive",
+                       action="store_true",
+                       help="Recurse into sub-trees")
+
+    # Like git, only --abbrev=n takes a length: see argv_split_equals.
+    argsp.add_argument("--abbrev",
+                       action="store_const",
+                       const=0,
+                       default=None,
+                       help="Show the shortest unique object names; --abbrev=n makes them at least n digits")
+    argsp.add_argument("--abbrev=",
+                       dest="abbrev",
+                       type=int,
+                       help=argparse.SUPPRESS)
 
-argsp.add_argument("tree",
-                   help="A tree-ish object.")
+    argsp.add_argument("tree",
+                       help="A tree-ish object.")
+
+argcommand("ls-tree", "Pretty-print a tree object.", argparse_ls_tree)
 
 def cmd_ls_tree(args):
     repo = repo_find()
-    ls_tree(repo, args.tree, args.recursive)
-
-def ls_tree(repo, ref, recursive=None, prefix=""):
+    ls_tree(repo, args.tree, args.recursive, abbrev=args.abbrev)
+
+def ls_tree(repo, ref, recursive=None, prefix="", abbrev=None):
+    for mode, type, sha, path in ls_tree_items(repo, ref, recursive, prefix):
+        if abbrev is not None:
+            sha = repo_oids(repo).find_unique_abbrev(sha, abbrev or None)
+        print(f"{mode} {type} {sha}\t{path}")
+
+@traced("ls_tree")
+def ls_tree_items(repo, ref, recursive=None, prefix=""):
+    """Yield (mode, type, sha, path) for each entry of tree-ish ref, or
+each leaf under it if recursive."""
     sha = object_find(repo, ref, fmt=b"tree")
     obj = object_read(repo, sha)
-    for item in obj.items:
+    for item in obj:
         if len(item.mode) == 5:
             type = item.mode[0:1]
         else:
@@ -472,20 +2031,28 @@ def ls_tree(repo, ref, recursive=None, prefix=""):
             case _: raise Exception(f"Weird tree leaf mode {item.mode}")
 
         if not (recursive and type=='tree'): # This is a leaf
-            print(f"{'0' * (6 - len(item.mode)) + item.mode.decode("ascii")} {type} {item.sha}\t{os.path.join(prefix, item.path)}")
+            mode = item.mode.decode("ascii").rjust(6, "0")
+            yield mode, type, item.sha, os.path.join(prefix, item.path)
         else: # This is a branch, recurse
-            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
+            yield from ls_tree_items(repo, item.sha, recursive, os.path.join(prefix, item.path))
 
 
 #6.4 The checkout command
 
-argsp = argsubparsers.add_parser("checkout", help="Checkout a commit inside of a directory.")
+def argparse_checkout(argsp):
+    argsp.add_argument("commit",
+                       help="The commit or tree to checkout.")
 
-argsp.add_argument("commit",
-                   help="The commit or tree to checkout.")
+    argsp.add_argument("path",
+                       help="The EMPTY directory to checkout on.")
 
-argsp.add_argument("path",
-                   help="The EMPTY directory to checkout on.")
+    argsp.add_argument("-j",
+                       dest="jobs",
+                       type=int,
+                       default=None,
+                       help="Write files from this many threads at once")
+
+argcommand("checkout", "Checkout a commit inside of a directory.", argparse_checkout)
 
 def cmd_checkout(args):
     repo = repo_find()
@@ -493,7 +2060,7 @@ def cmd_checkout(args):
     obj = object_read(repo, object_find(repo, args.commit))
 
     if obj.fmt == b'commit':
-        obj = object_read(repo, obj.kvlm[b'tree'].decode("ascii"))
+        obj = object_read(repo, obj.tree)
 
     if os.path.exists(args.path):
         if not os.path.isdir(args.path):
@@ -502,48 +2069,375 @@ def cmd_checkout(args):
             raise Exception(f"{args.path} is not empty!")
     else:
         os.makedirs(args.path)
-    tree_checkout(repo, obj, os.path.join(args.path, "tree"))
+
+    if not args.jobs:
+        with trace_region("tree_checkout"):
+            tree_checkout(repo, obj, os.path.realpath(args.path))
+        return
+
+    if args.jobs < 1:
+        raise Exception("checkout: -j needs at least one job")
+    start = time.perf_counter()
+    with trace_region("tree_checkout_parallel", { "jobs": args.jobs }):
+        count, size = tree_checkout_parallel(repo, obj, os.path.realpath(args.path), args.jobs)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"Checked out {count} files ({size / 1e6:.1f} MB) in {elapsed:.2f}s: "
+          f"{count / elapsed:.0f} files/s, {size / 1e6 / elapsed:.1f} MB/s")
 
 def tree_checkout(repo, tree, path):
-    for item in tree.items:
-        obj = object_read(repo, item.sha)
+    for item in tree:
         dest = os.path.join(path, item.path)
 
-        if obj.fmt == b'tree':
+        # The mode tells us the type, so we only need to read trees
+        # whole: blobs are streamed straight to the file.
+        if item.mode.startswith(b'04'):
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
-            # @TODO Support symlinks (identified by mode 12****)
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
-#7.1 refs
-
-def ref_resolve(repo, ref):
-    path = repo_file(repo, ref)
+            tree_checkout(repo, object_read(repo, item.sha), dest)
+        elif item.mode.startswith(b'16'):
+            # A submodule.  Like git, leave an empty directory.
+            os.mkdir(dest)
+        else:
+            checkout_blob(repo, item.sha, item.mode, dest)
+
+def tree_checkout_parallel(repo, tree, path, jobs):
+    """Checkout tree in path, writing files from jobs threads.
+
+Directories are all created first, so that the files can then be
+written in any order.  Inflating releases the GIL, as do writes, so
+threads are enough to keep several cores busy.  Returns the number of
+files written and their total size."""
+    from concurrent.futures import ThreadPoolExecutor
+    dirs = list()
+    files = list()
+    tree_checkout_plan(repo, tree, path, dirs, files)
+
+    for d in dirs: # Parents always come before their children.
+        os.mkdir(d)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        size = sum(pool.map(lambda f: checkout_blob(repo, *f), files))
+    return len(files), size
+
+def tree_checkout_plan(repo, tree, path, dirs, files):
+    """Walk tree, adding the directories to create to dirs and the
+(sha, mode, dest) of each file to write to files."""
+    for item in tree:
+        dest = os.path.join(path, item.path)
+        if item.mode.startswith(b'04'):
+            dirs.append(dest)
+            tree_checkout_plan(repo, object_read(repo, item.sha), dest, dirs, files)
+        elif item.mode.startswith(b'16'):
+            dirs.append(dest)
+        else:
+            files.append((item.sha, item.mode, dest))
+
+def checkout_blob(repo, sha, mode, dest):
+    """Write blob sha at dest as its tree mode says: a symlink for
+120000, an executable file for 100755, a plain file otherwise.
+Returns the number of bytes written."""
+    _, _, chunks = object_read_stream(repo, sha)
+
+    if mode.startswith(b'12'):
+        # A symlink: the blob is its target.
+        target = b''.join(chunks)
+        os.symlink(os.fsdecode(target), dest)
+        return len(target)
+
+    size = 0
+    with open(dest, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            size += len(chunk)
+
+    if mode == b'100755':
+        # Add x wherever there's r, so the umask still applies.
+        perms = os.stat(dest).st_mode
+        os.chmod(dest, perms | ((perms & 0o444) >> 2))
+    return size
+
+#6.5 Comparing trees: diff-tree
+
+def argparse_diff_tree(argsp):
+    argsp.add_argument("-r",
+                       dest="recursive",
+                       action="store_true",
+                       help="Recurse into sub-trees")
+
+    argsp.add_argument("-m",
+                       dest="merges",
+                       action="store_true",
+                       help="Compare merge commits with each of their parents, instead of showing nothing")
+
+    argsp.add_argument("args",
+                       metavar="tree-ish",
+                       nargs="+",
+                       help="One commit, to compare with its parent, or two tree-ish objects, then optional paths to limit the comparison to")
+
+argcommand("diff-tree", "Compare the content and mode of blobs found via two tree objects.", argparse_diff_tree)
+
+def cmd_diff_tree(args):
+    repo = repo_find()
 
-    if not os.path.exists(path):
-        return None
+    # Like git, tell paths from objects by whether they resolve.
+    names = list(args.args)
+    if names[1:] and object_resolve(repo, names[1]):
+        a = object_find(repo, names.pop(0), fmt=b'tree')
+        b = object_find(repo, names.pop(0), fmt=b'tree')
+        pairs = [ (None, a, b) ]
+    else:
+        commit = object_find(repo, names.pop(0), fmt=b'commit')
+        tree, parents, _, _ = commit_info(repo, commit)
+        # A root commit has nothing to compare with.  Like git, a merge
+        # shows nothing either, unless -m asks for a comparison with
+        # each parent in turn.
+        if len(parents) > 1 and not args.merges:
+            parents = []
+        pairs = [ (commit, commit_info(repo, p)[0], tree) for p in parents ]
+    paths = [ p.rstrip("/") for p in names if p != "--" ]
+
+    out = sys.stdout.buffer
+    with trace_region("tree_diff"):
+        for header, a, b in pairs:
+            for old_mode, new_mode, old_sha, new_sha, status, path in tree_diff(repo, a, b, args.recursive, paths):
+                # The commit, before the first change, if any.
+                if header:
+                    out.write(f"{header}\n".encode("ascii"))
+                    header = None
+                out.write(f":{old_mode.decode('ascii')} {new_mode.decode('ascii')} {old_sha} {new_sha} {status}\t{path}\n".encode("utf8"))
+    out.flush()
+
+tree_null_mode = b'000000'
+tree_null_sha = "0" * 40
+
+def tree_diff(repo, a, b, recursive=False, paths=None, prefix=""):
+    """Compare trees a and b, given by sha, either of which can be None
+for an empty tree.  Yields (old_mode, new_mode, old_sha, new_sha,
+status, path) for each entry that differs, in tree order, with
+status A, D, M, or T for a change of type.  The missing side of an
+addition or deletion has tree_null_mode and tree_null_sha.
+
+Subtrees are listed as such unless recursive, in which case their
+own differences are listed instead.  If paths is given, only what's
+at or under one of those paths is compared.
+
+Both trees' items are sorted by tree_leaf_sort_key, so the two lists
+are walked side by side, like a merge.  Entries with the same mode
+and sha on both sides are skipped without reading anything, which
+for a subtree means everything under it."""
+    items_a = object_read(repo, a).items if a else []
+    items_b = object_read(repo, b).items if b else []
+    i = j = 0
+    while i < len(items_a) or j < len(items_b):
+        old = items_a[i] if i < len(items_a) else None
+        new = items_b[j] if j < len(items_b) else None
+        if old and new:
+            key_a = tree_leaf_sort_key(old)
+            key_b = tree_leaf_sort_key(new)
+            if key_a < key_b:
+                new = None
+            elif key_b < key_a:
+                old = None
+        if old:
+            i += 1
+        if new:
+            j += 1
+
+        if old and new and old.binsha == new.binsha and old.mode == new.mode:
+            continue
+
+        leaf = old or new
+        path = prefix + leaf.path
+        is_tree = tree_leaf_is_tree(leaf)
+        if paths and not tree_diff_pathspec(paths, path, is_tree):
+            continue
+
+        if recursive and is_tree:
+            yield from tree_diff(repo, old and old.sha, new and new.sha,
+                                 recursive, paths, path + "/")
+            continue
+
+        if not old:
+            yield tree_null_mode, new.mode, tree_null_sha, new.sha, "A", path
+        elif not new:
+            yield old.mode, tree_null_mode, old.sha, tree_null_sha, "D", path
+        else:
+            # 100644 and 100755 are both regular files; the first two
+            # digits of the mode are the type.
+            status = "M" if old.mode[0:2] == new.mode[0:2] else "T"
+            yield old.mode, new.mode, old.sha, new.sha, status, path
+
+def tree_diff_pathspec(paths, path, is_tree):
+    """Whether path is at or under one of paths or, for a tree, might
+have one of them under it."""
+    for p in paths:
+        if path == p or path.startswith(p + "/"):
+            return True
+        if is_tree and p.startswith(path + "/"):
+            return True
+    return False
 
-    with open(path, 'rb') as fp:
-        data = fp.read().strip()
+#7.1 refs
 
-        if data.startswith("ref: "):
-            return ref_resolve(repo, data[5:])
+def ref_resolve(repo, ref):
+    """Resolve ref to a sha, following symbolic refs.  Refs under refs/
+come from the ref store, so this opens no files; others, like HEAD, are
+read from their file in the gitdir."""
+    store = repo_refs(repo)
+    for _ in range(ref_max_depth):
+        if ref.startswith("refs/"):
+            data = store.refs.get(ref)
         else:
+            path = repo_file(repo, ref)
+            if not (path and os.path.isfile(path)):
+                return None
+            with open(path, 'r') as fp:
+                data = fp.read().strip()
+
+        if data is None or not data.startswith("ref: "):
             return data
-def ref_list(repo, path=None):
-    if not path:
-        path = repo_dir(repo)
+        ref = data[5:]
+    raise Exception(f"Too many levels of symbolic refs at {ref}")
+
+# Same limit as git's.
+ref_max_depth = 5
+
+class GitRefStore(object):
+    """Every ref under refs/, loose and packed, read once.  Loose refs
+win over packed ones, as in git.  Values are what's in the ref: a sha,
+or "ref: <name>" for a symbolic ref."""
+
+    def __init__(self, repo):
+        # Name to value, for packed-refs alone, then for everything.
+        self.packed = dict()
+        # Name to the sha an annotated tag peels to, from the ^ lines of
+        # packed-refs.
+        self.peeled = dict()
+
+        path = repo_path(repo, "packed-refs")
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                name = None
+                for line in f:
+                    line = line.rstrip("\n")
+                    if not line or line[0] == "#":
+                        continue
+                    if line[0] == "^":
+                        self.peeled[name] = line[1:]
+                        continue
+                    sha, _, name = line.partition(" ")
+                    self.packed[name] = sha
+
+        self.loose = dict()
+        top = repo_path(repo, "refs")
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            for f in files:
+                if f.endswith(".lock"):
+                    continue
+                full = os.path.join(root, f)
+                name = "refs/" + os.path.relpath(full, top).replace(os.sep, "/")
+                with open(full, 'r') as fp:
+                    self.loose[name] = fp.read().strip()
+
+        self.refs = dict(self.packed)
+        self.refs.update(self.loose)
+        self.names = sorted(self.refs)
+
+    def peeled_sha(self, name):
+        """The sha the packed ref name peels to, if packed-refs knows it
+and the ref isn't overridden by a loose one."""
+        if name in self.loose:
+            return None
+        return self.peeled.get(name)
+
+    def iter_prefix(self, prefix):
+        """Yield (name, value) for each ref whose name starts with prefix,
+in order."""
+        i = bisect.bisect_left(self.names, prefix)
+        while i < len(self.names) and self.names[i].startswith(prefix):
+            name = self.names[i]
+            yield name, self.refs[name]
+            i += 1
+
+    def set(self, name, value):
+        """Record that the loose ref name now holds value."""
+        if name not in self.refs:
+            bisect.insort(self.names, name)
+        self.loose[name] = value
+        self.refs[name] = value
+
+def repo_refs(repo):
+    """Return the repository's ref store, reading the refs on first use."""
+    if repo.refs is None:
+        repo.refs = GitRefStore(repo)
+    return repo.refs
+
+def ref_list(repo, prefix="refs/"):
+    """Return the refs under prefix as nested dicts, one per directory,
+with symbolic refs resolved."""
     ret = dict()
+    for name, value in repo_refs(repo).iter_prefix(prefix):
+        parts = name[len(prefix):].split("/")
+        d = ret
+        for p in parts[:-1]:
+            d = d.setdefault(p, dict())
+        d[parts[-1]] = ref_resolve(repo, name) if value.startswith("ref: ") else value
+    return ret
+
+def argparse_pack_refs(argsp):
+    argsp.add_argument("--all", action="store_true", help="Pack every ref, not only tags")
+    argsp.add_argument("--no-prune", dest="prune", action="store_false",
+                       help="Keep the loose refs after packing them")
+
+argcommand("pack-refs", "Pack refs into .git/packed-refs.", argparse_pack_refs)
 
-    for f in os.listdir(path):
-        can = os.path.join(path, f)
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can)
+def cmd_pack_refs(args):
+    repo = repo_find()
+    refs_pack(repo, pack_all=args.all, prune=args.prune)
+
+def refs_pack(repo, pack_all=False, prune=True):
+    """Write packed-refs with the refs already packed, plus every loose
+tag, or every loose ref if pack_all.  Symbolic refs are never packed.
+Annotated tags get a ^ line with what they peel to, so readers don't
+need to open the tag.  Returns the number of refs packed."""
+    import tempfile
+    store = repo_refs(repo)
+    packed = dict(store.packed)
+    pruned = list()
+    for name, value in store.loose.items():
+        if value.startswith("ref: "):
+            continue
+        if pack_all or name.startswith("refs/tags/") or name in packed:
+            packed[name] = value
+            pruned.append(name)
+
+    lines = [ "# pack-refs with: peeled fully-peeled sorted \n" ]
+    for name in sorted(packed):
+        sha = packed[name]
+        lines.append(f"{sha} {name}\n")
+        if store.packed.get(name) == sha and name in store.peeled:
+            peeled = store.peeled[name]
         else:
-            ret = ref_resolve(repo, can)
-    return ret
-argsp = argsubparsers.add_parser("show-ref", help="List references.")
+            peeled = tag_peel(repo, sha)
+        if peeled != sha:
+            lines.append(f"^{peeled}\n")
+
+    # Write to a temporary file, then move it over, so readers never
+    # see half of it.
+    fd, tmp = tempfile.mkstemp(dir=repo.gitdir, prefix="packed-refs")
+    with os.fdopen(fd, 'w') as f:
+        f.writelines(lines)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, repo_path(repo, "packed-refs"))
+
+    if prune:
+        for name in pruned:
+            os.unlink(repo_path(repo, *name.split("/")))
+
+    repo.refs = None
+    return len(packed)
+
+argcommand("show-ref", "List references.")
 
 def cmd_show_ref(args):
     repo = repo_find()
@@ -565,23 +2459,22 @@ class GitTag(GitCommit):
     fmt = b'tag'
 #7.4 tag creation
 
-argsp = argsubparsers.add_parser(
-    "tag",
-    help="List and create tags")
+def argparse_tag(argsp):
+    argsp.add_argument("-a",
+                       action="store_true",
+                       dest="create_tag_object",
+                       help="Whether to create a tag object")
 
-argsp.add_argument("-a",
-                   action="store_true",
-                   dest="create_tag_object",
-                   help="Whether to create a tag object")
+    argsp.add_argument("name",
+                       nargs="?",
+                       help="The new tag's name")
 
-argsp.add_argument("name",
-                   nargs="?",
-                   help="The new tag's name")
+    argsp.add_argument("object",
+                       default="HEAD",
+                       nargs="?",
+                       help="The object the new tag will point to")
 
-argsp.add_argument("object",
-                   default="HEAD",
-                   nargs="?",
-                   help="The object the new tag will point to")
+argcommand("tag", "List and create tags", argparse_tag)
 
 def cmd_tag(args):
     repo = repo_find()
@@ -619,8 +2512,14 @@ def tag_create(repo, name, ref, create_tag_object=False):
         ref_create(repo, "tags/" + name, sha)
 
 def ref_create(repo, ref_name, sha):
-    with open(repo_file(repo, "refs/" + ref_name), 'w') as fp:
+    # Write a lock file and rename it over the ref, like git, so the
+    # update is atomic and shows in the directory's mtime.
+    path = repo_file(repo, "refs", *ref_name.split("/"), mkdir=True)
+    with open(path + ".lock", 'w') as fp:
         fp.write(sha + "\n")
+    os.replace(path + ".lock", path)
+    repo_refs(repo).set("refs/" + ref_name, sha)
+
 def object_resolve(repo, name):
     """Resolve name to an object hash in repo.
 
@@ -647,16 +2546,7 @@ This function is aware of:
         # This may be a hash, either small or full.  4 seems to be the
         # minimal length for git to consider something a short hash.
         # This limit is documented in man git-rev-parse
-        name = name.lower()
-        prefix = name[0:2]
-        path = repo_dir(repo, "objects", prefix, mkdir=False)
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    # Notice a string startswith() itself, so this
-                    # works for full hashes.
-                    candidates.append(prefix + f)
+        candidates.extend(repo_oids(repo).find_prefix(name))
 
     # Try for references.
     as_tag = ref_resolve(repo, "refs/tags/" + name)
@@ -688,39 +2578,57 @@ def object_find(repo, name, fmt=None, follow=True):
     if not fmt:
         return sha
 
-    while True:
-        obj = object_read(repo, sha)
-        #     ^^^^^^^^^^^ < this is a bit agressive: we're reading
-        # the full object just to get its type.  And we're doing
-        # that in a loop, albeit normally short.  Don't expect
-        # high performance here.
+    return object_peel(repo, sha, fmt, follow)
 
-        if obj.fmt == fmt:
+def object_peel(repo, sha, fmt, follow=True):
+    """Return the sha of the object of type fmt that sha is or, if
+follow, points to through tags (and commits, for a tree).  None if
+there's no such object."""
+    while True:
+        # Only the header is needed to get the type, so a blob at the
+        # end of the chain never gets inflated.  Tags and commits do,
+        # but they're small.
+        header = object_read_header(repo, sha)
+        if header is None:
+            raise Exception(f"No such object {sha}.")
+        obj_fmt = header[0]
+
+        if obj_fmt == fmt:
             return sha
 
         if not follow:
             return None
 
         # Follow tags
-        if obj.fmt == b'tag':
-            sha = obj.kvlm[b'object'].decode("ascii")
-        elif obj.fmt == b'commit' and fmt == b'tree':
-            sha = obj.kvlm[b'tree'].decode("ascii")
+        if obj_fmt == b'tag':
+            sha = object_read(repo, sha).header(b'object')[0].decode("ascii")
+        elif obj_fmt == b'commit' and fmt == b'tree':
+            sha = commit_info(repo, sha)[0]
         else:
             return None
-argsp = argsubparsers.add_parser(
-    "rev-parse", help="Parse revision (or other objects) identifiers"
-)
-argsp.add_argument(
-    "--wyag-type",
-    metavar="type",
-    dest="type",
-    choices =["blob", "commit", "tag", "tree"],
-    default=None,
-    help="Specify the type"
-)
-
-argsp.add_argument("name", help="The name to parse")
+
+def tag_peel(repo, sha):
+    """Return what sha points to once every tag on the way is followed:
+sha itself if it's not a tag."""
+    while True:
+        header = object_read_header(repo, sha)
+        if header is None or header[0] != b'tag':
+            return sha
+        sha = object_read(repo, sha).header(b'object')[0].decode("ascii")
+
+def argparse_rev_parse(argsp):
+    argsp.add_argument(
+        "--wyag-type",
+        metavar="type",
+        dest="type",
+        choices =["blob", "commit", "tag", "tree"],
+        default=None,
+        help="Specify the type"
+    )
+
+    argsp.add_argument("name", help="The name to parse")
+
+argcommand("rev-parse", "Parse revision (or other objects) identifiers", argparse_rev_parse)
 
 def cmd_rev_parse(args):
     if args.type:
@@ -734,10 +2642,16 @@ def cmd_rev_parse(args):
 #8.2 parsing the index
 
 class GitIndexEntry(object):
+    # An index can have hundreds of thousands of entries: slots save
+    # a dict per entry.
+    __slots__ = ("ctime", "mtime", "dev", "ino", "mode_type", "mode_perms",
+                 "uid", "gid", "fsize", "binsha", "flag_assume_valid",
+                 "flag_stage", "raw_name")
+
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
-                 fsize=None, sha=None, flag_assume_valid=None,
-                 flag_stage=None, name=None):
+                 fsize=None, binsha=None, flag_assume_valid=None,
+                 flag_stage=None, raw_name=None):
         self.ctime = ctime
         self.mtime = mtime
         self.dev = dev
@@ -747,10 +2661,30 @@ class GitIndexEntry(object):
         self.uid = uid
         self.gid = gid
         self.fsize = fsize
-        self.sha = sha
+        self.binsha = binsha
         self.flag_assume_valid = flag_assume_valid
         self.flag_stage = flag_stage
-        self.name = name
+        self.raw_name = raw_name
+
+    # The sha is kept as its 20 raw bytes and the name as utf8 bytes,
+    # and only converted when asked for.
+
+    @property
+    def sha(self):
+        return self.binsha.hex()
+
+    @sha.setter
+    def sha(self, value):
+        self.binsha = bytes.fromhex(value)
+
+    @property
+    def name(self):
+        return self.raw_name.decode("utf8")
+
+    @name.setter
+    def name(self, value):
+        self.raw_name = value.encode("utf8")
+
 class GitIndex(object):
     version = None
     entries = []
@@ -758,130 +2692,184 @@ class GitIndex(object):
     #ext = None
     #sha = None
 
+    # Built on first use by index_find
+    names = None
+
+    # Set by index_read: the extensions after the entries, which
+    # index_write puts back as they were, and the mtime and size of the
+    # file, to tell whether somebody else wrote it since.
+    extensions = b""
+    stamp = None
+
     def __init__(self, version=2, entries=None):
         if not entries:
             entries = list()
         self.version = version
         self.entries = entries
+
+# The 62 bytes at the start of each entry, all big-endian: ctime
+# seconds and nanoseconds, mtime seconds and nanoseconds, device,
+# inode, mode (16 unused bits, then 4 bits of type, 3 unused and 9 of
+# permissions), uid, gid, size, sha and flags.
+index_entry_header = struct.Struct(">10I20sH")
+
+@traced("index_read")
 def index_read(repo):
+    import mmap
     index_file = repo_file(repo, "index")
 
     # New repositories have no index!
     if not os.path.exists(index_file):
         return GitIndex()
 
-    with open(index_file, 'rb') as f:
-        raw = f.read()
-
-    header = raw[:12]
-    signature = header[:4]
-    assert signature == b"DIRC" # Stands for "DirCache"
-    version = int.from_bytes(header[4:8], "big")
-    assert version == 2, "wyag only supports index file version 2"
-    count = int.from_bytes(header[8:12], "big")
-
-    entries = list()
-
-    content = raw[12:]
-    idx = 0
-    for i in range(0, count):
-        # Read creation time, as a unix timestamp (seconds since
-        # 1970-01-01 00:00:00, the "epoch")
-        ctime_s =  int.from_bytes(content[idx: idx+4], "big")
-        # Read creation time, as nanoseconds after that timestamps,
-        # for extra precision.
-        ctime_ns = int.from_bytes(content[idx+4: idx+8], "big")
-        # Same for modification time: first seconds from epoch.
-        mtime_s = int.from_bytes(content[idx+8: idx+12], "big")
-        # Then extra nanoseconds
-        mtime_ns = int.from_bytes(content[idx+12: idx+16], "big")
-        # Device ID
-        dev = int.from_bytes(content[idx+16: idx+20], "big")
-        # Inode
-        ino = int.from_bytes(content[idx+20: idx+24], "big")
-        # Ignored.
-        unused = int.from_bytes(content[idx+24: idx+26], "big")
-        assert 0 == unused
-        mode = int.from_bytes(content[idx+26: idx+28], "big")
-        mode_type = mode >> 12
-        assert mode_type in [0b1000, 0b1010, 0b1110]
-        mode_perms = mode & 0b0000000111111111
-        # User ID
-        uid = int.from_bytes(content[idx+28: idx+32], "big")
-        # Group ID
-        gid = int.from_bytes(content[idx+32: idx+36], "big")
-        # Size
-        fsize = int.from_bytes(content[idx+36: idx+40], "big")
-        # SHA (object ID).  We'll store it as a lowercase hex string
-        # for consistency.
-        sha = format(int.from_bytes(content[idx+40: idx+60], "big"), "040x")
-        # Flags we're going to ignore
-        flags = int.from_bytes(content[idx+60: idx+62], "big")
-        # Parse flags
-        flag_assume_valid = (flags & 0b1000000000000000) != 0
-        flag_extended = (flags & 0b0100000000000000) != 0
-        assert not flag_extended
-        flag_stage =  flags & 0b0011000000000000
-        # Length of the name.  This is stored on 12 bits, some max
-        # value is 0xFFF, 4095.  Since names can occasionally go
-        # beyond that length, git treats 0xFFF as meaning at least
-        # 0xFFF, and looks for the final 0x00 to find the end of the
-        # name --- at a small, and probably very rare, performance
-        # cost.
-        name_length = flags & 0b0000111111111111
-
-        # We've read 62 bytes so far.
-        idx += 62
-
-        if name_length < 0xFFF:
-            assert content[idx + name_length] == 0x00
-            raw_name = content[idx:idx+name_length]
-            idx += name_length + 1
-        else:
-            print(f"Notice: Name is 0x{name_length:X} bytes long.")
-            # This probably wasn't tested enough.  It works with a
-            # path of exactly 0xFFF bytes.  Any extra bytes broke
-            # something between git, my shell and my filesystem.
-            null_idx = content.find(b'\x00', idx + 0xFFF)
-            raw_name = content[idx: null_idx]
-            idx = null_idx + 1
-
-        # Just parse the name as utf8.
-        name = raw_name.decode("utf8")
-
-        # Data is padded on multiples of eight bytes for pointer
-        # alignment, so we skip as many bytes as we need for the next
-        # read to start at the right position.
-
-        idx = 8 * ceil(idx / 8)
-
-        # And we add this entry to our list.
-        entries.append(GitIndexEntry(ctime=(ctime_s, ctime_ns),
-                                     mtime=(mtime_s,  mtime_ns),
-                                     dev=dev,
-                                     ino=ino,
-                                     mode_type=mode_type,
-                                     mode_perms=mode_perms,
-                                     uid=uid,
-                                     gid=gid,
-                                     fsize=fsize,
-                                     sha=sha,
-                                     flag_assume_valid=flag_assume_valid,
-                                     flag_stage=flag_stage,
-                                     name=name))
-
-    return GitIndex(version=version, entries=entries)
-
-argsp = argsubparsers.add_parser("ls-files", help = "List all the stage files")
-argsp.add_argument("--verbose", action="store_true", help="Show everything.")
+    with open(index_file, 'rb') as f, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+         memoryview(mm) as raw:
+        signature, version, count = struct.unpack_from(">4sII", raw, 0)
+        assert signature == b"DIRC" # Stands for "DirCache"
+        assert version == 2, "wyag only supports index file version 2"
+
+        entries = list()
+        unpack = index_entry_header.unpack_from
+        idx = 12
+        for i in range(0, count):
+            (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode,
+             uid, gid, fsize, binsha, flags) = unpack(raw, idx)
+
+            mode_type = mode >> 12
+            assert mode_type in [0b1000, 0b1010, 0b1110]
+
+            flag_extended = (flags & 0b0100000000000000) != 0
+            assert not flag_extended
+
+            # Length of the name.  This is stored on 12 bits, so 0xFFF
+            # means "at least 0xFFF", and we have to look for the NUL
+            # that ends the name.
+            name_start = idx + 62
+            name_length = flags & 0b0000111111111111
+            if name_length < 0xFFF:
+                name_end = name_start + name_length
+            else:
+                name_end = mm.find(b'\x00', name_start + 0xFFF)
+
+            entries.append(GitIndexEntry((ctime_s, ctime_ns),
+                                         (mtime_s, mtime_ns),
+                                         dev,
+                                         ino,
+                                         mode_type,
+                                         mode & 0b0000000111111111,
+                                         uid,
+                                         gid,
+                                         fsize,
+                                         binsha,
+                                         (flags & 0b1000000000000000) != 0,
+                                         flags & 0b0011000000000000,
+                                         bytes(raw[name_start:name_end])))
+
+            # Entries are NUL-padded (with at least one NUL) to a
+            # multiple of eight bytes.
+            idx += (name_end - idx + 8) & ~7
+
+        index = GitIndex(version=version, entries=entries)
+        index.extensions = bytes(raw[idx:len(raw) - 20])
+        st = os.fstat(f.fileno())
+        index.stamp = (st.st_mtime_ns, st.st_size)
+    return index
+
+def index_write(repo, index):
+    """Write index to .git/index: the reverse of index_read.  Entries
+must already be sorted by name.
+
+Like git, this holds .git/index.lock while writing, and gives up if
+another process holds it, or if index came from index_read and the
+file changed since.  Returns whether it wrote the index."""
+    import hashlib
+
+    out = [ struct.pack(">4sII", b"DIRC", 2, len(index.entries)) ]
+    pack = index_entry_header.pack
+    for e in index.entries:
+        flags = ((0b1000000000000000 if e.flag_assume_valid else 0)
+                 | e.flag_stage
+                 | min(len(e.raw_name), 0xFFF))
+        entry = pack(e.ctime[0], e.ctime[1], e.mtime[0], e.mtime[1], e.dev, e.ino,
+                     (e.mode_type << 12) | e.mode_perms, e.uid, e.gid, e.fsize,
+                     e.binsha, flags) + e.raw_name
+        # NUL-padded, with at least one NUL, to a multiple of eight.
+        out.append(entry + b'\x00' * (8 - len(entry) % 8))
+    out.append(index.extensions)
+    data = b''.join(out)
+    data += hashlib.sha1(data).digest()
+
+    path = repo_file(repo, "index")
+    try:
+        f = open(path + ".lock", "xb")
+    except FileExistsError:
+        return False
+    with f:
+        if index.stamp is not None and index.stamp != index_stamp(path):
+            os.unlink(path + ".lock")
+            return False
+        f.write(data)
+    os.replace(path + ".lock", path)
+    return True
+
+def index_stamp(path):
+    """The mtime and size of the index file at path, or None if there's
+none."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def index_find(index, paths):
+    """Return the entries matching any of paths, each either the name
+of a file in the index or a directory, matching every file under it.
+Like git, they come in index order, each once, whatever the order of
+paths."""
+    if index.names is None:
+        index.names = [ e.raw_name for e in index.entries ]
+    names = index.names
+
+    positions = set()
+    for path in paths:
+        raw = b"" if path == "." else path.encode("utf8").rstrip(b"/")
+        if not raw:
+            return list(index.entries)
+        # A file, with several entries if a merge left it in several
+        # stages.
+        start = bisect.bisect_left(names, raw)
+        end = bisect.bisect_right(names, raw, start)
+        if start == end:
+            # Not a file, maybe a directory: the index is sorted by
+            # name, so everything under it is in one contiguous range.
+            start = bisect.bisect_left(names, raw + b"/", start)
+            end = bisect.bisect_left(names, raw + b"0", start) # "0" sorts right after "/"
+        positions.update(range(start, end))
+    return [ index.entries[i] for i in sorted(positions) ]
+
+def argparse_ls_files(argsp):
+    argsp.add_argument("--verbose", action="store_true", help="Show everything.")
+    argsp.add_argument("path", nargs="*", help="Only show these files, or files under these directories")
+
+argcommand("ls-files", "List all the stage files", argparse_ls_files)
 
 def cmd_ls_files(args):
+    from datetime import datetime
+    import grp, pwd
     repo = repo_find()
     index = index_read(repo)
     if args.verbose:
         print(f"Index file format v{index.version}, containing {len(index.entries)} entries.")
 
-    for e in index.entries:
+    if args.path:
+        # Paths are given relative to the current directory.
+        entries = index_find(index, [ os.path.relpath(os.path.abspath(path), repo.worktree)
+                                      for path in args.path ])
+    else:
+        entries = index.entries
+
+    for e in entries:
         print(e.name)
         if args.verbose:
             entry_type = { 0b1000: "regular file",
@@ -896,15 +2884,55 @@ def cmd_ls_files(args):
 
 #8.4 check-ignore command
 
-argsp = argsubparsers.add_parser("check-ignore", help = "Check path(s) against ignore rules.")
-argsp.add_argument("path", nargs="+", help="Paths to check")
+def argparse_check_ignore(argsp):
+    argsp.add_argument("--stdin", action="store_true", help="Read paths from standard input, one per line")
+    argsp.add_argument("-z", dest="nul", action="store_true",
+                       help="Paths are separated by NUL instead of newlines, both in input and output")
+    argsp.add_argument("path", nargs="*", help="Paths to check")
+
+argcommand("check-ignore", "Check path(s) against ignore rules.", argparse_check_ignore)
 
 def cmd_check_ignore(args):
+    if args.stdin and args.path:
+        raise Exception("check-ignore: can't take paths with --stdin")
+    if not (args.stdin or args.path):
+        raise Exception("check-ignore: no path specified")
+
     repo = repo_find()
     rules = gitignore_read(repo)
-    for path in args.path:
-        if check_ignore(rules, path):
-            print(path)
+    out = sys.stdout.buffer
+    sep = b"\x00" if args.nul else b"\n"
+    # Like git, flush after each answer so that the other end of a pipe
+    # can feed us paths one at a time, unless we're writing to a file.
+    flush = args.stdin and not stat.S_ISREG(os.fstat(out.fileno()).st_mode)
+
+    paths = stdin_read_paths(sys.stdin.buffer, sep) if args.stdin else args.path
+    for path in paths:
+        is_dir = path.endswith("/") or os.path.isdir(path)
+        if check_ignore(rules, path.rstrip("/") if is_dir else path, is_dir):
+            out.write(path.encode("utf8") + sep)
+            if flush:
+                out.flush()
+
+def stdin_read_paths(f, sep):
+    """Yield the sep-separated paths read from binary file f, as they
+come in."""
+    if sep == b"\n":
+        for line in f:
+            line = line.rstrip(b"\n")
+            if line:
+                yield line.decode("utf8")
+        return
+
+    pending = b''
+    while chunk := f.read1(64 * 1024) if hasattr(f, "read1") else f.read(64 * 1024):
+        pending += chunk
+        *paths, pending = pending.split(sep)
+        for path in paths:
+            if path:
+                yield path.decode("utf8")
+    if pending:
+        yield pending.decode("utf8")
 def gitignore_parse1(raw):
     raw = raw.strip() # Remove leading/trailing spaces
 
@@ -933,14 +2961,126 @@ class GitIgnore(object):
     def __init__(self, absolute, scoped):
         self.absolute = absolute
         self.scoped = scoped
-def gitignore_read(repo):
+        # Caches, by directory: whether it's ignored, and which scoped
+        # rulesets apply to what's in it.
+        self.dirs = dict()
+        self.scopes = dict()
+
+class GitIgnoreRules(object):
+    """The rules of one ignore file, compiled.
+
+Rather than trying each pattern in turn, all of them are joined into
+one regular expression, in reverse order: the regex engine picks the
+first alternative that matches, which is then the last matching rule,
+and last match wins in gitignore.  Patterns ending with a slash only
+match directories, so there's one regex for directories and one, without
+those patterns, for everything else."""
+
+    def __init__(self, rules):
+        self.rules = rules
+        translated = [ (gitignore_translate(pattern), value) for pattern, value in rules ]
+        self.dir_regex, self.dir_values = gitignore_compile(
+            [ (regex, value) for (regex, _), value in translated ])
+        self.file_regex, self.file_values = gitignore_compile(
+            [ (regex, value) for (regex, dir_only), value in translated if not dir_only ])
+
+    def match(self, path, is_dir=False):
+        """Return True if path, relative to the directory of the ignore
+file, is ignored, False if it's explicitly not, None if no rule
+matches."""
+        if is_dir:
+            regex, values = self.dir_regex, self.dir_values
+        else:
+            regex, values = self.file_regex, self.file_values
+        if regex is None:
+            return None
+        m = regex.fullmatch(path)
+        if not m:
+            return None
+        return values[m.lastindex - 1]
+
+def gitignore_compile(rules):
+    """Join (regex, value) rules in one regex, the last rule first, each
+in its own group.  Returns the compiled regex and the values, in the
+order of the groups."""
+    if not rules:
+        return None, []
+    rules = rules[::-1]
+    regex = re.compile("|".join(f"({regex})" for regex, _ in rules), re.DOTALL)
+    return regex, [ value for _, value in rules ]
+
+def gitignore_translate(pattern):
+    """Translate a gitignore pattern to a regex (with no capturing
+group) matching paths relative to the ignore file's directory.
+Returns the regex and whether the pattern only matches directories."""
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+
+    # With a slash anywhere but at the end, the pattern is anchored to
+    # the ignore file's directory.  Otherwise it matches at any depth.
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+
+    ret = list()
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            if pattern.startswith("*", i) and (i == 1 or pattern[i - 2] == "/"):
+                if i + 1 == n:
+                    # Trailing "**": everything below.
+                    ret.append(".*")
+                    i += 1
+                    continue
+                if pattern[i + 1] == "/":
+                    # "**/": zero or more directories.
+                    ret.append("(?:.*/)?")
+                    i += 2
+                    continue
+            while pattern.startswith("*", i):
+                i += 1
+            ret.append("[^/]*")
+        elif c == "?":
+            ret.append("[^/]")
+        elif c == "[":
+            j = i
+            if pattern.startswith("!", j):
+                j += 1
+            if pattern.startswith("]", j):
+                j += 1
+            j = pattern.find("]", j)
+            if j < 0:
+                ret.append("\\[")
+                continue
+            stuff = pattern[i:j].replace("\\", "\\\\")
+            i = j + 1
+            if stuff[0] == "!":
+                stuff = "^/" + stuff[1:]
+            elif stuff[0] == "^":
+                stuff = "\\" + stuff
+            ret.append(f"[{stuff}]")
+        elif c == "\\" and i < n:
+            ret.append(re.escape(pattern[i]))
+            i += 1
+        else:
+            ret.append(re.escape(c))
+
+    regex = "".join(ret)
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+    return regex, dir_only
+
+@traced("gitignore_read")
+def gitignore_read(repo, index=None):
     ret = GitIgnore(absolute=list(), scoped=dict())
 
     # Read local configuration in .git/info/exclude
     repo_file = os.path.join(repo.gitdir, "info/exclude")
     if os.path.exists(repo_file):
         with open(repo_file, "r") as f:
-            ret.absolute.append(gitignore_parse(f.readlines()))
+            ret.absolute.append(GitIgnoreRules(gitignore_parse(f.readlines())))
 
     # Global configuration
     if "XDG_CONFIG_HOME" in os.environ:
@@ -951,50 +3091,1720 @@ def gitignore_read(repo):
 
     if os.path.exists(global_file):
         with open(global_file, "r") as f:
-            ret.absolute.append(gitignore_parse(f.readlines()))
+            ret.absolute.append(GitIgnoreRules(gitignore_parse(f.readlines())))
 
     # .gitignore files in the index
-    index = index_read(repo)
+    if index is None:
+        index = index_read(repo)
 
     for entry in index.entries:
-        if entry.name == ".gitignore" or entry.name.endswith("/.gitignore"):
+        if entry.raw_name == b".gitignore" or entry.raw_name.endswith(b"/.gitignore"):
             dir_name = os.path.dirname(entry.name)
             contents = object_read(repo, entry.sha)
             lines = contents.blobdata.decode("utf8").splitlines()
-            ret.scoped[dir_name] = gitignore_parse(lines)
+            ret.scoped[dir_name] = GitIgnoreRules(gitignore_parse(lines))
     return ret
-def check_ignore1(rules, path):
-    result = None
-    for (pattern, value) in rules:
-        if fnmatch(path, pattern):
-            result = value
-    return result
+def check_ignore_scopes(rules, dirname):
+    """The (directory, ruleset) of the .gitignore files that apply to
+entries of dirname, deepest first."""
+    scopes = rules.scopes.get(dirname)
+    if scopes is None:
+        scopes = list()
+        if dirname in rules.scoped:
+            scopes.append((dirname, rules.scoped[dirname]))
+        if dirname:
+            scopes += check_ignore_scopes(rules, dirname.rpartition("/")[0])
+        rules.scopes[dirname] = scopes
+    return scopes
+
+def check_ignore1(rules, path, is_dir=False):
+    """Apply the rules to path itself, ignoring its parents."""
+    for dirname, ruleset in check_ignore_scopes(rules, path.rpartition("/")[0]):
+        result = ruleset.match(path[len(dirname) + 1:] if dirname else path, is_dir)
+        if result is not None:
+            return result
 
-def check_ignore_scoped(rules, path):
-    parent = os.path.dirname(path)
-    while True:
-        if parent in rules:
-            result = check_ignore1(rules[parent], path)
-            if result != None:
-                return result
-        if parent == "":
-            break
-        parent = os.path.dirname(parent)
-    return None
-def check_ignore_absolute(rules, path):
-    parent = os.path.dirname(path)
-    for ruleset in rules:
-        result = check_ignore1(ruleset, path)
-        if result != None:
+    for ruleset in rules.absolute:
+        result = ruleset.match(path, is_dir)
+        if result is not None:
             return result
     return False
 
-def check_ignore(rules, path):
+def check_ignore_dir(rules, path):
+    """Whether directory path is ignored, itself or through a parent."""
+    result = rules.dirs.get(path)
+    if result is None:
+        parent = path.rpartition("/")[0]
+        result = (bool(parent) and check_ignore_dir(rules, parent)) \
+            or check_ignore1(rules, path, is_dir=True)
+        rules.dirs[path] = result
+    return result
+
+def check_ignore(rules, path, is_dir=False):
     if os.path.isabs(path):
         raise Exception("This function requires path to be relative to the repository's root")
 
-    result = check_ignore_scoped(rules.scoped, path)
-    if result != None:
-        return result
+    # Like git, a path in an ignored directory is ignored, whatever the
+    # rules say about the path itself.
+    parent = path.rpartition("/")[0]
+    if parent and check_ignore_dir(rules, parent):
+        return True
+
+    return check_ignore1(rules, path, is_dir)
+
+#8.5 status command
+
+argcommand("status", "Show the working tree status.")
+
+def cmd_status(_):
+    repo = repo_find()
+    index = index_read(repo)
+
+    cmd_status_branch(repo)
+    cmd_status_head_index(repo, index)
+    print()
+    cmd_status_index_worktree(repo, index)
+
+def branch_get_active(repo):
+    with open(repo_file(repo, "HEAD"), "r") as f:
+        head = f.read()
+
+    if head.startswith("ref: refs/heads/"):
+        return(head[16:-1])
+    else:
+        return False
+
+def cmd_status_branch(repo):
+    branch = branch_get_active(repo)
+    if branch:
+        print(f"On branch {branch}.")
+    else:
+        print(f"HEAD detached at {object_find(repo, 'HEAD')}")
+
+#8.5.1 HEAD against the index
+
+def cmd_status_head_index(repo, index):
+    print("Changes to be committed:")
+    for change, path in status_head_index(repo, index):
+        print(f"  {change}: {path}")
+
+def index_entry_mode(entry):
+    """The entry's mode as it would be written in a tree, eg b"100644"."""
+    return b"%o" % ((entry.mode_type << 12) | entry.mode_perms)
+
+def index_dirs(index):
+    """Arrange the index entries the way trees would hold them: returns
+a dict mapping each directory ("" for the root) to a (files, subdirs)
+pair, where files is a dict of file name to entry and subdirs a set
+of subdirectory names."""
+    dirs = { "": (dict(), set()) }
 
-    return check_ignore_absolute(rules.absolute, path)
\ No newline at end of file
+    for e in index.entries:
+        dirname, _, basename = e.name.rpartition("/")
+        if dirname not in dirs:
+            missing = list()
+            d = dirname
+            while d not in dirs:
+                missing.append(d)
+                d = d.rpartition("/")[0]
+            for d in reversed(missing):
+                parent, _, base = d.rpartition("/")
+                dirs[parent][1].add(base)
+                dirs[d] = (dict(), set())
+        dirs[dirname][0][basename] = e
+
+    return dirs
+
+def index_tree(index):
+    """Arrange the index entries the way trees would hold them.
+
+Returns (dirs, shas), where dirs is as returned by index_dirs and shas
+maps each directory to the sha its tree would have, computed in memory
+without writing anything.  Directories with unmerged entries have no
+sha."""
+    import hashlib
+    dirs = index_dirs(index)
+    unmerged = set(e.name.rpartition("/")[0] for e in index.entries if e.flag_stage)
+
+    # Children before parents, since a tree holds its subtrees' shas.
+    shas = dict()
+    for d in sorted(dirs, key=lambda d: d.count("/") + (d != ""), reverse=True):
+        files, subdirs = dirs[d]
+        if d in unmerged or any((f"{d}/{s}" if d else s) not in shas for s in subdirs):
+            continue
+
+        items = [ (name, index_entry_mode(e), e.binsha) for name, e in files.items() ]
+        items += [ (name, b"40000", bytes.fromhex(shas[f"{d}/{name}" if d else name]))
+                   for name in subdirs ]
+        # Same order as tree_leaf_sort_key: directories sort as if
+        # their name ended with a slash.
+        items.sort(key=lambda i: i[0] + "/" if i[1] == b"40000" else i[0])
+        body = b''.join(mode + b" " + name.encode("utf8") + b"\x00" + binsha
+                        for name, mode, binsha in items)
+        shas[d] = hashlib.sha1(b"tree %d\x00" % len(body) + body).hexdigest()
+
+    return dirs, shas
+
+@traced("status_head_index")
+def status_head_index(repo, index):
+    """Compare HEAD's tree with the index.  Returns a sorted list of
+(change, path), where change is "added", "modified" or "deleted".
+
+The sha each directory would have as a tree is computed from the
+index, so subtrees that are identical in HEAD are skipped without even
+being read."""
+    dirs, shas = index_tree(index)
+    changes = list()
+
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        tree = commit_info(repo, head)[0]
+        status_tree_index(repo, tree, "", dirs, shas, changes)
+    else:
+        # No commit yet: everything is new.
+        changes = [ ("added", e.name) for e in index.entries ]
+
+    changes.sort(key=lambda c: c[1])
+    return changes
+
+def status_tree_index(repo, sha, prefix, dirs, shas, changes):
+    if shas.get(prefix) == sha:
+        return
+
+    files, subdirs = dirs.get(prefix, (dict(), set()))
+    seen_files = set()
+    seen_dirs = set()
+
+    for item in object_read(repo, sha):
+        name = item.path
+        path = f"{prefix}/{name}" if prefix else name
+        if item.mode.startswith(b'04'):
+            seen_dirs.add(name)
+            if name in subdirs:
+                status_tree_index(repo, item.sha, path, dirs, shas, changes)
+            else:
+                changes.extend(("deleted", p) for p in tree_walk_files(repo, item.sha, path))
+        else:
+            seen_files.add(name)
+            entry = files.get(name)
+            if entry is None:
+                changes.append(("deleted", path))
+            elif entry.binsha != item.binsha or index_entry_mode(entry) != item.mode:
+                changes.append(("modified", path))
+
+    for name in files.keys() - seen_files:
+        changes.append(("added", f"{prefix}/{name}" if prefix else name))
+    for name in subdirs - seen_dirs:
+        changes.extend(("added", p) for p in index_tree_files(dirs, f"{prefix}/{name}" if prefix else name))
+
+def tree_walk_files(repo, sha, prefix):
+    """Yield the path of every file under tree sha."""
+    for item in object_read(repo, sha):
+        path = f"{prefix}/{item.path}"
+        if item.mode.startswith(b'04'):
+            yield from tree_walk_files(repo, item.sha, path)
+        else:
+            yield path
+
+def index_tree_files(dirs, prefix):
+    """Yield the path of every index entry under directory prefix."""
+    files, subdirs = dirs[prefix]
+    for name in files:
+        yield f"{prefix}/{name}"
+    for name in subdirs:
+        yield from index_tree_files(dirs, f"{prefix}/{name}")
+
+#8.5.2 Index against the worktree
+
+# Below this many files to rehash, starting worker processes costs more
+# than it saves.
+status_pool_threshold = 64
+
+def cmd_status_index_worktree(repo, index):
+    print("Changes not staged for commit:")
+    modified, deleted = status_index_worktree(repo, index)
+    for path in deleted:
+        print(f"  deleted: {path}")
+    for path in modified:
+        print(f"  modified: {path}")
+
+    print()
+    print("Untracked files:")
+    for path in status_untracked(repo, index):
+        print(f"  {path}")
+
+@traced("status_index_worktree")
+def status_index_worktree(repo, index, jobs=None):
+    """Compare the index with the worktree.  Returns the sorted lists of
+modified and deleted paths.
+
+Files whose stat data still matches what the index recorded are taken
+to be unchanged, so only the others get rehashed, in parallel.  Those
+whose contents turn out unchanged get their new stat data recorded in
+the index, which is written back, so they aren't rehashed next time."""
+    index_file = repo_file(repo, "index")
+    index_mtime = os.stat(index_file).st_mtime_ns if os.path.exists(index_file) else 0
+    now = time.time_ns() // 10**9
+
+    modified = list()
+    deleted = list()
+    rehash = list()
+    filemode = repo.conf.getboolean("core", "filemode", fallback=True)
+
+    for e in index.entries:
+        if e.mode_type == 0b1110:
+            continue # Submodules are somebody else's business.
+
+        try:
+            st = os.lstat(os.path.join(repo.worktree, e.name))
+        except (FileNotFoundError, NotADirectoryError):
+            deleted.append(e.name)
+            continue
+
+        if worktree_mode(st, e, filemode) != (e.mode_type << 12) | e.mode_perms:
+            # A chmod +x, or a file turned into a symlink: changed,
+            # whatever the contents.
+            modified.append(e.name)
+        elif e.fsize != st.st_size & 0xFFFFFFFF:
+            # Different size, different contents: no need to hash.
+            modified.append(e.name)
+        elif not index_entry_stat_matches(e, st) or index_entry_is_racy(e, index_mtime):
+            rehash.append((e, st))
+
+    paths = [ os.path.join(repo.worktree, e.name) for e, st in rehash ]
+    refreshed = racy = False
+    for (e, st), sha in zip(rehash, worktree_hash_files(paths, jobs)):
+        if sha != e.sha:
+            modified.append(e.name)
+        elif st.st_mtime_ns // 10**9 < now:
+            index_entry_refresh(e, st)
+            refreshed = True
+            continue
+        # Not refreshed: a file changed this second may change again
+        # within the same clock tick, and keep the same stat data.
+        if index_entry_stat_matches(e, st):
+            # Only the index's mtime makes this entry racy.  A newer
+            # index would make it look clean, whatever its contents.
+            racy = True
+
+    if refreshed and not racy:
+        index_write(repo, index)
+
+    modified.sort()
+    return modified, deleted
+
+def worktree_mode(st, entry, filemode=True):
+    """The mode git would record for the file with lstat result st, as
+an int like index_entry_mode.  Without core.filemode, the executable
+bit can't be trusted, and is taken from entry."""
+    if stat.S_ISLNK(st.st_mode):
+        return 0o120000
+    if not filemode:
+        return 0o100000 | entry.mode_perms
+    return 0o100755 if st.st_mode & stat.S_IXUSR else 0o100644
+
+def index_entry_stat_matches(entry, st):
+    """Whether stat result st matches what entry recorded.  The index
+only stores 32 bits of each field."""
+    return (entry.mtime == ((st.st_mtime_ns // 10**9) & 0xFFFFFFFF, st.st_mtime_ns % 10**9)
+            and entry.ctime == ((st.st_ctime_ns // 10**9) & 0xFFFFFFFF, st.st_ctime_ns % 10**9)
+            and entry.ino == st.st_ino & 0xFFFFFFFF
+            and entry.fsize == st.st_size & 0xFFFFFFFF)
+
+def index_entry_refresh(entry, st):
+    """Record stat result st in entry, whose file has been checked to
+still have the contents entry holds."""
+    entry.ctime = ((st.st_ctime_ns // 10**9) & 0xFFFFFFFF, st.st_ctime_ns % 10**9)
+    entry.mtime = ((st.st_mtime_ns // 10**9) & 0xFFFFFFFF, st.st_mtime_ns % 10**9)
+    entry.dev = st.st_dev & 0xFFFFFFFF
+    entry.ino = st.st_ino & 0xFFFFFFFF
+    entry.uid = st.st_uid & 0xFFFFFFFF
+    entry.gid = st.st_gid & 0xFFFFFFFF
+    entry.fsize = st.st_size & 0xFFFFFFFF
+
+def index_entry_is_racy(entry, index_mtime):
+    """Whether entry is "racily clean": a file modified in the same
+clock tick the index was written, but after the entry was recorded,
+has exactly the stat data the index holds.  So entries not strictly
+older than the index file can't be trusted on stat data alone."""
+    return entry.mtime[0] * 10**9 + entry.mtime[1] >= index_mtime
+
+def worktree_hash_file(path):
+    """Hash the file at path as a blob, without writing it.  A symlink
+hashes to its target, which is what git stores for it."""
+    import hashlib
+    if os.path.islink(path):
+        target = os.fsencode(os.readlink(path))
+        return hashlib.sha1(b"blob %d\x00" % len(target) + target).hexdigest()
+    with open(path, "rb") as f:
+        return object_write_stream(f, b"blob")
+
+def worktree_hash_files(paths, jobs=None):
+    """Hash the files at paths, from a pool of processes if there are
+enough of them.  Returns the shas, in the same order."""
+    from concurrent.futures import ProcessPoolExecutor
+    if len(paths) < status_pool_threshold:
+        return [ worktree_hash_file(p) for p in paths ]
+
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(worktree_hash_file, paths,
+                             chunksize=max(1, len(paths) // (4 * jobs))))
+
+#8.5.3 Untracked files
+#
+# Finding untracked files means listing every directory of the
+# worktree and checking every name against the ignore rules.  But a
+# directory's mtime changes whenever a name is added to or removed from
+# it, so as long as its mtime hasn't changed, nor the ignore rules that
+# apply to it, nor the names the index tracks in it, it has the same
+# untracked files as last time.  We keep what we found for each
+# directory in .git/wyag-untracked, and next time only stat those
+# directories instead of listing them.
+
+@traced("status_untracked")
+def status_untracked(repo, index):
+    """Return the sorted paths of the files in the worktree that are
+neither in the index nor ignored."""
+    import hashlib
+    ignore = gitignore_read(repo, index)
+    dirs = index_dirs(index)
+
+    use_cache = repo.conf.getboolean("core", "untrackedCache", fallback=True)
+    cache = untracked_cache_read(repo) if use_cache else None
+    new_cache = dict()
+    start = time.time_ns()
+
+    root_rules = hashlib.sha1(repr([ r.rules for r in ignore.absolute ]).encode("utf8")).hexdigest()
+    ret = list()
+    untracked_scan(repo, "", ignore, dirs, root_rules, cache, new_cache, ret)
+
+    if use_cache:
+        untracked_cache_write(repo, start, new_cache)
+    ret.sort()
+    return ret
+
+def untracked_scan(repo, path, ignore, dirs, rules, cache, new_cache, ret):
+    """Find the untracked files under directory path, adding their
+paths to ret and the directories' records to new_cache.  rules is
+the hash of the ignore rules of path's parents."""
+    import hashlib
+    st = os.stat(os.path.join(repo.worktree, path))
+
+    # The key under which what we find here stays valid.
+    scoped = ignore.scoped.get(path)
+    rules = hashlib.sha1((rules + repr(scoped.rules if scoped else None)).encode("utf8")).hexdigest()
+    files, subdirs = dirs.get(path, (dict(), set()))
+    tracked = hashlib.sha1("\x00".join(sorted(files) + ["/"] + sorted(subdirs)).encode("utf8")).hexdigest()
+    key = [st.st_mtime_ns, st.st_ctime_ns, st.st_ino, rules, tracked]
+
+    record = cache.get(path) if cache else None
+    if not record or record[0] != key:
+        record = [key, list(), list()]
+        with os.scandir(os.path.join(repo.worktree, path)) as it:
+            for entry in it:
+                name = entry.name
+                sub = f"{path}/{name}" if path else name
+                if entry.is_dir(follow_symlinks=False):
+                    if not path and name == ".git":
+                        continue
+                    # Ignored directories are skipped whole, unless
+                    # something in them is tracked.
+                    if name in subdirs or not check_ignore(ignore, sub, is_dir=True):
+                        record[2].append(name)
+                elif name not in files and not check_ignore(ignore, sub):
+                    record[1].append(name)
+
+    new_cache[path] = record
+    ret.extend(f"{path}/{name}" if path else name for name in record[1])
+    for name in record[2]:
+        untracked_scan(repo, f"{path}/{name}" if path else name,
+                       ignore, dirs, rules, cache, new_cache, ret)
+
+def untracked_cache_read(repo):
+    """Read the untracked cache, as a dict of directory to record.
+Directories modified no earlier than the cache was started are left
+out: they may have changed again within the same clock tick."""
+    import json
+    path = repo_file(repo, "wyag-untracked")
+    if not os.path.exists(path):
+        return dict()
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except ValueError:
+        return dict() # Corrupt, start over.
+    if data.get("version") != 1:
+        return dict()
+    return { d: record for d, record in data["dirs"].items() if record[0][0] < data["time"] }
+
+def untracked_cache_write(repo, start, dirs):
+    import json, tempfile
+    path = repo_file(repo, "wyag-untracked")
+    fd, tmp_path = tempfile.mkstemp(prefix="wyag-untracked", dir=repo.gitdir)
+    with os.fdopen(fd, "w") as f:
+        json.dump({ "version": 1, "time": start, "dirs": dirs }, f, separators=(",", ":"))
+    # mkstemp creates the file 0600: give it the mode open() would have,
+    # like every other file under .git.
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0o666 & ~umask)
+    os.replace(tmp_path, path)
+
+#9 The daemon
+
+# The daemon caches parsed objects even when core.wyagCacheSize isn't
+# set, since keeping them between requests is what it's for.  The
+# setting still changes the size.
+daemon_cache_size = 64 * 1024 * 1024
+
+def argparse_daemon(argsp):
+    argsp.add_argument("--socket", metavar="path", default=None,
+                       help="Where to listen (default .git/wyag-daemon.sock)")
+
+argcommand("daemon", "Serve requests on a Unix socket, keeping caches warm.", argparse_daemon)
+
+def cmd_daemon(args):
+    import signal, socketserver
+
+    class GitDaemonServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+    class GitDaemonHandler(socketserver.StreamRequestHandler):
+        """One connection: JSON-RPC 2.0 requests, one per line, each
+answered with one line."""
+
+        def handle(self):
+            for line in self.rfile:
+                if line.strip():
+                    self.wfile.write(self.server.daemon.handle(line) + b"\n")
+                    self.wfile.flush()
+
+    repo = repo_find()
+    path = args.socket or repo_path(repo, "wyag-daemon.sock")
+    # A socket left by a daemon that died would make bind() fail.
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+
+    server = GitDaemonServer(path, GitDaemonHandler)
+    server.daemon = GitDaemon(repo.worktree)
+    print(f"Listening on {path}", flush=True)
+    # Exit through the finally below on kill too, to remove the socket.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+class GitDaemon(object):
+    """A repository kept open between requests, with its refs, index,
+ignore rules, packs and objects.  Before each request, the mtimes of
+the files those come from are checked, and whatever changed is
+dropped, to be read again on demand.
+
+Requests are handled one at a time: the caches aren't meant to be
+shared between threads."""
+
+    def __init__(self, worktree):
+        import threading
+        self.repo = GitRepository(worktree, cache_size=daemon_cache_size)
+        self.index = None
+        self.rules = None
+        self.stamps = dict()
+        self.lock = threading.Lock()
+
+    def stamp(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def refresh(self):
+        repo = self.repo
+        # Refs are updated by renaming a lock file over them, which
+        # changes their directory's mtime, so the directories are
+        # enough.  Listing every loose ref would defeat the purpose.
+        refs = list()
+        for root, dirs, files in os.walk(repo_path(repo, "refs")):
+            dirs.sort()
+            refs.append((root, self.stamp(root)))
+        stamps = {
+            "config": self.stamp(repo_path(repo, "config")),
+            "index": self.stamp(repo_path(repo, "index")),
+            "exclude": self.stamp(repo_path(repo, "info", "exclude")),
+            "packed-refs": self.stamp(repo_path(repo, "packed-refs")),
+            "refs": refs,
+            "packs": self.stamp(repo_path(repo, "objects", "pack")),
+            "commit-graph": self.stamp(repo_path(repo, "objects", "info", "commit-graph")),
+        }
+        changed = { k for k, v in stamps.items() if self.stamps.get(k) != v }
+        first = not self.stamps
+        self.stamps = stamps
+        if first:
+            return
+        if "config" in changed:
+            # Everything may depend on the config, start over.
+            self.repo = GitRepository(repo.worktree, cache_size=daemon_cache_size)
+            self.index = self.rules = None
+            return
+        if changed & { "index", "exclude" }:
+            self.index = self.rules = None
+        if changed & { "packed-refs", "refs" }:
+            repo.refs = None
+        if "packs" in changed:
+            repo.packs = repo.oids = repo.bitmap = None
+        if "commit-graph" in changed:
+            repo.commit_graph = None
+        # Loose objects come and go without touching anything above.
+        # Listing one objects/ directory is cheap, so forget them all.
+        if repo.oids:
+            repo.oids.loose.clear()
+
+    def handle(self, line):
+        """Answer the JSON-RPC request in line, returning the encoded
+response."""
+        import json
+        return json.dumps(self.answer(line), separators=(",", ":")).encode("utf8")
+
+    def answer(self, line):
+        import json
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return self.error(None, -32700, f"Parse error: {e}")
+        if type(request) != dict or type(request.get("method")) != str:
+            return self.error(None, -32600, "Invalid request")
+
+        rid = request.get("id")
+        method = getattr(self, "rpc_" + request["method"].replace("-", "_"), None)
+        if method is None:
+            return self.error(rid, -32601, f"No such method {request['method']}")
+        params = request.get("params", dict())
+        if type(params) != dict:
+            return self.error(rid, -32602, "params must be an object")
+        # Only a mismatch with the method's signature is the caller's
+        # fault: a TypeError from inside it is ours.
+        import inspect
+        try:
+            inspect.signature(method).bind(**params)
+        except TypeError as e:
+            return self.error(rid, -32602, f"Invalid params: {e}")
+
+        with self.lock:
+            try:
+                self.refresh()
+                result = method(**params)
+            except Exception as e:
+                return self.error(rid, -32603, str(e))
+        return { "jsonrpc": "2.0", "id": rid, "result": result }
+
+    def error(self, rid, code, message):
+        return { "jsonrpc": "2.0", "id": rid,
+                 "error": { "code": code, "message": message } }
+
+    def get_index(self):
+        if self.index is None:
+            self.index = index_read(self.repo)
+        return self.index
+
+    def get_rules(self):
+        if self.rules is None:
+            self.rules = gitignore_read(self.repo, self.get_index())
+        return self.rules
+
+    def rpc_rev_parse(self, name, type=None):
+        return object_find(self.repo, name, fmt=type.encode() if type else None)
+
+    def rpc_cat_file(self, object, type=None, check=False):
+        """The object's type and size and, unless check, its contents in
+base64."""
+        sha = object_find(self.repo, object, fmt=type.encode() if type else None)
+        if check:
+            header = object_read_header(self.repo, sha)
+            if header is None:
+                raise Exception(f"No such object {object}.")
+            return { "sha": sha, "type": header[0].decode("ascii"), "size": header[1] }
+        import base64
+        fmt, data = object_read_raw(self.repo, sha)
+        return { "sha": sha, "type": fmt.decode("ascii"), "size": len(data),
+                 "content": base64.b64encode(data).decode("ascii") }
+
+    def rpc_ls_tree(self, tree, recursive=False):
+        return [ { "mode": mode, "type": type, "sha": sha, "path": path }
+                 for mode, type, sha, path in ls_tree_items(self.repo, tree, recursive) ]
+
+    def rpc_ls_files(self, paths=None):
+        """Paths are relative to the worktree."""
+        index = self.get_index()
+        if not paths:
+            return [ e.name for e in index.entries ]
+        return [ e.name for e in index_find(index, paths) ]
+
+    def rpc_check_ignore(self, paths):
+        """Return those of paths, relative to the worktree, that are
+ignored.  A trailing slash marks a directory."""
+        rules = self.get_rules()
+        ret = list()
+        for path in paths:
+            is_dir = path.endswith("/") or os.path.isdir(os.path.join(self.repo.worktree, path))
+            if check_ignore(rules, path.rstrip("/") if is_dir else path, is_dir):
+                ret.append(path)
+        return ret
+
+    def rpc_log(self, revs=None, max_count=None, since=None, first_parent=False,
+                topo_order=False):
+        repo = self.repo
+        starts, exclude = log_parse_revs(repo, revs)
+        walk = rev_walk(repo, starts, exclude,
+                        max_count=max_count,
+                        since=log_parse_date(since) if since else None,
+                        first_parent=first_parent,
+                        topo_order=topo_order)
+        return [ { "sha": sha, "subject": commit_subject(object_read(repo, sha)) }
+                 for sha in walk ]
+
+#10 Packing objects: repack
+
+def argparse_repack(argsp):
+    argsp.add_argument("-d",
+                       dest="prune",
+                       action="store_true",
+                       help="Then delete the loose objects and packs the new pack makes redundant")
+    argsp.add_argument("--window",
+                       type=int,
+                       default=10,
+                       help="How many of the objects before each one to try as its delta base (default 10)")
+    argsp.add_argument("--depth",
+                       type=int,
+                       default=50,
+                       help="The longest delta chain to make (default 50)")
+    argsp.add_argument("-j",
+                       dest="jobs",
+                       type=int,
+                       default=None,
+                       help="Search for deltas from this many processes")
+    argsp.add_argument("-b", "--write-bitmap-index",
+                       dest="bitmap",
+                       action="store_true",
+                       help="Write reachability bitmaps for the new pack")
+
+argcommand("repack", "Pack every reachable object into one packfile.", argparse_repack)
+
+def cmd_repack(args):
+    repo = repo_find()
+    start = time.perf_counter()
+    stats = repack(repo, args.window, args.depth, args.jobs, args.prune, args.bitmap)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"Packed {stats['objects']} objects, {stats['deltas']} of them as deltas, into {stats['name']}.")
+    print(f"{stats['size'] / 1e6:.1f} MB of objects in a {stats['pack_size'] / 1e6:.1f} MB pack "
+          f"({stats['size'] / max(stats['pack_size'], 1):.1f}x) in {elapsed:.2f}s.")
+    if args.bitmap:
+        print(f"Wrote {stats['bitmaps']} bitmaps.")
+    if args.prune:
+        print(f"Removed {stats['pruned_loose']} loose objects and {stats['pruned_packs']} packs.")
+
+# Below this many objects, looking for deltas in a pool of processes
+# costs more than it saves.
+repack_pool_threshold = 2000
+
+@traced("repack")
+def repack(repo, window=10, depth=50, jobs=None, prune=False, bitmap=False):
+    """Write every object reachable from the refs and HEAD into one new
+pack, with deltas, and its reachability bitmaps if bitmap.  If prune,
+delete what it makes redundant: the loose objects it contains, and
+the packs it contains all of.  Returns a dict of statistics.
+
+Objects are sorted by type, then name, then decreasing size, so that
+the versions of a file end up next to each other with the biggest
+first.  Each object is then compared with the window objects before
+it, and stored as a delta against the one that gives the smallest.
+That search is split into runs of consecutive objects, handed out to
+a pool of processes."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    objects = repack_objects(repo)
+    sizes = { sha: object_read_header(repo, sha)[1] for sha in objects }
+    order = sorted(objects, key=lambda sha: (objects[sha][0], objects[sha][1], -sizes[sha]))
+    todo = [ (sha, objects[sha][0]) for sha in order ]
+
+    if len(todo) < repack_pool_threshold or jobs == 1:
+        results = repack_deltify(repo.worktree, todo, window, depth)
+    else:
+        jobs = jobs or os.cpu_count() or 1
+        # More runs than processes, so a process that gets the big
+        # blobs doesn't hold up the others.
+        step = ceil(len(todo) / (jobs * 4))
+        runs = [ todo[i:i + step] for i in range(0, len(todo), step) ]
+        results = list()
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for i, run in zip(range(0, len(todo), step),
+                              pool.map(repack_deltify, [repo.worktree] * len(runs), runs,
+                                       [window] * len(runs), [depth] * len(runs))):
+                # Bases are indexes in the run, make them global.
+                results.extend((None if base is None else i + base, size, data)
+                               for base, size, data in run)
+
+    entries = [ (sha, fmt) + result for (sha, fmt), result in zip(todo, results) ]
+    name, pack_size = pack_write(repo, entries)
+
+    stats = { "name": name,
+              "objects": len(entries),
+              "deltas": sum(1 for e in entries if e[2] is not None),
+              "size": sum(sizes.values()),
+              "pack_size": pack_size,
+              "bitmaps": 0,
+              "pruned_loose": 0,
+              "pruned_packs": 0 }
+    if bitmap:
+        stats["bitmaps"] = bitmap_write(repo, name, order,
+                                        { sha: objects[sha][0] for sha in objects })
+    if prune:
+        stats["pruned_loose"], stats["pruned_packs"] = repack_prune(repo, name, set(objects))
+
+    repo.packs = None
+    repo.oids = None
+    repo.bitmap = None
+    return stats
+
+@traced("repack_objects")
+def repack_objects(repo):
+    """Return a dict of every object reachable from the refs and HEAD to
+its (fmt, name), where name is the last path component the object was
+found under, or "" for commits and tags."""
+    objects = dict()
+    commits = list()
+    trees = list()
+
+    starts = [ ref_resolve(repo, "HEAD") ] + [ ref_resolve(repo, name)
+                                             for name in repo_refs(repo).names ]
+    for sha in starts:
+        if not sha:
+            continue
+        fmt = object_read_header(repo, sha)[0]
+        # Keep the tags themselves, and what they point to.
+        while fmt == b'tag' and sha not in objects:
+            objects[sha] = (fmt, "")
+            sha = object_read(repo, sha).header(b'object')[0].decode("ascii")
+            fmt = object_read_header(repo, sha)[0]
+        match fmt:
+            case b'commit': commits.append(sha)
+            case b'tree': trees.append((sha, ""))
+            case b'blob': objects.setdefault(sha, (fmt, ""))
+
+    while commits:
+        sha = commits.pop()
+        if sha in objects:
+            continue
+        objects[sha] = (b'commit', "")
+        tree, parents, _, _ = commit_info(repo, sha)
+        trees.append((tree, ""))
+        commits.extend(parents)
+
+    while trees:
+        sha, name = trees.pop()
+        if sha in objects:
+            continue
+        objects[sha] = (b'tree', name)
+        for leaf in object_read(repo, sha):
+            if tree_leaf_is_tree(leaf):
+                trees.append((leaf.sha, leaf.path))
+            elif not leaf.mode.startswith(b'16'): # Submodule commits aren't ours.
+                objects.setdefault(leaf.sha, (b'blob', leaf.path))
+    return objects
+
+def repack_deltify(worktree, objects, window, depth):
+    """For each of objects, a list of (sha, fmt), try the window objects
+before it as delta bases.  Returns a list of (base, size, data), one
+per object: base is the index in objects of the delta base, or None,
+size the length of the delta or object, and data the delta or object
+compressed.
+
+This runs in worker processes, so it opens the repository itself."""
+    repo = GitRepository(worktree)
+    recent = list() # (index, fmt, data, depth) of the last window objects
+    ret = list()
+    for i, (sha, fmt) in enumerate(objects):
+        data = object_read_raw(repo, sha)[1]
+        best = None
+        best_base = None
+        best_depth = 0
+        for j, base_fmt, base_data, base_depth in reversed(recent):
+            if base_fmt != fmt or base_depth >= depth:
+                continue
+            # Deltas must save at least half the object to be worth
+            # the extra work reading them.  A base much smaller than
+            # that can't give one.
+            max_size = len(data) // 2 if best is None else len(best) - 1
+            if len(base_data) < len(data) - max_size:
+                continue
+            delta = delta_create(base_data, data, max_size)
+            if delta is not None:
+                best, best_base, best_depth = delta, j, base_depth + 1
+
+        recent.append((i, fmt, data, best_depth))
+        if len(recent) > window:
+            recent.pop(0)
+
+        if best is None:
+            ret.append((None, len(data), zlib.compress(data)))
+        else:
+            ret.append((best_base, len(best), zlib.compress(best)))
+    return ret
+
+def delta_varint_encode(value):
+    """The inverse of delta_varint."""
+    out = bytearray()
+    while value >= 0x80:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.append(value)
+    return out
+
+def delta_create(base, target, max_size=None):
+    """Return a git delta that turns base into target, or None if it
+would be longer than max_size.  See delta_apply for the format.
+
+This works on lines: each line of target that's also in base starts
+a copy, which goes on for as long as the following lines match too.
+Everything else is inserted.  Binary data simply has odd lines."""
+    out = delta_varint_encode(len(base)) + delta_varint_encode(len(target))
+
+    # Where each line of base first appears.
+    index = dict()
+    pos = 0
+    for line in base.splitlines(keepends=True):
+        index.setdefault(line, pos)
+        pos += len(line)
+
+    lines = target.splitlines(keepends=True)
+    pos = 0      # Where we are in target
+    pending = 0  # Where the bytes not yet in the delta start
+    i = 0
+    while i < len(lines):
+        start = index.get(lines[i])
+        if start is None:
+            pos += len(lines[i])
+            i += 1
+            continue
+
+        length = len(lines[i])
+        i += 1
+        while i < len(lines) and base.startswith(lines[i], start + length):
+            length += len(lines[i])
+            i += 1
+
+        delta_insert(out, target[pending:pos])
+        delta_copy(out, start, length)
+        pos += length
+        pending = pos
+        if max_size is not None and len(out) > max_size:
+            return None
+
+    delta_insert(out, target[pending:])
+    if max_size is not None and len(out) > max_size:
+        return None
+    return bytes(out)
+
+def delta_insert(out, data):
+    # At most 127 bytes per instruction.
+    for i in range(0, len(data), 0x7f):
+        chunk = data[i:i + 0x7f]
+        out.append(len(chunk))
+        out += chunk
+
+def delta_copy(out, offset, size):
+    # At most 0xffffff bytes per instruction, and only the non-zero
+    # bytes of the offset and size are written.
+    while size:
+        n = min(size, 0xffffff)
+        cmd = 0x80
+        args = bytearray()
+        for i in range(4):
+            byte = (offset >> (8 * i)) & 0xff
+            if byte:
+                cmd |= 1 << i
+                args.append(byte)
+        for i in range(3):
+            byte = (n >> (8 * i)) & 0xff
+            if byte:
+                cmd |= 0x10 << i
+                args.append(byte)
+        out.append(cmd)
+        out += args
+        offset += n
+        size -= n
+
+def pack_write(repo, entries):
+    """Write a version 2 pack and its index to objects/pack.  entries
+is a list of (sha, fmt, base, size, data), in the order to write them,
+where base is the index in entries of the delta base (which must come
+first) or None, size the inflated size of the object or delta and
+data the compressed object or delta.  Returns the pack's name and
+its size."""
+    import hashlib, tempfile
+
+    pack_dir = repo_dir(repo, "objects", "pack", mkdir=True)
+    offsets = list()
+    crcs = list()
+    sha1 = hashlib.sha1()
+    fd, tmp_pack = tempfile.mkstemp(prefix="tmp_pack_", dir=pack_dir)
+    with os.fdopen(fd, "wb") as f:
+        def write(data):
+            sha1.update(data)
+            f.write(data)
+
+        write(b"PACK" + struct.pack(">II", 2, len(entries)))
+        offset = 12
+        for sha, fmt, base, size, data in entries:
+            type = PACK_OBJ_OFS_DELTA if base is not None else pack_type_codes[fmt]
+
+            # The type and size: 4 bits of size in the first byte, then
+            # 7 per byte, least significant first.
+            header = bytearray([ (type << 4) | (size & 0x0f) ])
+            size >>= 4
+            while size:
+                header[-1] |= 0x80
+                header.append(size & 0x7f)
+                size >>= 7
+
+            if base is not None:
+                # How far back the base is, as read by entry_header.
+                distance = offset - offsets[base]
+                encoded = bytearray([ distance & 0x7f ])
+                distance >>= 7
+                while distance:
+                    distance -= 1
+                    encoded.insert(0, 0x80 | (distance & 0x7f))
+                    distance >>= 7
+                header += encoded
+
+            offsets.append(offset)
+            crcs.append(zlib.crc32(data, zlib.crc32(header)))
+            write(header)
+            write(data)
+            offset += len(header) + len(data)
+
+        checksum = sha1.digest()
+        f.write(checksum)
+    pack_size = offset + 20
+
+    # The index: everything sorted by sha.
+    order = sorted(range(len(entries)), key=lambda i: entries[i][0])
+    names = [ bytes.fromhex(entries[i][0]) for i in order ]
+    fanout = [ 0 ] * 256
+    for name in names:
+        fanout[name[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    small = list()
+    large = list()
+    for i in order:
+        if offsets[i] < 0x80000000:
+            small.append(offsets[i])
+        else:
+            small.append(0x80000000 | len(large))
+            large.append(offsets[i])
+
+    idx = b"".join([ b"\377tOc", struct.pack(">I", 2),
+                     struct.pack(">256I", *fanout),
+                     b"".join(names),
+                     struct.pack(f">{len(order)}I", *(crcs[i] for i in order)),
+                     struct.pack(f">{len(small)}I", *small),
+                     struct.pack(f">{len(large)}Q", *large),
+                     checksum ])
+    idx += hashlib.sha1(idx).digest()
+
+    name = f"pack-{checksum.hex()}"
+    fd, tmp_idx = tempfile.mkstemp(prefix="tmp_idx_", dir=pack_dir)
+    with os.fdopen(fd, "wb") as f:
+        f.write(idx)
+    for tmp in (tmp_pack, tmp_idx):
+        os.chmod(tmp, 0o444)
+    # The pack goes first: readers look for the index.
+    os.replace(tmp_pack, os.path.join(pack_dir, name + ".pack"))
+    os.replace(tmp_idx, os.path.join(pack_dir, name + ".idx"))
+    return name, pack_size
+
+pack_type_codes = { v: k for k, v in pack_type_names.items() }
+
+def repack_prune(repo, name, packed):
+    """Delete the loose objects whose sha is in packed, the set of what
+pack name contains, and the other packs it contains all of, unless
+they have a .keep file.  Returns how many of each were deleted."""
+    loose = 0
+    objects = repo_path(repo, "objects")
+    for d in os.listdir(objects):
+        path = os.path.join(objects, d)
+        if len(d) != 2 or not os.path.isdir(path):
+            continue
+        for f in os.listdir(path):
+            if d + f in packed:
+                os.unlink(os.path.join(path, f))
+                loose += 1
+        if not os.listdir(path):
+            os.rmdir(path)
+
+    packs = 0
+    for pack in repo_packs(repo):
+        base = pack.idx_path[:-4]
+        if os.path.basename(base) == name or os.path.exists(base + ".keep"):
+            continue
+        if all(pack.name_at(i).hex() in packed for i in range(pack.count)):
+            for ext in (".pack", ".idx", ".bitmap"):
+                if os.path.exists(base + ext):
+                    os.unlink(base + ext)
+            packs += 1
+    return loose, packs
+
+#11 Reachability bitmaps
+
+# A bitmap file sits next to a pack and its index, as pack-*.bitmap,
+# in the same format as git's.  Bit i stands for the i-th object of
+# the pack in pack order (by offset), and each selected commit has a
+# bitmap of every object reachable from it.  All the bitmaps are
+# EWAH-compressed; in memory they're plain Python ints, which do OR
+# and AND-NOT fast.
+
+BITMAP_OPT_FULL_DAG = 0x1 # Git refuses bitmaps without this
+BITMAP_OPT_HASH_CACHE = 0x4
+
+# Every how many commits we write a bitmap, besides the ref tips.
+bitmap_interval = 100
+
+EWAH_ALL_ONES = (1 << 64) - 1
+EWAH_RUN_MAX = (1 << 32) - 1
+EWAH_LITERALS_MAX = (1 << 31) - 1
+
+def ewah_decode(buf, offset):
+    """Read the EWAH bitmap at offset in buf.  Returns (bits, offset
+after it), bits as an int.
+
+The bitmap is a list of 64-bit words.  Each marker word says that a
+run of words that are all 0 (or all 1, by its lowest bit) comes next,
+for bits 1 to 32, then the number of literal words that follow the
+run, in the upper 31 bits."""
+    bit_size, count = struct.unpack_from(">II", buf, offset)
+    words = struct.unpack_from(f">{count}Q", buf, offset + 8)
+    offset += 8 + 8 * count + 4 # The last 4 bytes point at the last marker.
+
+    out = list()
+    i = 0
+    while i < count:
+        marker = words[i]
+        i += 1
+        out.extend([ EWAH_ALL_ONES if marker & 1 else 0 ] * ((marker >> 1) & EWAH_RUN_MAX))
+        literals = marker >> 33
+        out.extend(words[i:i + literals])
+        i += literals
+    return int.from_bytes(struct.pack(f"<{len(out)}Q", *out), "little"), offset
+
+def ewah_encode(bits, nbits):
+    """Return bits, an int of nbits bits, as a serialized EWAH bitmap.
+See ewah_decode."""
+    nwords = (nbits + 63) // 64
+    words = struct.unpack(f"<{nwords}Q", bits.to_bytes(nwords * 8, "little"))
+
+    out = list()
+    marker = 0
+    i = 0
+    while i < nwords:
+        marker = len(out)
+        out.append(0)
+        run_bit = 0
+        run = 0
+        if words[i] == 0 or words[i] == EWAH_ALL_ONES:
+            clean = words[i]
+            run_bit = 1 if clean else 0
+            while i < nwords and words[i] == clean and run < EWAH_RUN_MAX:
+                run += 1
+                i += 1
+        start = i
+        while (i < nwords and words[i] != 0 and words[i] != EWAH_ALL_ONES
+               and i - start < EWAH_LITERALS_MAX):
+            i += 1
+        out.extend(words[start:i])
+        out[marker] = run_bit | (run << 1) | ((i - start) << 33)
+
+    return (struct.pack(">II", nwords * 64, len(out))
+            + struct.pack(f">{len(out)}Q", *out)
+            + struct.pack(">I", marker))
+
+class GitBitmapIndex(object):
+    """The reachability bitmaps of a pack."""
+
+    def __init__(self, pack, path):
+        self.pack = pack
+        with open(path, "rb") as f:
+            buf = f.read()
+
+        if buf[0:4] != b"BITM" or struct.unpack_from(">H", buf, 4)[0] != 1:
+            raise Exception(f"Unsupported bitmap format: {path}")
+        options, entries = struct.unpack_from(">HI", buf, 6)
+        if buf[12:32] != pack.pack[-20:]:
+            raise Exception(f"Bitmap doesn't match its pack: {path}")
+
+        offset = 32
+        self.types = dict()
+        for fmt in (b'commit', b'tree', b'blob', b'tag'):
+            self.types[fmt], offset = ewah_decode(buf, offset)
+
+        # Commit sha to (bitmap, xor_offset, position in the file).
+        # Each bitmap can be stored XORed with the one xor_offset
+        # entries before it, which is decoded on first use.
+        self.commits = dict()
+        order = list()
+        for i in range(entries):
+            position, xor_offset, flags = struct.unpack_from(">IBB", buf, offset)
+            bits, offset = ewah_decode(buf, offset + 6)
+            sha = pack.name_at(position).hex()
+            self.commits[sha] = [ bits, order[i - xor_offset] if xor_offset else None ]
+            order.append(sha)
+
+        # The pack order: positions in the index, sorted by offset,
+        # and the other way around.
+        self.count = pack.count
+        self.order = sorted(range(pack.count), key=pack.offset_at)
+        self.position = [ 0 ] * pack.count
+        for i, j in enumerate(self.order):
+            self.position[j] = i
+
+    def commit_bitmap(self, sha):
+        """The bitmap of commit sha, or None if it has none."""
+        entry = self.commits.get(sha)
+        if entry is None:
+            return None
+        if entry[1] is not None:
+            entry[0] ^= self.commit_bitmap(entry[1])
+            entry[1] = None
+        return entry[0]
+
+    def find(self, sha):
+        """The bit of the object sha, or None if it's not in the pack."""
+        i = oid_table_find(self.pack.idx, self.pack.fanout, self.pack.names_offset,
+                           bytes.fromhex(sha))
+        return None if i is None else self.position[i]
+
+    def sha_at(self, bit):
+        return self.pack.name_at(self.order[bit]).hex()
+
+def repo_bitmap(repo):
+    """Return the bitmap index of the repository's pack that has one, or
+None."""
+    if repo.bitmap is None:
+        repo.bitmap = False
+        for pack in repo_packs(repo):
+            path = pack.idx_path[:-4] + ".bitmap"
+            if os.path.exists(path):
+                repo.bitmap = GitBitmapIndex(pack, path)
+                break
+    return repo.bitmap or None
+
+def bitmap_walk(repo, starts, bitmap=None, find=None):
+    """Find every object reachable from starts, commits or tags.  Returns
+(bits, extra): bits has the bits of the objects in the bitmap's pack,
+as an int, and extra is the set of the shas of the others.  Without a
+bitmap, everything is in extra.
+
+Commits that have a bitmap aren't walked: their bitmap is ORed in.
+The commits that don't are walked down to those, then their trees,
+skipping whatever is already in.  find maps a sha to its bit, or None,
+and defaults to the bitmap's."""
+    if bitmap and find is None:
+        find = bitmap.find
+    count = bitmap.count if bitmap else 0
+    bits = bytearray((count + 7) // 8)
+    extra = set()
+
+    def add(sha):
+        """Add sha, returning whether it wasn't there already."""
+        bit = find(sha) if find else None
+        if bit is None:
+            if sha in extra:
+                return False
+            extra.add(sha)
+            return True
+        if bits[bit >> 3] & (1 << (bit & 7)):
+            return False
+        bits[bit >> 3] |= 1 << (bit & 7)
+        return True
+
+    stack = list()
+    trees = list()
+    for sha in starts:
+        fmt = object_read_header(repo, sha)[0]
+        while fmt == b'tag':
+            add(sha)
+            sha = object_read(repo, sha).header(b'object')[0].decode("ascii")
+            fmt = object_read_header(repo, sha)[0]
+        if fmt == b'commit':
+            stack.append(sha)
+        elif fmt == b'tree':
+            trees.append(sha)
+        else:
+            add(sha)
+
+    while stack:
+        sha = stack.pop()
+        found = bitmap.commit_bitmap(sha) if bitmap else None
+        if found is not None:
+            bits[:] = (int.from_bytes(bits, "little") | found).to_bytes(len(bits), "little")
+        elif add(sha):
+            tree, parents, _, _ = commit_info(repo, sha)
+            trees.append(tree)
+            stack.extend(parents)
+
+    while trees:
+        sha = trees.pop()
+        if not add(sha):
+            continue
+        for leaf in object_read(repo, sha):
+            if tree_leaf_is_tree(leaf):
+                trees.append(leaf.sha)
+            elif not leaf.mode.startswith(b'16'):
+                add(leaf.sha)
+    return int.from_bytes(bits, "little"), extra
+
+def bitmap_write(repo, pack_name, objects, fmts):
+    """Write pack_name.bitmap, for the pack that has objects, a list of
+shas in pack order, whose types are in the dict fmts.  Bitmaps are
+written for the ref tips and every bitmap_interval-th commit.
+Returns how many."""
+    import hashlib
+
+    position = { sha: i for i, sha in enumerate(objects) }
+    names = sorted(objects)
+
+    tips = set()
+    for sha in [ ref_resolve(repo, "HEAD") ] + [ ref_resolve(repo, n) for n in repo_refs(repo).names ]:
+        if sha and (sha := object_peel(repo, sha, b'commit')):
+            tips.add(sha)
+    # Parents first, so that each bitmap can reuse those of the
+    # selected commits under it.
+    commits = list(rev_walk(repo, list(tips), topo_order=True))
+    selected = [ sha for i, sha in enumerate(commits) if sha in tips or i % bitmap_interval == 0 ]
+    selected.reverse()
+
+    bitmaps = dict()
+    class Reused(object):
+        # Just enough of GitBitmapIndex for bitmap_walk.
+        count = len(objects)
+        def commit_bitmap(self, sha):
+            return bitmaps.get(sha)
+    for sha in selected:
+        bitmaps[sha] = bitmap_walk(repo, [ sha ], Reused(), position.get)[0]
+
+    types = { fmt: 0 for fmt in (b'commit', b'tree', b'blob', b'tag') }
+    for fmt in types:
+        bits = bytearray((len(objects) + 7) // 8)
+        for i, sha in enumerate(objects):
+            if fmts[sha] == fmt:
+                bits[i >> 3] |= 1 << (i & 7)
+        types[fmt] = int.from_bytes(bits, "little")
+
+    checksum = bytes.fromhex(pack_name[len("pack-"):])
+    out = [ b"BITM", struct.pack(">HHI", 1, BITMAP_OPT_FULL_DAG, len(selected)), checksum ]
+    out.extend(ewah_encode(types[fmt], len(objects)) for fmt in types)
+    for sha in selected:
+        out.append(struct.pack(">IBB", bisect.bisect_left(names, sha), 0, 0))
+        out.append(ewah_encode(bitmaps[sha], len(objects)))
+    data = b"".join(out)
+    data += hashlib.sha1(data).digest()
+
+    path = repo_path(repo, "objects", "pack", pack_name + ".bitmap")
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.chmod(path + ".tmp", 0o444)
+    os.replace(path + ".tmp", path)
+    return len(selected)
+
+def argparse_rev_list(argsp):
+    argsp.add_argument("--objects", action="store_true",
+                       help="List the trees, blobs and tags reachable too, not just the commits")
+    argsp.add_argument("--use-bitmap-index", dest="bitmap", action="store_true",
+                       help="Use the reachability bitmaps when there are some")
+    argsp.add_argument("--count", action="store_true", help="Only print how many there are")
+    argsp.add_argument("--all", action="store_true", help="Start from every ref, and HEAD")
+    argsp.add_argument("commit", nargs="*",
+                       help="Commits to start from.  ^A or A..B exclude what's reachable from A.")
+
+argcommand("rev-list", "List the objects reachable from some commits but not others.", argparse_rev_list)
+
+def cmd_rev_list(args):
+    repo = repo_find()
+    starts, exclude = log_parse_revs(repo, args.commit)
+    if args.all:
+        # Not peeled: with --objects, the tags are listed too.
+        starts += [ sha for sha in [ ref_resolve(repo, name) for name in [ "HEAD" ] + repo_refs(repo).names ]
+                    if sha ]
+
+    out = sys.stdout.buffer
+    bitmap = repo_bitmap(repo) if args.bitmap else None
+    if not (args.objects or bitmap):
+        starts = [ sha for sha in (object_peel(repo, sha, b'commit') for sha in starts) if sha ]
+        walk = rev_walk(repo, starts, exclude)
+        if args.count:
+            out.write(f"{sum(1 for _ in walk)}\n".encode("ascii"))
+        else:
+            out.writelines(f"{sha}\n".encode("ascii") for sha in walk)
+        return
+
+    objects = rev_list_objects(repo, starts, exclude, bitmap, args.objects)
+    if args.count:
+        out.write(f"{len(objects)}\n".encode("ascii"))
+    else:
+        out.writelines(f"{sha}\n".encode("ascii") for sha in objects)
+    out.flush()
+
+@traced("rev_list_objects")
+def rev_list_objects(repo, starts, exclude, bitmap=None, objects=True):
+    """Return the shas of what's reachable from starts but not from
+exclude: commits first, then trees, blobs and tags.  Only
+commits unless objects.
+
+With a bitmap, this is mostly ORs of bitmaps, then an AND-NOT: only
+the history not covered by bitmaps gets walked.  Without one,
+everything reachable from both sides is walked."""
+    bits, extra = bitmap_walk(repo, starts, bitmap)
+    if exclude:
+        not_bits, not_extra = bitmap_walk(repo, exclude, bitmap)
+        bits &= ~not_bits
+        extra -= not_extra
+
+    ret = list()
+    for fmt in (b'commit', b'tree', b'blob', b'tag') if objects else (b'commit',):
+        if bitmap:
+            typed = bits & bitmap.types[fmt]
+            while typed:
+                low = typed & -typed
+                ret.append(bitmap.sha_at(low.bit_length() - 1))
+                typed ^= low
+        ret.extend(sorted(sha for sha in extra if object_read_header(repo, sha)[0] == fmt))
+    return ret
+
+def argparse_count_objects(argsp):
+    argsp.add_argument("-v", dest="verbose", action="store_true", help="Report more")
+
+argcommand("count-objects", "Count the objects, loose and packed, and the space they take.", argparse_count_objects)
+
+def cmd_count_objects(args):
+    repo = repo_find()
+    count, size, packable = 0, 0, 0
+    objects = repo_path(repo, "objects")
+    packs = repo_packs(repo)
+    for d in os.listdir(objects):
+        if len(d) != 2 or not os.path.isdir(os.path.join(objects, d)):
+            continue
+        for f in os.listdir(os.path.join(objects, d)):
+            count += 1
+            # Like du, in 1k blocks actually used.
+            size += os.stat(os.path.join(objects, d, f)).st_blocks * 512
+            binsha = bytes.fromhex(d + f)
+            if any(pack.find(binsha) is not None for pack in packs):
+                packable += 1
+
+    if not args.verbose:
+        print(f"{count} objects, {size // 1024} kilobytes")
+        return
+    print(f"count: {count}")
+    print(f"size: {size // 1024}")
+    print(f"in-pack: {sum(pack.count for pack in packs)}")
+    print(f"packs: {len(packs)}")
+    print(f"size-pack: {sum(os.path.getsize(p.pack_path) + os.path.getsize(p.idx_path) for p in packs) // 1024}")
+    print(f"prune-packable: {packable}")
+    print("garbage: 0")
+    print("size-garbage: 0")
+
+#12 Checking the repository: fsck
+#
+# Every object is read back, hashed again and parsed: its sha must be
+# the hash of its header and contents, and trees, commits and tags must
+# be well-formed.  The objects they point to must exist and have the
+# right type.  That's the expensive part and each object is checked on
+# its own, so it's spread over a pool of processes; only the links
+# between objects come back, to find what's missing and what's
+# dangling, that is unreachable from the refs, HEAD and the index and
+# pointed to by no other object.
+
+# Below this many objects, checking them in a pool of processes costs
+# more than it saves.
+fsck_pool_threshold = 2000
+
+# The modes git writes in trees, and what they point to.  Submodules
+# (160000) point to commits in another repository.
+fsck_tree_modes = { b'40000': b'tree',
+                    b'100644': b'blob',
+                    b'100755': b'blob',
+                    b'120000': b'blob',
+                    b'160000': None }
+
+# Patterns, compiled on first use by re's own cache.
+fsck_ident_re = rb"^[^<>\n]* <[^<>\n]*> \d+ [+-]\d{4}$"
+fsck_sha_re = rb"^[0-9a-f]{40}$"
+
+def argparse_fsck(argsp):
+    argsp.add_argument("-j",
+                       dest="jobs",
+                       type=int,
+                       default=None,
+                       help="Check objects from this many processes")
+    argsp.add_argument("--json",
+                       action="store_true",
+                       help="Print a JSON summary instead of one line per problem")
+    argsp.add_argument("--no-dangling",
+                       dest="dangling",
+                       action="store_false",
+                       help="Don't list dangling objects")
+
+argcommand("fsck", "Verify the objects in the repository, and the links between them.", argparse_fsck)
+
+def cmd_fsck(args):
+    repo = repo_find()
+    report = fsck(repo, args.jobs)
+
+    if args.json:
+        import json
+        if not args.dangling:
+            del report["dangling"]
+        print(json.dumps(report, indent=2))
+    else:
+        for e in report["errors"]:
+            print(f"error in {e['type']} {e['sha']}: {e['error']}")
+        for e in report["broken"]:
+            print(f"broken link from {e['from_type']:>6} {e['from']}\n"
+                  f"              to {e['type']:>6} {e['sha']}")
+        for e in report["missing"]:
+            print(f"missing {e['type']} {e['sha']}")
+        if args.dangling:
+            for e in report["dangling"]:
+                print(f"dangling {e['type']} {e['sha']}")
+
+    if report["errors"] or report["missing"]:
+        sys.exit(1)
+
+@traced("fsck")
+def fsck(repo, jobs=None):
+    """Check every object, loose and packed, and return a report: a dict
+of counts, and of lists of problems, each a dict of their own."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    start = time.perf_counter()
+    todo = fsck_objects(repo)
+
+    if len(todo) < fsck_pool_threshold or jobs == 1:
+        jobs = 1
+        results = fsck_check(repo.worktree, todo)
+    else:
+        jobs = jobs or os.cpu_count() or 1
+        step = ceil(len(todo) / (jobs * 4))
+        runs = [ todo[i:i + step] for i in range(0, len(todo), step) ]
+        results = list()
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for run in pool.map(fsck_check, [repo.worktree] * len(runs), runs):
+                results.extend(run)
+
+    types = dict()
+    links = dict()
+    errors = list()
+    for sha, fmt, problems, refs in results:
+        if fmt is not None:
+            types[sha] = fmt
+        links.setdefault(sha, list()).extend(refs)
+        errors.extend({ "sha": sha, "type": (fmt or b'unknown').decode("ascii"), "error": p }
+                      for p in problems)
+
+    # What points where, with the types it expects.
+    referenced = set()
+    broken = list()
+    for sha, refs in links.items():
+        for ref, fmt in refs:
+            referenced.add(ref)
+            if ref not in types:
+                broken.append({ "from": sha, "from_type": types[sha].decode("ascii"),
+                                "sha": ref, "type": fmt.decode("ascii") })
+            elif types[ref] != fmt:
+                errors.append({ "sha": sha, "type": types[sha].decode("ascii"),
+                                "error": f"{ref} is a {types[ref].decode('ascii')}, not a {fmt.decode('ascii')}" })
+
+    roots = [ ref_resolve(repo, "HEAD") ] + [ ref_resolve(repo, name) for name in repo_refs(repo).names ]
+    roots = [ sha for sha in roots if sha ]
+    roots += [ e.sha for e in index_read(repo).entries if e.mode_type != 0b1110 ]
+
+    # Missing objects only count when they're reachable: the others
+    # are just broken links.
+    missing = dict()
+    reachable = set()
+    stack = [ (sha, b'object') for sha in roots ]
+    while stack:
+        sha, fmt = stack.pop()
+        if sha not in types:
+            missing[sha] = fmt
+            continue
+        if sha in reachable:
+            continue
+        reachable.add(sha)
+        stack.extend(links.get(sha, ()))
+
+    dangling = sorted(sha for sha in types if sha not in reachable and sha not in referenced)
+
+    return { "objects": len(types),
+             "loose": sum(1 for _, source in todo if source is None),
+             "packed": sum(1 for _, source in todo if source is not None),
+             "reachable": len(reachable),
+             "unreachable": len(types) - len(reachable),
+             "jobs": jobs,
+             "seconds": round(time.perf_counter() - start, 3),
+             "errors": errors,
+             "broken": broken,
+             "missing": [ { "sha": sha, "type": fmt.decode("ascii") } for sha, fmt in sorted(missing.items()) ],
+             "dangling": [ { "sha": sha, "type": types[sha].decode("ascii") } for sha in dangling ] }
+
+def fsck_objects(repo):
+    """Return every object there is, as a list of (sha, source): source
+is None for a loose object, or the number of the pack it's in.  An
+object in several places is checked in each of them.  Packed objects
+come in pack order, so the workers' delta base caches get hits."""
+    todo = list()
+    objects = repo_path(repo, "objects")
+    for d in sorted(os.listdir(objects)):
+        if len(d) == 2 and os.path.isdir(os.path.join(objects, d)):
+            todo.extend((d + f, None) for f in sorted(os.listdir(os.path.join(objects, d)))
+                        if len(f) == 38)
+
+    for i, pack in enumerate(repo_packs(repo)):
+        order = sorted(range(pack.count), key=pack.offset_at)
+        todo.extend((pack.name_at(j).hex(), i) for j in order)
+    return todo
+
+def fsck_check(worktree, objects):
+    """Check objects, a list of (sha, source) as from fsck_objects.
+Returns a list of (sha, fmt, problems, refs), one per object: fmt is
+None if the object couldn't be read at all, problems a list of
+strings, and refs the (sha, fmt) of the objects it points to.
+
+This runs in worker processes, so it opens the repository itself."""
+    import hashlib
+
+    repo = GitRepository(worktree)
+    packs = repo_packs(repo)
+    ret = list()
+    for sha, source in objects:
+        try:
+            if source is None:
+                fmt, size, chunks = object_read_loose_stream(repo, sha, 1024 * 1024)
+                data = b''.join(chunks)
+            else:
+                fmt, data = packs[source].read(packs[source].find(bytes.fromhex(sha)), repo)
+        except Exception as e:
+            ret.append((sha, None, [ f"can't read: {e}" ], []))
+            continue
+
+        problems = list()
+        refs = list()
+        actual = hashlib.sha1(fmt + b' ' + str(len(data)).encode() + b'\x00' + data).hexdigest()
+        if actual != sha:
+            problems.append(f"hash mismatch, contents hash to {actual}")
+
+        match fmt:
+            case b'tree': fsck_check_tree(data, problems, refs)
+            case b'commit': fsck_check_commit(data, problems, refs)
+            case b'tag': fsck_check_tag(data, problems, refs)
+            case b'blob': pass
+            case _: problems.append(f"unknown type {fmt!r}")
+        ret.append((sha, fmt, problems, refs))
+    return ret
+
+def fsck_check_tree(data, problems, refs):
+    previous = None
+    pos = 0
+    while pos < len(data):
+        try:
+            raw_mode = data[pos:data.index(b' ', pos)]
+            # tree_parse_one doesn't look for the path's NUL: without
+            # one, it would take the path for the sha.
+            if data.find(b'\x00', pos + len(raw_mode) + 1) < 0:
+                raise ValueError("no NUL after the path")
+            end, leaf = tree_parse_one(data, pos)
+            path = leaf.path
+        except (AssertionError, ValueError, UnicodeDecodeError):
+            problems.append(f"malformed entry at byte {pos}")
+            return
+        pos = end
+        if len(leaf.binsha) != 20:
+            problems.append(f"truncated entry {leaf.raw_path!r}")
+            return
+
+        if raw_mode.startswith(b'0'):
+            problems.append(f"zero-padded mode for {path}")
+        if raw_mode.lstrip(b'0') not in fsck_tree_modes:
+            problems.append(f"bad mode {raw_mode.decode('ascii', 'replace')} for {path}")
+        elif fmt := fsck_tree_modes[raw_mode.lstrip(b'0')]:
+            refs.append((leaf.sha, fmt))
+        if path in ("", ".", "..", ".git") or "/" in path:
+            problems.append(f"bad name {path!r}")
+
+        key = tree_leaf_sort_key(leaf)
+        if previous is not None:
+            if key == previous:
+                problems.append(f"duplicate entry {path}")
+            elif key < previous:
+                problems.append(f"entries not sorted at {path}")
+        previous = key
+
+def fsck_check_commit(data, problems, refs):
+    if not fsck_check_headers(data, (b'tree', b'author', b'committer'), problems):
+        return
+    tree = kvlm_values(data, b'tree')
+    if len(tree) != 1:
+        problems.append(f"{len(tree)} tree headers")
+    for value in tree:
+        if fsck_check_sha(value, b'tree', problems):
+            refs.append((value.decode("ascii"), b'tree'))
+    for value in kvlm_values(data, b'parent'):
+        if fsck_check_sha(value, b'parent', problems):
+            refs.append((value.decode("ascii"), b'commit'))
+    for key in (b'author', b'committer'):
+        for value in kvlm_values(data, key):
+            if not re.match(fsck_ident_re, value):
+                problems.append(f"bad {key.decode('ascii')} line")
+
+def fsck_check_tag(data, problems, refs):
+    if not fsck_check_headers(data, (b'object', b'type', b'tag'), problems):
+        return
+    obj = kvlm_values(data, b'object')[0]
+    fmt = kvlm_values(data, b'type')[0]
+    if fmt not in (b'commit', b'tree', b'blob', b'tag'):
+        problems.append(f"bad type {fmt!r}")
+    elif fsck_check_sha(obj, b'object', problems):
+        refs.append((obj.decode("ascii"), fmt))
+    for value in kvlm_values(data, b'tagger'):
+        if not re.match(fsck_ident_re, value):
+            problems.append("bad tagger line")
+
+def fsck_check_headers(data, required, problems):
+    """Check that commit or tag data parses, and has the headers in
+required, in that order, before any other.  Returns whether it
+parsed with all of them, so they can be looked up."""
+    try:
+        kvlm = kvlm_parse(data)
+    except (AssertionError, IndexError):
+        problems.append("malformed headers")
+        return False
+    keys = [ key for key in kvlm if key is not None ]
+    present = [ key for key in keys if key in required ]
+    for key in required:
+        if key not in kvlm:
+            problems.append(f"missing {key.decode('ascii')} header")
+    if present != [ key for key in required if key in kvlm ]:
+        problems.append("headers out of order")
+    return all(key in kvlm for key in required)
+
+def fsck_check_sha(value, key, problems):
+    if re.match(fsck_sha_re, value):
+        return True
+    problems.append(f"bad {key.decode('ascii')} sha {value!r}")
+    return False
@@ -0,0 +1,759 @@
+"""Checks of wyag against git, on small repositories built with git.
+
+Run with python -m pytest tests."""
+
+import json
+import os
+import subprocess
+import sys
+import time
+import zlib
+
+import pytest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+import libwyag
+
+def wyag(cwd, *args, input=None, check=True):
+    return subprocess.run([ sys.executable, os.path.join(root, "wyag"), *args ], cwd=cwd,
+                          input=input, capture_output=True, check=check)
+
+def git(cwd, *args, input=None, date=None):
+    env = dict(os.environ,
+               GIT_AUTHOR_NAME="A", GIT_AUTHOR_EMAIL="a@example.com",
+               GIT_COMMITTER_NAME="C", GIT_COMMITTER_EMAIL="c@example.com")
+    if date is not None:
+        env["GIT_AUTHOR_DATE"] = env["GIT_COMMITTER_DATE"] = f"{date} +0000"
+    return subprocess.run([ "git", *args ], cwd=cwd, env=env, input=input,
+                          capture_output=True, check=True).stdout
+
+def commit(repo, message, date):
+    """Commit what's staged, at date, a unix timestamp."""
+    git(repo, "commit", "-q", "--allow-empty", "-m", message, date=date)
+    return git(repo, "rev-parse", "HEAD").decode("ascii").strip()
+
+@pytest.fixture
+def repo(tmp_path):
+    """A repository with two files in two commits."""
+    git(tmp_path, "init", "-q", "-b", "master")
+    (tmp_path / "a.txt").write_text("a\n")
+    os.mkdir(tmp_path / "d")
+    (tmp_path / "d" / "b.txt").write_text("b\n")
+    git(tmp_path, "add", ".")
+    commit(tmp_path, "one", 1000000000)
+    (tmp_path / "a.txt").write_text("a2\n")
+    git(tmp_path, "add", ".")
+    commit(tmp_path, "two", 1000000100)
+    return tmp_path
+
+def pack_with_delta(repo):
+    """Commit two versions of a big file, and pack everything: the
+second version becomes a delta."""
+    lines = [ f"line {i}\n" for i in range(2000) ]
+    (repo / "big.txt").write_text("".join(lines))
+    git(repo, "add", ".")
+    commit(repo, "big", 1000000200)
+    lines[1000] = "changed\n"
+    (repo / "big.txt").write_text("".join(lines))
+    git(repo, "add", ".")
+    commit(repo, "bigger", 1000000300)
+    git(repo, "repack", "-adq")
+    git(repo, "prune-packed")
+    pack, = (repo / ".git" / "objects" / "pack").glob("*.pack")
+    assert b"chain length" in git(repo, "verify-pack", "-v", str(pack))
+
+def all_objects(repo):
+    """The sha and type of every object in repo."""
+    lines = git(repo, "cat-file", "--batch-all-objects", "--batch-check").decode("ascii").splitlines()
+    return [ (line.split(" ")[0], line.split(" ")[1].encode("ascii")) for line in lines ]
+
+def test_packed_objects(repo):
+    pack_with_delta(repo)
+    r = libwyag.GitRepository(str(repo))
+    for sha, fmt in all_objects(repo):
+        assert libwyag.object_read_raw(r, sha) == (fmt, git(repo, "cat-file", fmt.decode("ascii"), sha))
+
+def test_object_cache(repo):
+    head = git(repo, "rev-parse", "HEAD").decode("ascii").strip()
+    assert libwyag.GitRepository(str(repo)).cache is None
+
+    git(repo, "config", "core.wyagCacheSize", "1m")
+    r = libwyag.GitRepository(str(repo))
+    commit = libwyag.object_read(r, head)
+    assert (r.cache.hits, r.cache.misses) == (0, 1)
+    assert libwyag.object_read(r, head) is commit
+    assert (r.cache.hits, r.cache.misses) == (1, 1)
+
+    # Over the budget, the least recently used objects go first.
+    tree = commit.kvlm[b'tree'].decode("ascii")
+    libwyag.object_read(r, tree)
+    libwyag.object_read(r, head)
+    # One byte short of room for the parent.
+    r.cache.limit = r.cache.size + int(git(repo, "cat-file", "-s", "HEAD^")) - 1
+    libwyag.object_read(r, git(repo, "rev-parse", "HEAD^").decode("ascii").strip())
+    assert head in r.cache.objects
+    assert tree not in r.cache.objects
+    assert r.cache.size <= r.cache.limit
+
+def test_object_header(repo):
+    sha, fmt = all_objects(repo)[0]
+    assert wyag(repo, "cat-file", "-t", sha).stdout == fmt + b"\n"
+    assert wyag(repo, "cat-file", "-s", sha).stdout == git(repo, "cat-file", "-s", sha)
+    assert wyag(repo, "cat-file", "-e", sha).returncode == 0
+    assert wyag(repo, "cat-file", "-e", "0" * 40, check=False).returncode == 1
+
+    pack_with_delta(repo)
+    r = libwyag.GitRepository(str(repo))
+    for sha, fmt in all_objects(repo):
+        assert libwyag.object_read_header(r, sha) == \
+            (fmt, int(git(repo, "cat-file", "-s", sha)))
+
+def test_hash_object_stream(repo):
+    # Bigger than any chunk, and not a multiple of one.
+    data = b"".join(b"%d\n" % i for i in range(1000000))
+    (repo / "big.bin").write_bytes(data)
+    sha = git(repo, "hash-object", "big.bin")
+    assert wyag(repo, "hash-object", "big.bin").stdout == sha
+    sha = sha.decode("ascii").strip()
+    assert subprocess.run([ "git", "cat-file", "-e", sha ], cwd=repo).returncode != 0
+    assert wyag(repo, "hash-object", "-w", "big.bin").stdout.decode("ascii").strip() == sha
+    assert git(repo, "cat-file", "blob", sha) == data
+
+def test_object_write_stream_memory(repo):
+    import tracemalloc
+    (repo / "big.bin").write_bytes(b"x" * (32 * 1024 * 1024))
+    r = libwyag.GitRepository(str(repo))
+    tracemalloc.start()
+    try:
+        with open(repo / "big.bin", "rb") as f:
+            sha = libwyag.object_write_stream(f, b"blob", r)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert sha == git(repo, "hash-object", "big.bin").decode("ascii").strip()
+    assert peak < 1024 * 1024
+
+def test_cat_file_stream(repo):
+    data = b"".join(b"%d\n" % i for i in range(1000000))
+    (repo / "big.bin").write_bytes(data)
+    sha = git(repo, "hash-object", "-w", "big.bin").decode("ascii").strip()
+    assert wyag(repo, "cat-file", "blob", sha).stdout == data
+
+    r = libwyag.GitRepository(str(repo))
+    fmt, size, chunks = libwyag.object_read_stream(r, sha)
+    assert (fmt, size) == (b"blob", len(data))
+    assert max(len(chunk) for chunk in chunks) <= 64 * 1024
+
+def test_checkout(repo, tmp_path_factory):
+    out = tmp_path_factory.mktemp("out")
+    wyag(repo, "checkout", git(repo, "rev-parse", "HEAD").decode("ascii").strip(), str(out))
+    for name in ("a.txt", "d/b.txt"):
+        assert (out / name).read_bytes() == (repo / name).read_bytes()
+
+    # Blobs stream out of packs too, deltas included.
+    pack_with_delta(repo)
+    r = libwyag.GitRepository(str(repo))
+    commit = libwyag.object_read(r, git(repo, "rev-parse", "HEAD").decode("ascii").strip())
+    out = tmp_path_factory.mktemp("out")
+    libwyag.tree_checkout(r, libwyag.object_read(r, commit.kvlm[b'tree'].decode("ascii")), str(out))
+    for name in ("a.txt", "d/b.txt", "big.txt"):
+        assert (out / name).read_bytes() == (repo / name).read_bytes()
+
+def test_checkout_parallel(repo, tmp_path_factory):
+    for i in range(50):
+        os.makedirs(repo / f"d{i % 5}" / f"e{i % 3}", exist_ok=True)
+        (repo / f"d{i % 5}" / f"e{i % 3}" / f"f{i}").write_text(f"{i}\n" * i)
+    (repo / "run.sh").write_text("#!/bin/sh\n")
+    os.chmod(repo / "run.sh", 0o755)
+    os.symlink("d/b.txt", repo / "link")
+    git(repo, "add", ".")
+    head = commit(repo, "more", 1000000200)
+
+    outs = list()
+    for args in ([], [ "-j", "4" ]):
+        out = tmp_path_factory.mktemp("out")
+        wyag(repo, "checkout", *args, head, str(out))
+        outs.append(out)
+        assert os.readlink(out / "link") == "d/b.txt"
+        assert os.stat(out / "run.sh").st_mode & 0o111
+        assert not os.stat(out / "a.txt").st_mode & 0o111
+
+    def contents(out):
+        return { os.path.relpath(os.path.join(dirpath, f), out): open(os.path.join(dirpath, f), "rb").read()
+                 for dirpath, dirnames, filenames in os.walk(out) for f in filenames }
+    assert contents(outs[0]) == contents(outs[1]) == \
+        { name: (repo / name).read_bytes() for name in git(repo, "ls-files").decode("utf8").split() }
+
+@pytest.mark.parametrize("paths", [ [ "d", "a.txt" ], [ "a.txt", "d/b.txt", "a.txt" ], [ "." ] ])
+def test_ls_files_order(repo, paths):
+    assert wyag(repo, "ls-files", *paths).stdout == git(repo, "ls-files", *paths)
+
+def test_index_read(repo):
+    os.symlink("a.txt", repo / "link")
+    git(repo, "add", ".")
+    index = libwyag.index_read(libwyag.GitRepository(str(repo)))
+    assert [ f"{e.mode_type << 12 | e.mode_perms:o} {e.sha} {e.flag_stage}\t{e.name}" for e in index.entries ] == \
+        git(repo, "ls-files", "-s").decode("utf8").splitlines()
+    assert [ e.fsize for e in index.entries ] == [ os.lstat(repo / e.name).st_size for e in index.entries ]
+
+def test_status(repo):
+    (repo / "a.txt").write_text("a3\n")
+    os.unlink(repo / "d" / "b.txt")
+    (repo / "new.txt").write_text("new\n")
+    (repo / "staged.txt").write_text("staged\n")
+    git(repo, "add", "staged.txt")
+    assert wyag(repo, "status").stdout.decode("utf8").splitlines() == [
+        "On branch master.",
+        "Changes to be committed:",
+        "  added: staged.txt",
+        "",
+        "Changes not staged for commit:",
+        "  deleted: d/b.txt",
+        "  modified: a.txt",
+        "",
+        "Untracked files:",
+        "  new.txt" ]
+
+def test_status_mode_change(repo):
+    os.chmod(repo / "a.txt", 0o755)
+    assert git(repo, "status", "--porcelain") == b" M a.txt\n"
+    assert b"modified: a.txt" in wyag(repo, "status").stdout
+
+    git(repo, "config", "core.filemode", "false")
+    assert git(repo, "status", "--porcelain") == b""
+    assert b"modified" not in wyag(repo, "status").stdout
+
+def test_status_refreshes_index(repo):
+    def entry(name):
+        index = libwyag.index_read(libwyag.GitRepository(str(repo)))
+        return next(e for e in index.entries if e.name == name)
+
+    # Same contents, new stat data, an hour ago so it isn't racy.
+    hour_ago = int(time.time()) - 3600
+    os.utime(repo / "a.txt", (hour_ago, hour_ago))
+    extensions = libwyag.index_read(libwyag.GitRepository(str(repo))).extensions
+
+    (repo / ".git" / "index.lock").write_bytes(b"")
+    assert b"modified" not in wyag(repo, "status").stdout
+    assert entry("a.txt").mtime[0] != hour_ago
+    os.unlink(repo / ".git" / "index.lock")
+
+    assert b"modified" not in wyag(repo, "status").stdout
+    assert entry("a.txt").mtime == (hour_ago, 0)
+    assert libwyag.index_read(libwyag.GitRepository(str(repo))).extensions == extensions
+    assert git(repo, "status", "--porcelain") == b""
+    assert not os.path.exists(repo / ".git" / "index.lock")
+
+def test_status_racy_entry(repo):
+    r = libwyag.GitRepository(str(repo))
+    index = libwyag.index_read(r)
+    # a.txt changed, but its index entry has the file's exact stat
+    # data: as if it had changed in the clock tick git recorded it,
+    # which is also when the index was written.
+    a = next(e for e in index.entries if e.name == "a.txt")
+    (repo / "a.txt").write_text("a3\n")
+    libwyag.index_entry_refresh(a, os.lstat(repo / "a.txt"))
+    # And b.txt needs a refresh, which mustn't make a.txt look clean.
+    hour_ago = int(time.time()) - 3600
+    os.utime(repo / "d" / "b.txt", (hour_ago, hour_ago))
+    index.stamp = None
+    libwyag.index_write(r, index)
+    os.utime(repo / ".git" / "index", ns=(a.mtime[0] * 10**9 + a.mtime[1],) * 2)
+
+    for i in range(2):
+        assert wyag(repo, "status").stdout.count(b"modified: a.txt") == 1
+    assert os.stat(repo / ".git" / "index").st_mtime_ns == a.mtime[0] * 10**9 + a.mtime[1]
+
+def untracked(repo):
+    out = wyag(repo, "status").stdout.decode("utf8")
+    return out.split("Untracked files:\n")[1].split()
+
+def test_untracked_cache(repo):
+    (repo / "d" / "new.txt").write_text("new\n")
+    assert untracked(repo) == [ "d/new.txt" ]
+    assert os.path.exists(repo / ".git" / "wyag-untracked")
+    # Seen through the cache: each directory's mtime tells it changed.
+    os.makedirs(repo / "d" / "e")
+    (repo / "d" / "e" / "f.txt").write_text("f\n")
+    (repo / "top.txt").write_text("top\n")
+    assert untracked(repo) == [ "d/e/f.txt", "d/new.txt", "top.txt" ]
+    # wyag reads the ignore rules from the index.
+    (repo / ".gitignore").write_text("*.txt\n")
+    git(repo, "add", ".gitignore")
+    assert untracked(repo) == []
+    git(repo, "rm", "-q", "-f", ".gitignore")
+    os.unlink(repo / "d" / "new.txt")
+    assert untracked(repo) == [ "d/e/f.txt", "top.txt" ]
+
+    git(repo, "config", "core.untrackedCache", "false")
+    os.unlink(repo / ".git" / "wyag-untracked")
+    assert untracked(repo) == [ "d/e/f.txt", "top.txt" ]
+    assert not os.path.exists(repo / ".git" / "wyag-untracked")
+
+def test_untracked_cache_mode(repo):
+    old = os.umask(0o022)
+    try:
+        wyag(repo, "status")
+    finally:
+        os.umask(old)
+    assert os.stat(repo / ".git" / "wyag-untracked").st_mode & 0o777 == 0o644
+
+def test_check_ignore(repo):
+    (repo / ".gitignore").write_text("*.o\n!keep.o\n/build\ndocs/\na/**/z\n[abc].c\n\\#x\nsp\\ ace\n")
+    (repo / "d" / ".gitignore").write_text("*.txt\n!b.txt\n/top\n")
+    git(repo, "add", ".gitignore", "d/.gitignore")
+    for name in ("docs", "d/docs", "build", "d/build", "a/b/c"):
+        os.makedirs(repo / name)
+    paths = [ "x.o", "keep.o", "d/keep.o", "build", "build/x", "d/build", "docs", "docs/x",
+              "d/docs", "docs.txt", "a/z", "a/b/c/z", "a/zz", "b.c", "d.c", "#x", "sp ace",
+              "d/x.txt", "d/b.txt", "d/e/x.txt", "x.txt", "d/top", "d/e/top", "top" ]
+    stdin = "".join(p + "\n" for p in paths).encode("utf8")
+    expected = git(repo, "check-ignore", "--no-index", "--stdin", input=stdin)
+    assert expected
+    assert wyag(repo, "check-ignore", *paths).stdout == expected
+    assert wyag(repo, "check-ignore", "--stdin", input=stdin).stdout == expected
+    assert wyag(repo, "check-ignore", "--stdin", "-z", input=stdin.replace(b"\n", b"\0")).stdout == \
+        expected.replace(b"\n", b"\0")
+
+def test_commit_graph(tmp_path):
+    # Three branches merged at once: an octopus, with parents in the
+    # EDGE chunk.
+    git(tmp_path, "init", "-q", "-b", "master")
+    day = 1000000000
+    commit(tmp_path, "root", day)
+    for i, branch in enumerate(("b1", "b2", "b3")):
+        git(tmp_path, "checkout", "-q", "-b", branch, "master")
+        commit(tmp_path, branch, day + 100 * (i + 1))
+    git(tmp_path, "checkout", "-q", "master")
+    commit(tmp_path, "m1", day + 400)
+    git(tmp_path, "merge", "-q", "-m", "octopus", "b1", "b2", "b3", date=day + 500)
+    commit(tmp_path, "last", day + 600)
+
+    expected = dict()
+    for line in reversed(git(tmp_path, "log", "--all", "--topo-order", "--format=%H %T %ct %P").decode("ascii").splitlines()):
+        sha, tree, date, *parents = line.split()
+        expected[sha] = (tree, parents, int(date), 1 + max((expected[p][3] for p in parents), default=0))
+
+    wyag(tmp_path, "commit-graph", "write")
+    git(tmp_path, "commit-graph", "verify")
+    r = libwyag.GitRepository(str(tmp_path))
+    assert libwyag.repo_commit_graph(r) is not None
+    assert { sha: libwyag.commit_info(r, sha) for sha in expected } == expected
+
+    # And one git wrote.
+    os.unlink(tmp_path / ".git" / "objects" / "info" / "commit-graph")
+    git(tmp_path, "commit-graph", "write", "--reachable")
+    r = libwyag.GitRepository(str(tmp_path))
+    assert { sha: libwyag.commit_info(r, sha) for sha in expected } == expected
+
+def merged_history(path):
+    """Two branches whose commits alternate by date, merged twice."""
+    git(path, "init", "-q", "-b", "master")
+    day = 1000000000
+    commit(path, "root", day)
+    git(path, "checkout", "-q", "-b", "side")
+    commit(path, "s1", day + 100)
+    git(path, "checkout", "-q", "master")
+    commit(path, "m1", day + 200)
+    git(path, "checkout", "-q", "side")
+    commit(path, "s2", day + 300)
+    git(path, "checkout", "-q", "master")
+    commit(path, "m2", day + 400)
+    git(path, "merge", "-q", "--no-ff", "side", "-m", "merge", date=day + 500)
+    git(path, "checkout", "-q", "-b", "other", "HEAD~2")
+    commit(path, "o1", day + 600)
+    git(path, "checkout", "-q", "master")
+    commit(path, "m3", day + 700)
+    git(path, "merge", "-q", "--no-ff", "other", "-m", "merge2", date=day + 800)
+
+def log_subjects(path, *args):
+    """The subjects wyag log prints, to compare with git's."""
+    ours = wyag(path, "log", "--oneline", *args).stdout.splitlines()
+    return [ line.split(b" ", 1)[1] for line in ours ]
+
+def test_log(tmp_path):
+    merged_history(tmp_path)
+    for args in ([], [ "-n", "3" ], [ "--first-parent" ], [ "side" ], [ "master", "side" ],
+                 [ "side..master" ], [ "master", "^other" ]):
+        assert log_subjects(tmp_path, *args) == git(tmp_path, "log", "--format=%s", *args).splitlines(), args
+    assert log_subjects(tmp_path, "--since", "1000000400") == \
+        git(tmp_path, "log", "--format=%s", "--since=@1000000400").splitlines()
+
+def test_log_topo_order(tmp_path):
+    merged_history(tmp_path)
+    for args in ([], [ "--first-parent" ], [ "-n", "4" ]):
+        assert log_subjects(tmp_path, "--topo-order", *args) == \
+            git(tmp_path, "log", "--format=%s", "--topo-order", *args).splitlines(), args
+
+def test_log_long_history(tmp_path):
+    # Deeper than the recursion limit.
+    git(tmp_path, "init", "-q", "-b", "master")
+    stream = list()
+    for i in range(3000):
+        stream.append(f"commit refs/heads/master\ncommitter C <c@example.com> {1000000000 + i} +0000\n"
+                      f"data {len(str(i))}\n{i}\n")
+    git(tmp_path, "fast-import", "--quiet", input="".join(stream).encode("ascii"))
+    subjects = log_subjects(tmp_path, "master")
+    assert len(subjects) == 3000
+    assert subjects[0] == b"2999" and subjects[-1] == b"0"
+
+def test_packed_refs(repo):
+    git(repo, "branch", "b1")
+    git(repo, "tag", "light")
+    git(repo, "tag", "-a", "-m", "annotated", "v1", date=1000000200)
+    git(repo, "tag", "-a", "-m", "tag of a tag", "v1-again", "v1", date=1000000200)
+    loose = git(repo, "show-ref")
+
+    # wyag packs like git.
+    wyag(repo, "pack-refs", "--all")
+    packed = (repo / ".git" / "packed-refs").read_bytes()
+    assert not os.listdir(repo / ".git" / "refs" / "tags")
+    assert wyag(repo, "show-ref").stdout == git(repo, "show-ref") == loose
+    os.unlink(repo / ".git" / "packed-refs")
+    for line in loose.decode("ascii").splitlines():
+        sha, name = line.split()
+        (repo / ".git" / name).write_text(sha + "\n")
+    git(repo, "pack-refs", "--all")
+    assert (repo / ".git" / "packed-refs").read_bytes() == packed
+
+    # A loose ref wins over a packed one.
+    head = git(repo, "rev-parse", "HEAD^").decode("ascii").strip()
+    git(repo, "update-ref", "refs/heads/b1", head)
+    assert wyag(repo, "show-ref").stdout == git(repo, "show-ref")
+    assert wyag(repo, "rev-parse", "b1").stdout.decode("ascii").strip() == head
+    assert wyag(repo, "rev-parse", "v1").stdout == git(repo, "rev-parse", "v1")
+
+@pytest.mark.parametrize("args", [ [ "--abbrev", "HEAD" ],
+                                   [ "HEAD", "--abbrev" ],
+                                   [ "--abbrev=4", "HEAD" ],
+                                   [ "--abbrev=12", "-r", "HEAD" ] ])
+def test_ls_tree_abbrev(repo, args):
+    assert wyag(repo, "ls-tree", *args).stdout == git(repo, "ls-tree", *args)
+
+def test_rev_parse_short(repo):
+    pack_with_delta(repo)
+    for sha, _ in all_objects(repo):
+        for n in (7, 12, 40):
+            assert wyag(repo, "rev-parse", sha[:n]).stdout == (sha + "\n").encode("ascii")
+    assert (wyag(repo, "log", "--oneline").stdout
+            == git(repo, "log", "--oneline", "--no-decorate"))
+
+def test_cat_file_modes(repo):
+    assert wyag(repo, "cat-file", "-t", "HEAD").stdout == b"commit\n"
+    assert wyag(repo, "cat-file", "-s", "HEAD").stdout == git(repo, "cat-file", "-s", "HEAD")
+    assert wyag(repo, "cat-file", "-e", "HEAD").returncode == 0
+    assert wyag(repo, "cat-file", "-e", "0" * 40, check=False).returncode == 1
+    assert wyag(repo, "cat-file", "commit", "HEAD").stdout == git(repo, "cat-file", "commit", "HEAD")
+
+def test_cat_file_batch(repo):
+    names = git(repo, "rev-list", "--objects", "--all")
+    names = b"".join(line.split(b" ")[0] + b"\n" for line in names.splitlines()) + b"nosuchobject\n"
+    for mode in ("--batch", "--batch-check"):
+        assert wyag(repo, "cat-file", mode, input=names).stdout == \
+            git(repo, "cat-file", mode, input=names)
+
+def test_daemon_errors(repo):
+    daemon = libwyag.GitDaemon(str(repo))
+    def code(method, **params):
+        response = daemon.answer(json.dumps({ "jsonrpc": "2.0", "id": 1,
+                                              "method": method, "params": params }))
+        return response["error"]["code"] if "error" in response else None
+
+    assert code("rev-parse", name="HEAD") is None
+    assert code("rev-parse") == -32602
+    assert code("rev-parse", name="HEAD", color=True) == -32602
+    # Params that fit the signature, but break the method.
+    assert code("ls-files", paths=5) == -32603
+    assert code("rev-parse", name="nosuchref") == -32603
+
+def test_daemon_ls_files(repo):
+    daemon = libwyag.GitDaemon(str(repo))
+    for paths in ([ "d", "a.txt" ], [ "a.txt", "d/b.txt", "a.txt" ], [ "." ]):
+        request = { "jsonrpc": "2.0", "id": 1, "method": "ls-files", "params": { "paths": paths } }
+        assert daemon.answer(json.dumps(request))["result"] == \
+            git(repo, "ls-files", *paths).decode("utf8").splitlines()
+
+def test_daemon_cache(repo):
+    request = json.dumps({ "jsonrpc": "2.0", "id": 1, "method": "ls-tree",
+                           "params": { "tree": "HEAD", "recursive": True } })
+    daemon = libwyag.GitDaemon(str(repo))
+    assert daemon.repo.cache.limit == libwyag.daemon_cache_size
+    daemon.answer(request)
+    hits = daemon.repo.cache.hits
+    daemon.answer(request)
+    assert daemon.repo.cache.hits > hits
+
+    # The config only changes the size.
+    git(repo, "config", "core.wyagCacheSize", "1m")
+    assert libwyag.GitDaemon(str(repo)).repo.cache.limit == 1024 * 1024
+    git(repo, "config", "core.wyagCacheSize", "0")
+    assert libwyag.GitDaemon(str(repo)).repo.cache is None
+
+# What only some commands need, and importing libwyag mustn't pull in:
+# see the comment at the top of libwyag.py.
+deferred_modules = { "base64", "concurrent.futures", "datetime", "grp", "hashlib", "inspect",
+                     "json", "logging", "mmap", "multiprocessing", "pwd", "shutil", "signal",
+                     "socket", "socketserver", "subprocess", "tempfile", "threading" }
+
+def test_import_defers_modules():
+    env = { key: value for key, value in os.environ.items() if key != "WYAG_TRACE" }
+    env["PYTHONPATH"] = root
+    p = subprocess.run([ sys.executable, "-X", "importtime", "-c", "import libwyag" ],
+                       env=env, capture_output=True, text=True, check=True)
+    # "import time: self [us] | cumulative | imported package", the
+    # package indented by how deep it was imported.
+    imported = { line.split("|")[-1].strip() for line in p.stderr.splitlines()[1:] }
+    assert "libwyag" in imported
+    assert not imported & deferred_modules
+
+def test_diff_tree_merge(repo):
+    git(repo, "checkout", "-q", "-b", "side", "HEAD~1")
+    (repo / "d" / "c.txt").write_text("c\n")
+    git(repo, "add", ".")
+    commit(repo, "side", 1000000200)
+    git(repo, "checkout", "-q", "master")
+    git(repo, "merge", "-q", "--no-ff", "side", "-m", "merge", date=1000000300)
+
+    # wyag doesn't parse HEAD~1 and the like.
+    first, second = git(repo, "rev-parse", "HEAD^1", "HEAD^2").decode("ascii").split()
+    for args in ([ "HEAD" ], [ "-r", "HEAD" ], [ "-m", "HEAD" ], [ "-r", "-m", "HEAD" ],
+                 [ "-r", first ], [ "-r", second, "HEAD" ]):
+        assert wyag(repo, "diff-tree", *args).stdout == git(repo, "diff-tree", *args), args
+
+def test_tree_leaves(repo):
+    # "a" sorts after "a-b" and "a.txt" as a tree, before them as a file.
+    os.mkdir(repo / "a")
+    (repo / "a" / "c.txt").write_text("c\n")
+    (repo / "a-b").write_text("ab\n")
+    os.symlink("a.txt", repo / "s")
+    git(repo, "add", ".")
+    commit(repo, "three", 1000000200)
+
+    r = libwyag.GitRepository(str(repo))
+    for line in git(repo, "rev-list", "--objects", "--all").decode("ascii").splitlines():
+        sha = line.split(" ")[0]
+        obj = libwyag.object_read(r, sha)
+        if obj.fmt != b'tree':
+            continue
+        expected = list()
+        for entry in git(repo, "ls-tree", sha).decode("utf8").splitlines():
+            info, path = entry.split("\t")
+            mode, _, leaf_sha = info.split(" ")
+            expected.append((mode, leaf_sha, path))
+        assert [ (leaf.mode.decode("ascii"), leaf.sha, leaf.path) for leaf in obj ] == expected
+        assert libwyag.object_write(obj, None) == sha
+        # Parsed and shuffled, the leaves are sorted back on the way out.
+        obj.items.reverse()
+        assert libwyag.object_write(obj, None) == sha
+
+    tree = libwyag.object_read(r, git(repo, "rev-parse", "HEAD^{tree}").decode("ascii").strip())
+    assert tree.find("a").mode == b'040000'
+    assert tree.find("a.txt").path == "a.txt"
+    assert tree.find("s").mode == b'120000'
+    assert tree.find("b") is None
+
+def test_commit_headers(repo):
+    head = git(repo, "rev-parse", "HEAD").decode("ascii").strip()
+    tree = git(repo, "rev-parse", "HEAD^{tree}").decode("ascii").strip()
+    # A multi-line header, a blank line in the message, and more
+    # parents than a recursive parser would get through.
+    raw = (f"tree {tree}\n".encode("ascii")
+           + f"parent {head}\n".encode("ascii") * 3000
+           + b"author A <a@example.com> 1000000000 +0000\n"
+           + b"committer C <c@example.com> 1000000200 +0000\n"
+           + b"gpgsig -----BEGIN PGP SIGNATURE-----\n \n abc\n -----END PGP SIGNATURE-----\n"
+           + b"\nsubject\n\nbody\n")
+    sha = git(repo, "hash-object", "-t", "commit", "-w", "--stdin", "--literally",
+              input=raw).decode("ascii").strip()
+
+    r = libwyag.GitRepository(str(repo))
+    commit = libwyag.object_read(r, sha)
+    assert commit.tree == tree
+    assert commit.parents == [ head ] * 3000
+    assert commit.committer_time == 1000000200
+    assert commit.message == b"subject\n\nbody\n"
+    assert libwyag.commit_subject(commit) == "subject"
+
+    # Parsed, then written back as it was.
+    assert len(commit.kvlm[b'parent']) == 3000
+    assert commit.kvlm[b'gpgsig'] == b"-----BEGIN PGP SIGNATURE-----\n\nabc\n-----END PGP SIGNATURE-----"
+    assert commit.serialize() == raw
+    assert commit.parents == [ head ] * 3000
+
+@pytest.mark.parametrize("pool", [ False, True ])
+def test_repack(repo, monkeypatch, pool):
+    # An old pack, loose objects, versions of a file to delta, a tag.
+    pack_with_delta(repo)
+    lines = (repo / "big.txt").read_text().splitlines(True)
+    for i in range(3):
+        lines[i * 500] = f"version {i}\n"
+        (repo / "big.txt").write_text("".join(lines))
+        git(repo, "add", ".")
+        commit(repo, f"version {i}", 1000000400 + i)
+    git(repo, "tag", "-a", "-m", "tag", "v1", date=1000000500)
+    before = sorted(all_objects(repo))
+
+    if pool:
+        # Small as it is, have the repository packed by a pool.
+        monkeypatch.setattr(libwyag, "repack_pool_threshold", 0)
+        stats = libwyag.repack(libwyag.GitRepository(str(repo)), jobs=2, prune=True)
+        assert stats["objects"] == len(before)
+        assert stats["pruned_packs"] == 1
+    else:
+        assert wyag(repo, "repack", "-d").stdout.startswith(f"Packed {len(before)} objects".encode("ascii"))
+
+    git(repo, "fsck", "--full", "--strict")
+    assert sorted(all_objects(repo)) == before
+    pack, = (repo / ".git" / "objects" / "pack").glob("*.pack")
+    assert b"chain length" in git(repo, "verify-pack", "-v", str(pack))
+    assert git(repo, "count-objects").startswith(b"0 objects")
+
+def bitmap_history(path):
+    """250 commits on master, a side branch off the 120th, and a tag."""
+    git(path, "init", "-q", "-b", "master")
+    stream = list()
+    for i in range(250):
+        stream.append(f"commit refs/heads/master\nmark :{i + 1}\n"
+                      f"committer C <c@example.com> {1000000000 + i} +0000\ndata 2\nm\n"
+                      f"M 644 inline f\ndata {len(str(i))}\n{i}\n"
+                      f"M 644 inline d/g{i % 5}\ndata {len(str(i))}\n{i}\n")
+    stream.append(f"commit refs/heads/side\ncommitter C <c@example.com> 1000001000 +0000\ndata 2\ns\n"
+                  f"from :120\nM 644 inline s\ndata 2\ns\n")
+    git(path, "fast-import", "--quiet", input="".join(stream).encode("ascii"))
+    git(path, "tag", "-a", "-m", "tag", "v1", "master", date=1000002000)
+
+def test_rev_list_bitmap(tmp_path):
+    bitmap_history(tmp_path)
+    side = git(tmp_path, "rev-parse", "side").decode("ascii").strip()
+    wyag(tmp_path, "repack", "-d", "-b")
+    assert list((tmp_path / ".git" / "objects" / "pack").glob("*.bitmap"))
+    git(tmp_path, "rev-list", "--test-bitmap", "master")
+
+    for writer in ("wyag", "git"):
+        if writer == "git":
+            git(tmp_path, "repack", "-adqb")
+        assert libwyag.repo_bitmap(libwyag.GitRepository(str(tmp_path))), writer
+        for args in ([ "master" ], [ "side" ], [ "master", "^" + side ], [ "side", "^master" ], [ "--all" ]):
+            ours = wyag(tmp_path, "rev-list", "--objects", "--use-bitmap-index", *args).stdout.split()
+            theirs = [ line.split(b" ")[0] for line in
+                       git(tmp_path, "rev-list", "--objects", *args).splitlines() ]
+            assert sorted(ours) == sorted(theirs), (writer, args)
+        assert wyag(tmp_path, "rev-list", "--count", "--use-bitmap-index", "master").stdout == b"250\n"
+
+def test_count_objects(repo):
+    assert wyag(repo, "count-objects").stdout == git(repo, "count-objects")
+    pack_with_delta(repo)
+    (repo / "e.txt").write_text("e\n")
+    git(repo, "add", ".")
+    assert wyag(repo, "count-objects", "-v").stdout == git(repo, "count-objects", "-v")
+
+@pytest.mark.parametrize("pool", [ False, True ])
+def test_fsck(repo, monkeypatch, pool):
+    pack_with_delta(repo)
+    dangling = git(repo, "hash-object", "-w", "--stdin", input=b"dangling\n").decode("ascii").strip()
+    (repo / "e.txt").write_text("e\n")
+    git(repo, "add", ".")
+    commit(repo, "three", 1000000400)
+    r = libwyag.GitRepository(str(repo))
+    if pool:
+        monkeypatch.setattr(libwyag, "fsck_pool_threshold", 0)
+    report = libwyag.fsck(r, jobs=2)
+    assert report["errors"] == report["broken"] == report["missing"] == []
+    assert report["dangling"] == [ { "sha": dangling, "type": "blob" } ]
+    assert report["objects"] == len(all_objects(repo))
+
+    # A missing blob, and a corrupt one.
+    missing = git(repo, "rev-parse", "HEAD:e.txt").decode("ascii").strip()
+    os.unlink(repo / ".git" / "objects" / missing[:2] / missing[2:])
+    path = repo / ".git" / "objects" / dangling[:2] / dangling[2:]
+    os.chmod(path, 0o644)
+    path.write_bytes(zlib.compress(b"blob 8\x00dingling"))
+    report = libwyag.fsck(r, jobs=2)
+    assert report["missing"] == [ { "sha": missing, "type": "blob" } ]
+    assert [ e["sha"] for e in report["errors"] ] == [ dangling ]
+
+def test_fsck_malformed(repo):
+    blob = bytes.fromhex(git(repo, "rev-parse", "HEAD:a.txt").decode("ascii").strip())
+    tag = git(repo, "hash-object", "-t", "tag", "--literally", "-w", "--stdin",
+              input=b"type commit\ntag v1\n\nno object\n").decode("ascii").strip()
+    commit = git(repo, "hash-object", "-t", "commit", "--literally", "-w", "--stdin",
+                 input=b"author A <a@example.com> 0 +0000\n\nno tree\n").decode("ascii").strip()
+    # The second entry has no NUL after its path.
+    tree = git(repo, "hash-object", "-t", "tree", "--literally", "-w", "--stdin",
+               input=b"100644 a\x00" + blob + b"100644 b" + b"x" * 30).decode("ascii").strip()
+
+    p = wyag(repo, "fsck", check=False)
+    assert p.returncode == 1
+    assert p.stderr == b""
+    errors = p.stdout.decode("ascii").splitlines()
+    assert f"error in tag {tag}: missing object header" in errors
+    assert f"error in commit {commit}: missing tree header" in errors
+    assert f"error in commit {commit}: missing committer header" in errors
+    assert f"error in tree {tree}: malformed entry at byte 29" in errors
+    assert b"broken link" not in p.stdout
+
+tiny_shape = [ "--commits", "5", "--files", "3", "--dirs", "2", "--depth", "1",
+               "--tags", "1", "--ignore-rules", "5", "--untracked", "5" ]
+
+def test_generate(tmp_path):
+    for name in ("one", "two"):
+        subprocess.run([ sys.executable, os.path.join(root, "benchmarks", "generate.py"),
+                         str(tmp_path / name), *tiny_shape ], check=True)
+    # The same shape gives the same repository.
+    assert git(tmp_path / "one", "rev-parse", "HEAD") == git(tmp_path / "two", "rev-parse", "HEAD")
+    git(tmp_path / "one", "fsck", "--full", "--strict")
+    # The index matches HEAD and the worktree: only untracked files show.
+    status = git(tmp_path / "one", "status", "--porcelain").splitlines()
+    assert status and all(line.startswith(b"?? ") for line in status)
+
+def test_bench(tmp_path):
+    bench = [ sys.executable, os.path.join(root, "benchmarks", "bench.py") ]
+    old = tmp_path / "old.json"
+    subprocess.run([ *bench, "run", "rev-parse", "ls-files", "--repeat", "1", "-o", str(old),
+                     "--repo", str(tmp_path / "repo"), *tiny_shape ],
+                   cwd=tmp_path, capture_output=True, check=True)
+    results = json.loads(old.read_text())
+    assert set(results["scenarios"]) == { "rev-parse", "ls-files" }
+
+    compare = [ *bench, "compare", str(old) ]
+    assert subprocess.run([ *compare, str(old) ], capture_output=True).returncode == 0
+    results["scenarios"]["ls-files"]["median"] *= 2
+    new = tmp_path / "new.json"
+    new.write_text(json.dumps(results))
+    p = subprocess.run([ *compare, str(new) ], capture_output=True)
+    assert p.returncode == 1
+    assert b"REGRESSION" in p.stdout
+
+def traced_wyag(repo, path, *args):
+    env = dict(os.environ, WYAG_TRACE=str(path))
+    p = subprocess.run([ sys.executable, os.path.join(root, "wyag"), *args ], cwd=repo, env=env,
+                       capture_output=True)
+    return p, json.loads(path.read_text())
+
+def test_trace(repo, tmp_path):
+    p, events = traced_wyag(repo, tmp_path / "trace.json", "ls-tree", "-r", "HEAD")
+    assert p.stdout == git(repo, "ls-tree", "-r", "HEAD")
+    regions = { e["name"] for e in events["traceEvents"] if e["ph"] == "X" }
+    assert { "wyag ls-tree", "repo_find", "config", "ls_tree" } <= regions
+    counters = events["otherData"]["counters"]
+    assert (counters["objects.commit"], counters["objects.tree"]) == (1, 2)
+    assert counters["bytes.inflated"] > 0
+
+    # Written however the command ends.
+    p, events = traced_wyag(repo, tmp_path / "failed.json", "cat-file", "-t", "nosuchref")
+    assert p.returncode != 0
+    assert "wyag cat-file" in { e["name"] for e in events["traceEvents"] }
+
+def test_trace_cache_counters(repo, tmp_path):
+    git(repo, "config", "core.wyagCacheSize", "1m")
+    r = libwyag.GitRepository(str(repo))
+    head = git(repo, "rev-parse", "HEAD").decode("ascii").strip()
+    libwyag.trace = libwyag.GitTrace(str(tmp_path / "trace.json"))
+    try:
+        for i in range(3):
+            libwyag.object_read(r, head)
+        counters = libwyag.trace.counters
+    finally:
+        libwyag.trace = None
+    assert (counters["cache.hits"], counters["cache.misses"]) == (2, 1)